@@ -4,7 +4,6 @@
 ################
 from azure.search.documents import SearchClient
 from azure.core.credentials import AzureKeyCredential, AzureNamedKeyCredential
-from azure.search.documents.indexes import SearchIndexClient
 from azure.ai.formrecognizer import DocumentAnalysisClient, DocumentField
 from azure.search.documents.indexes.models import (
     SearchIndex,
@@ -15,16 +14,34 @@ from azure.search.documents.indexes.models import (
     SearchFieldDataType,
     VectorSearch,
     HnswParameters,
-    VectorSearchAlgorithmConfiguration,
-    VectorSearchAlgorithmKind,
+    HnswAlgorithmConfiguration,
+    ExhaustiveKnnParameters,
+    ExhaustiveKnnAlgorithmConfiguration,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    BinaryQuantizationCompression,
+    RescoringOptions,
     VectorSearchProfile
 )
 from azure.storage.blob import BlobServiceClient
-from openai import AzureOpenAI
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import base64
+import logging
+import queue
 import json
+import time
 import os
 import uuid
 
+import Clients
+import AnswerCache
+import Metrics
+import Tokens
+import Chunker
+import Tracing
+import LocalSearch
+
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
 AZURE_AI_FOUNDRY_ENDPOINT = os.getenv("AZURE_AI_FOUNDRY_ENDPOINT")
@@ -41,86 +58,363 @@ AZURE_STORAGE_ACCOUNT_CONTAINER_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_CONTAINE
 ##############
 # Getting the embedding dimension of a model
 #############
-def getEmbeddingDimension():
-    openai_client = AzureOpenAI(
-        api_version=AZURE_OPENAI_API_VERSION,
-        azure_endpoint=AZURE_AI_FOUNDRY_ENDPOINT,
-        api_key=AZURE_OPENAI_API_KEY,
-    )
+# default dimensions of the Azure OpenAI embedding models, looked up by deployment name and by AZURE_OPENAI_EMBEDDING_MODEL_NAME
+KNOWN_EMBEDDING_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+AZURE_OPENAI_EMBEDDING_MODEL_NAME = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL_NAME")
+
+_embedding_dimensions = {}  # deployment -> dimension
+_embedding_dimensions_lock = threading.Lock()
+
+def getEmbeddingDimension(deployment=None):
+    #Returns the dimension of the embeddings of a deployment (defaults to the chatbot's), resolved once per process:
+    #from the known models, then from the metadata of an index created for the deployment, and only then by
+    #embedding a probe text
+    deployment = deployment or AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME
+    dimension = _embedding_dimensions.get(deployment)
+    if dimension:
+        return dimension
+
+    with _embedding_dimensions_lock:
+        if deployment not in _embedding_dimensions:
+            model_name = AZURE_OPENAI_EMBEDDING_MODEL_NAME if deployment == AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME else None
+            _embedding_dimensions[deployment] = (
+                KNOWN_EMBEDDING_DIMENSIONS.get(deployment)
+                or KNOWN_EMBEDDING_DIMENSIONS.get(model_name)
+                or _indexedEmbeddingDimension(deployment)
+                or _probeEmbeddingDimension(deployment)
+            )
+        return _embedding_dimensions[deployment]
+
+def _indexedEmbeddingDimension(deployment):
+    #dimension recorded by createIndex in the metadata of an index built with the deployment
+    for schema in getIndexSchemaCache().schemas().values():
+        if schema["metadata"].get("embedding_deployment") == deployment and schema["metadata"].get("embedding_dimensions"):
+            return schema["metadata"]["embedding_dimensions"]
+    return None
+
+def _probeEmbeddingDimension(deployment):
+    openai_client = Clients.getOpenAIClient()
 
     response = openai_client.embeddings.create(
-        model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME,
+        model=deployment,
         input="test"
     )
     
     embedding_vector = response.data[0].embedding
-    openai_client.close()
+    Metrics.increment("embedding.dimension_probes")
     return len(embedding_vector)
 
 
 ################
-# Listing Search Indexes 
+# Index Schemas
 ############
-def listIndexes():
+INDEX_SCHEMA_CACHE_TTL_SECONDS = int(os.getenv("INDEX_SCHEMA_CACHE_TTL_SECONDS", "300"))
 
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    index_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=credential)
+class IndexSchemaCache:
+    """
+    Per-process cache of the index definitions used by the admin functions (listIndexes, getFields, getKeyField).
+    Every definition is loaded by one list_indexes request and kept for ttl_seconds. createIndex and
+    deleteIndex invalidate it, an index missing from the cache triggers a reload before it is reported missing.
+    """
+    def __init__(self, ttl_seconds=INDEX_SCHEMA_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._schemas = None  # index_name -> {"name", "fields", "key_field", "metadata"}
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _load(self):
+        index_client = Clients.getSearchIndexClient()
+        return {index.name: indexSchema(index) for index in index_client.list_indexes()}
+
+    def schemas(self, refresh=False):
+        #returns {index_name: schema}
+        with self._lock:
+            if not refresh and self._schemas is not None and self._expires_at > time.monotonic():
+                self._hits += 1
+                return self._schemas
+            self._misses += 1
+            self._schemas = self._load()
+            self._expires_at = time.monotonic() + self.ttl_seconds
+            return self._schemas
+
+    def get(self, index_name):
+        schema = self.schemas().get(index_name)
+        if schema is None:
+            #created by another worker since the last load
+            schema = self.schemas(refresh=True).get(index_name)
+        if schema is None:
+            raise ValueError(f"Index {index_name} not found")
+        return schema
+
+    def invalidate(self):
+        with self._lock:
+            self._schemas = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "indexes": len(self._schemas or {}),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0
+            }
 
-    # List all indexes
-    indexes = index_client.list_indexes()
-    index_list = []
-    for idx in indexes:
-        index_list.append(idx.name)
-    return index_list
+
+_index_schema_cache = IndexSchemaCache()
+
+def getIndexSchemaCache():
+    return _index_schema_cache
+
+def indexSchema(index):
+    #the parts of a SearchIndex definition used by the admin functions
+    fields = [
+        {"name": field.name, "type": field.type, "key": bool(getattr(field, "key", False)),
+         "sortable": bool(getattr(field, "sortable", False)), "dimensions": getattr(field, "vector_search_dimensions", None)}
+        for field in index.fields
+    ]
+    try:
+        metadata = json.loads(index.description) if index.description else {}
+    except ValueError:
+        metadata = {} #a description not written by createIndex
+    return {
+        "name": index.name,
+        "fields": fields,
+        "key_field": next((field["name"] for field in fields if field["key"]), None),
+        "metadata": metadata if isinstance(metadata, dict) else {}
+    }
+
+################
+# Listing Search Indexes 
+############
+def listIndexes():
+    return list(getIndexSchemaCache().schemas())
 
 ###################
 # List the Documents in an Index
 #################
-def listDocuments(index_name):
-    #lists all the documents in an index, given the index name
+LIST_DOCUMENTS_PAGE_SIZE = int(os.getenv("LIST_DOCUMENTS_PAGE_SIZE", "100"))
+LIST_DOCUMENTS_MAX_PAGE_SIZE = 1000 #max number of documents AI Search returns per request
+
+def encodeCursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+def decodeCursor(cursor):
+    #{"after": <last key of the previous page>, "seen": <documents listed so far>} or {"skip": ...}
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if "after" in position:
+            return {"after": str(position["after"]), "seen": int(position["seen"])}
+        return {"skip": int(position["skip"])}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+
+def _odataString(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _isVectorField(field):
+    return field["type"] in [SearchFieldDataType.Collection(vector_type) for vector_type in VECTOR_TYPES.values()]
+
+def listDocuments(index_name, page_size=LIST_DOCUMENTS_PAGE_SIZE, cursor=None, fields=None, include_vectors=False):
+    #Lists one page of the documents in an index, given the index name.
     #chunked documents will be returned as is (as separate docs)
-
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    search_client = SearchClient(endpoint=AZURE_SEARCH_ENDPOINT, index_name=index_name, credential=credential)
+    #Only the requested fields are retrieved. By default every field except the vector fields is returned.
+    #Returns {"documents": [...], "next_cursor": <cursor of the next page or None>, "total_count": ...}
+    #Documents are listed in the order of their key and every page is filtered on the last key of the previous one,
+    #so documents added or deleted while paging do not shift the other documents between pages. Indexes whose key
+    #field is not sortable (created before chunk_id was made sortable) are paged with skip, without that guarantee.
+
+    page_size = max(1, min(int(page_size), LIST_DOCUMENTS_MAX_PAGE_SIZE))
+    schema = getIndexSchemaCache().get(index_name)
+    key_field = schema["key_field"]
+    key_sortable = any(field["name"] == key_field and field["sortable"] for field in schema["fields"])
+    position = decodeCursor(cursor) if cursor else ({"after": None, "seen": 0} if key_sortable else {"skip": 0})
+
+    if not fields:
+        fields = [field["name"] for field in schema["fields"] if include_vectors or not _isVectorField(field)]
+    select = fields if key_field in fields else fields + [key_field]
+
+    arguments = {"search_text": "*", "select": ",".join(select), "top": page_size, "include_total_count": True}
+    if "after" in position:
+        arguments["order_by"] = [f"{key_field} asc"]
+        if position["after"] is not None:
+            arguments["filter"] = f"{key_field} gt {_odataString(position['after'])}"
+    else:
+        arguments["skip"] = position["skip"]
+
+    search_client = Clients.getSearchClient(index_name)
+    pages = search_client.search(**arguments)
 
     results = []
-    pages = search_client.search(
-        search_text="*",
-        include_total_count=True
-    )
-
     for result in pages:
         # result is a dict-like object
         clean_doc = {k: v for k, v in result.items() if not k.startswith("@")}
         results.append(clean_doc)
 
-    return results
+    #with a key filter the count only covers the documents after the cursor
+    listed = position.get("seen", position.get("skip"))
+    total_count = pages.get_count() + (position["seen"] if "after" in position else 0)
+    next_position = {"after": results[-1][key_field], "seen": listed + len(results)} if "after" in position and results else {"skip": listed + len(results)}
+    if key_field not in fields:
+        for result in results:
+            result.pop(key_field, None)
+    return {
+        "documents": results,
+        "next_cursor": encodeCursor(next_position) if results and listed + len(results) < total_count else None,
+        "total_count": total_count
+    }
+
+def listDocumentFiles(index_name, group_field="file_name"):
+    #Groups the chunks of an index by file name: returns [{"file_name": ..., "chunks": <number of chunks>}]
+    #Only the file name of every chunk is retrieved and results are counted while they are streamed.
+
+    search_client = Clients.getSearchClient(index_name)
+    results = search_client.search(search_text="*", select=group_field)
+
+    counts = {}
+    for result in results:
+        name = result.get(group_field)
+        counts[name] = counts.get(name, 0) + 1
+
+    return [{group_field: name, "chunks": count} for name, count in counts.items()]
 
 ###############
 #  Creating an Index  
 ###############
+# Options of a vectorized field ("field_type": "SearchField") in index_fields, all optional:
+#   "dimensions": size of the vectors (defaults to the dimension of the embedding model)
+#   "vector_type": "float32" (default) or "float16", half the memory and storage per vector
+#   "stored": False drops the retrievable copy of the vectors (less storage, but they can no longer be exported)
+#   "algorithm": "hnsw" (default) or "exhaustive"
+#   "metric": "cosine" (default), "euclidean" or "dotProduct"
+#   "m", "ef_construction", "ef_search": HNSW parameters (4-10, 100-1000, 100-1000). Higher values improve recall
+#       at the cost of memory (m), indexing time (ef_construction) and query latency (ef_search)
+#   "compression": "none" (default), "scalar" (int8, 4x smaller) or "binary" (1 bit per dimension, 32x smaller)
+#   "rescore": rescore the compressed results with the original vectors (default True)
+#   "oversampling": how many more compressed candidates are rescored, eg: 4 (service default when omitted)
+#   "preserve_originals": keep the full precision vectors next to the compressed ones (default True, needed to rescore)
+VECTOR_FIELD_OPTIONS = ["dimensions", "vector_type", "stored", "algorithm", "metric", "m", "ef_construction", "ef_search",
+                        "compression", "rescore", "oversampling", "preserve_originals"]
+VECTOR_TYPES = {"float32": SearchFieldDataType.Single, "float16": "Edm.Half"} #SearchFieldDataType has no Half
+VECTOR_METRICS = ["cosine", "euclidean", "dotProduct"]
+VECTOR_COMPRESSIONS = ["none", "scalar", "binary"]
+
+def _checkRange(options, name, low, high):
+    value = options.get(name)
+    if value is not None and not (isinstance(value, int) and not isinstance(value, bool) and low <= value <= high):
+        raise ValueError(f"{name} must be an integer between {low} and {high}")
+    return value
+
+def _checkBoolean(options, name, default):
+    #only JSON booleans: bool("false") would be True
+    value = options.get(name, default)
+    if not isinstance(value, bool):
+        raise ValueError(f"{name} must be true or false")
+    return value
+
+def vectorFieldOptions(options):
+    #validates the vector options of an index_fields entry and returns them with their defaults
+    unknown = set(options) - set(VECTOR_FIELD_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown vector options: {', '.join(sorted(unknown))}")
+
+    checked = {
+        "dimensions": _checkRange(options, "dimensions", 2, 4096),
+        "vector_type": options.get("vector_type", "float32"),
+        "stored": _checkBoolean(options, "stored", True),
+        "algorithm": options.get("algorithm", "hnsw"),
+        "metric": options.get("metric", "cosine"),
+        "m": _checkRange(options, "m", 4, 10),
+        "ef_construction": _checkRange(options, "ef_construction", 100, 1000),
+        "ef_search": _checkRange(options, "ef_search", 100, 1000),
+        "compression": options.get("compression") or "none",
+        "rescore": _checkBoolean(options, "rescore", True),
+        "oversampling": options.get("oversampling"),
+        "preserve_originals": _checkBoolean(options, "preserve_originals", True),
+    }
+    if checked["vector_type"] not in VECTOR_TYPES:
+        raise ValueError(f"vector_type must be one of {', '.join(VECTOR_TYPES)}")
+    if checked["algorithm"] not in ("hnsw", "exhaustive"):
+        raise ValueError("algorithm must be hnsw or exhaustive")
+    if checked["metric"] not in VECTOR_METRICS:
+        raise ValueError(f"metric must be one of {', '.join(VECTOR_METRICS)}")
+    if checked["algorithm"] == "exhaustive" and any(checked[name] is not None for name in ("m", "ef_construction", "ef_search")):
+        raise ValueError("m, ef_construction and ef_search only apply to the hnsw algorithm")
+    if checked["compression"] not in VECTOR_COMPRESSIONS:
+        raise ValueError(f"compression must be one of {', '.join(VECTOR_COMPRESSIONS)}")
+    oversampling = checked["oversampling"]
+    if oversampling is not None and not (isinstance(oversampling, (int, float)) and not isinstance(oversampling, bool) and oversampling >= 1):
+        raise ValueError("oversampling must be a number of at least 1")
+    if checked["rescore"] and not checked["preserve_originals"] and checked["compression"] != "none":
+        raise ValueError("rescoring needs the original vectors: set rescore to false or preserve_originals to true")
+    return checked
+
+def vectorSearchConfiguration(field_name, options):
+    #returns the (algorithm, compression or None, profile) of a vectorized field, options as returned by vectorFieldOptions
+    if options["algorithm"] == "hnsw":
+        algorithm = HnswAlgorithmConfiguration(
+            name=f"{field_name}-hnsw",
+            parameters=HnswParameters(
+                m=options["m"],
+                ef_construction=options["ef_construction"],
+                ef_search=options["ef_search"],
+                metric=options["metric"]
+            )
+        )
+    else:
+        algorithm = ExhaustiveKnnAlgorithmConfiguration(
+            name=f"{field_name}-exhaustive",
+            parameters=ExhaustiveKnnParameters(metric=options["metric"])
+        )
+
+    compression = None
+    if options["compression"] != "none":
+        rescoring = RescoringOptions(
+            enable_rescoring=options["rescore"],
+            default_oversampling=options["oversampling"] if options["rescore"] else None,
+            rescore_storage_method="preserveOriginals" if options["preserve_originals"] else "discardOriginals"
+        )
+        if options["compression"] == "scalar":
+            compression = ScalarQuantizationCompression(
+                compression_name=f"{field_name}-scalar",
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+                rescoring_options=rescoring
+            )
+        else:
+            compression = BinaryQuantizationCompression(
+                compression_name=f"{field_name}-binary",
+                rescoring_options=rescoring
+            )
+
+    profile = VectorSearchProfile(
+        name=f"{field_name}-profile",
+        algorithm_configuration_name=algorithm.name,
+        compression_name=compression.compression_name if compression else None
+    )
+    return algorithm, compression, profile
+
 def createIndex(index_name, index_fields):
     # index_fields = [
     #     {"field_name": <name>, "field_type": <type>, "data_type": <data_type>,
     #        "key": True/False, "filterable": True/False, "sortable": True/False, "vectorized": True/False}
     #     ...
+    #     {"field_name": <name>, "field_type": "SearchField", <vector options, see VECTOR_FIELD_OPTIONS>}
     #     {"field_name": <name>, "field_type": "ComplexField", "sub_fields": [{...}, {...}, ...]}
     # ]
     #
-    #This function is used to create the search index and define its fields
-
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    index_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=credential)
-
-    vector_profile_name = "vector-search-01"
-    vector_config_name = "vector-search-config"
-    vector_algo_config = VectorSearchAlgorithmConfiguration(name=vector_config_name)
-    vector_algo_config.kind = VectorSearchAlgorithmKind.HNSW
-    vector_search = VectorSearch(
-        profiles= [VectorSearchProfile(name=vector_profile_name, algorithm_configuration_name=vector_config_name)],
-        algorithms=[vector_algo_config]
-    )
+    #This function is used to create the search index and define its fields.
+    #Every vectorized field gets its own vector search profile (algorithm and compression)
 
+    index_client = Clients.getSearchIndexClient()
+
+    algorithms, compressions, profiles = [], [], []
+    embedding_dimensions = None
     fields = []
     for field in index_fields:
 
@@ -143,11 +437,23 @@ def createIndex(index_name, index_fields):
 
 
         elif field["field_type"] == "SearchField": #Vectorized field
+            options = vectorFieldOptions({k: v for k, v in field.items() if k not in ("field_name", "field_type", "data_type", "vectorized")})
+            algorithm, compression, profile = vectorSearchConfiguration(field["field_name"], options)
+            algorithms.append(algorithm)
+            profiles.append(profile)
+            if compression is not None:
+                compressions.append(compression)
+
+            if options["dimensions"] is None:
+                embedding_dimensions = getEmbeddingDimension()
             fields.append(SearchField(
                 name = field["field_name"],
-                type = SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                vector_search_dimensions = getEmbeddingDimension(),        
-                vector_search_profile_name = vector_profile_name
+                type = SearchFieldDataType.Collection(VECTOR_TYPES[options["vector_type"]]),
+                searchable = True,
+                stored = options["stored"],
+                hidden = not options["stored"], #a field that is not stored cannot be retrievable
+                vector_search_dimensions = options["dimensions"] or embedding_dimensions,
+                vector_search_profile_name = profile.name
             ))
             
         elif field["field_type"] == "ComplexField":
@@ -169,62 +475,90 @@ def createIndex(index_name, index_fields):
 
             fields.append(ComplexField(name=field["field_name"], fields=sub_fields, collection=True))
 
-    index = SearchIndex(name=index_name, fields=fields, vector_search=vector_search)
-    result = index_client.create_index(index)
+    #the embedding deployment of the vector fields is recorded in the index description (see getEmbeddingDimension)
+    metadata = {"embedding_deployment": AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME, "embedding_dimensions": embedding_dimensions} if embedding_dimensions else None
+    vector_search = VectorSearch(profiles=profiles, algorithms=algorithms, compressions=compressions or None)
+    index = SearchIndex(name=index_name, fields=fields, vector_search=vector_search, description=json.dumps(metadata) if metadata else None)
+    try:
+        result = index_client.create_index(index)
+    finally:
+        getIndexSchemaCache().invalidate()
 
 ###############
 # Divide Text into Chunk
 ###############
-def chunkText(text, chunk_size = 400):
-    #str, int -> list[str]
-
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), chunk_size):
-        chunk = " ".join(words[i:i + chunk_size])
-        chunks.append(chunk)
-    return chunks
+def chunkText(text, chunk_size = Chunker.CHUNK_SIZE_TOKENS, overlap = Chunker.CHUNK_OVERLAP_TOKENS):
+    #str, int, int -> list[str]
+    #chunks of at most chunk_size tokens, snapped to sentence boundaries and overlapping by up to overlap tokens (see Chunker)
+    return Chunker.chunkText(text, chunk_size, overlap)
 
 ################
 # Vectorize String 
 #############
 def vectorizeString(text):
-    openai_client = AzureOpenAI(
-        api_version=AZURE_OPENAI_API_VERSION,
-        azure_endpoint=AZURE_AI_FOUNDRY_ENDPOINT,
-        api_key=AZURE_OPENAI_API_KEY,
-    )
+    openai_client = Clients.getOpenAIClient()
 
     embed_text = openai_client.embeddings.create(
             input=text,
             model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME
         ).data[0].embedding
     
-    openai_client.close()
     return embed_text
 
 ################
-# Add Document to an Index 
-###############
-def addDocuments(index_name, documents, vector_fields=[], chunk_size=400):
-
-    # Uploads documents to a vector search index with vectorization and chunking.
-    # The function only expects an id field to be present in the search index
-    # It also assumes that for every vectorized field there is a non-vectorized field for it. eg: content_vector and content.
-    # Parameters:
-    # - documents: list of dicts with raw document fields
-    # - vector_fields: list of fields to vectorize (e.g., ["content", "summary"])
-    # - chunk_size: number of words per chunk
-
+# Vectorize Strings in Batches
+#############
+EMBEDDING_BATCH_TOKEN_BUDGET = int(os.getenv("EMBEDDING_BATCH_TOKEN_BUDGET", "64000")) #max tokens sent in one embeddings request
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "256")) #max texts sent in one embeddings request
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4")) #embeddings requests running at the same time
+
+def batchTexts(texts, token_budget=EMBEDDING_BATCH_TOKEN_BUDGET, max_inputs=EMBEDDING_BATCH_MAX_INPUTS):
+    #list[str] -> list[list[int]]
+    #groups the positions of texts into consecutive batches that stay within the token budget
+    batches = []
+    current, current_tokens = [], 0
+    for position, text in enumerate(texts):
+        text_tokens = Tokens.countTokens(text)
+        if current and (current_tokens + text_tokens > token_budget or len(current) >= max_inputs):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(position)
+        current_tokens += text_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def vectorizeStrings(texts, token_budget=EMBEDDING_BATCH_TOKEN_BUDGET, max_inputs=EMBEDDING_BATCH_MAX_INPUTS, concurrency=EMBEDDING_CONCURRENCY):
+    #list[str] -> list[list[float]]
+    #Embeds texts with batched embeddings requests, run concurrently. The vectors are returned in the order of texts.
+    openai_client = Clients.getOpenAIClient()
+
+    def embedBatch(positions):
+        response = openai_client.embeddings.create(
+            input=[texts[p] for p in positions],
+            model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME
+        )
+        #the api returns one item per input, item.index being the position within the batch
+        return [(positions[item.index], item.embedding) for item in response.data]
 
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    search_client = SearchClient(endpoint=AZURE_SEARCH_ENDPOINT, index_name=index_name, credential=credential)
+    vectors = [None] * len(texts)
+    batches = batchTexts(texts, token_budget, max_inputs)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for batch_vectors in executor.map(embedBatch, batches):
+            for position, vector in batch_vectors:
+                vectors[position] = vector
 
-    if(len(vector_fields)==0):
-        result = search_client.upload_documents(documents)
-        return
+    Metrics.increment("ingestion.embedding_requests", len(batches))
+    return vectors
 
+################
+# Add Document to an Index 
+###############
+def buildChunks(documents, vector_fields, chunk_size=Chunker.CHUNK_SIZE_TOKENS):
+    #Splits the vectorized fields of documents into chunk documents (without their vectors yet).
+    #Returns (docs_to_upload, chunks_to_vectorize) where chunks_to_vectorize holds (doc_chunk, field) pairs
     docs_to_upload = []
+    chunks_to_vectorize = []
     for doc in documents:
         doc_id = doc.get("id")
 
@@ -240,19 +574,97 @@ def addDocuments(index_name, documents, vector_fields=[], chunk_size=400):
                     "parent_id": doc_id,            
                     "chunk_index": str(i), 
                     "chunk": chunk,
-                    f"{field}_vector": vectorizeString(chunk)
                 }
                 doc_chunk["id"] = f"{doc_id}-{i}"
                 for k, v in doc.items():
                     if k not in vector_fields and k != "id":
                         doc_chunk[k] = v
                 docs_to_upload.append(doc_chunk)
-    
+                chunks_to_vectorize.append((doc_chunk, field))
+
+    return docs_to_upload, chunks_to_vectorize
+
+def embedChunks(chunks_to_vectorize, concurrency=EMBEDDING_CONCURRENCY):
+    #adds the <field>_vector of every chunk built by buildChunks
+    vectors = vectorizeStrings([doc_chunk["chunk"] for doc_chunk, _ in chunks_to_vectorize], concurrency=concurrency)
+    for (doc_chunk, field), vector in zip(chunks_to_vectorize, vectors):
+        doc_chunk[f"{field}_vector"] = vector
+
+def uploadChunks(index_name, docs_to_upload):
+    search_client = Clients.getSearchClient(index_name)
     result = search_client.upload_documents(docs_to_upload)
+    LocalSearch.syncDocuments(index_name, docs_to_upload)
+    AnswerCache.invalidate(index_name) #cached answers may be based on outdated sources
+    return result
+
+def addDocuments(index_name, documents, vector_fields=[], chunk_size=Chunker.CHUNK_SIZE_TOKENS):
+
+    # Uploads documents to a vector search index with vectorization and chunking.
+    # The function only expects an id field to be present in the search index
+    # It also assumes that for every vectorized field there is a non-vectorized field for it. eg: content_vector and content.
+    # Chunks are embedded with batched requests (see vectorizeStrings).
+    # Parameters:
+    # - documents: list of dicts with raw document fields
+    # - vector_fields: list of fields to vectorize (e.g., ["content", "summary"])
+    # - chunk_size: max number of tokens per chunk
+    # Returns the ingestion stats {"chunks": ..., "seconds": ..., "chunks_per_second": ...}
+
+    started_at = time.perf_counter()
+
+    if(len(vector_fields)==0):
+        docs_to_upload = documents
+    else:
+        docs_to_upload, chunks_to_vectorize = buildChunks(documents, vector_fields, chunk_size)
+        embedChunks(chunks_to_vectorize)
+    uploadChunks(index_name, docs_to_upload)
+
+    stats = ingestionStats(len(docs_to_upload), time.perf_counter() - started_at)
+    logging.info("Indexed %s chunks into %s at %s chunks/sec", stats["chunks"], index_name, stats["chunks_per_second"])
+    return stats
+
+def ingestionStats(chunk_count, elapsed):
+    Metrics.increment("ingestion.chunks", chunk_count)
+    Metrics.recordLatency("ingestion.addDocuments", elapsed * 1000)
+    return {
+        "chunks": chunk_count,
+        "seconds": round(elapsed, 3),
+        "chunks_per_second": round(chunk_count / elapsed, 2) if elapsed > 0 else 0.0
+    }
 
 #############
 # Process Document with Doc Intelligence
 ############
+def initializeDocumentAnalysisClient():
+    return DocumentAnalysisClient(endpoint=AZURE_AI_FOUNDRY_ENDPOINT, 
+                                  credential=AzureKeyCredential(AZURE_OPENAI_API_KEY))
+
+def analyzeDocument(client, file_info):
+    #runs the 'prebuilt-read' model on one file and returns one parsed object per page
+    file_url = file_info["url"]
+    file_name = file_info.get("file_name", file_url.split("/")[-1])
+
+    poller = client.begin_analyze_document_from_url(
+        model_id="prebuilt-read",
+        document_url=file_url
+    )
+    result = poller.result()
+    document_id = str(uuid.uuid4())  
+
+    results = []
+    for page_num, page in enumerate(result.pages, start=1):
+        page_text = " ".join([line.content for line in page.lines])
+
+        parsed_result = {
+            "id": f"{document_id}-page{page_num}",  
+            "file_name": file_name,
+            "page_number": page_num,
+            "content": page_text, 
+        }
+
+        results.append(parsed_result)
+
+    return results
+
 def scanDocuments(files):
     """
     Receives a list of dicts containing 'url' and 'file_name',
@@ -266,36 +678,83 @@ def scanDocuments(files):
     ]
     """
 
-    endpoint = AZURE_AI_FOUNDRY_ENDPOINT
-    key = AZURE_OPENAI_API_KEY
-
-    client = DocumentAnalysisClient(endpoint=endpoint, 
-                                    credential=AzureKeyCredential(key))
+    client = initializeDocumentAnalysisClient()
     results = []
     for file_info in files:
-        file_url = file_info["url"]
-        file_name = file_info.get("file_name", file_url.split("/")[-1])
+        results.extend(analyzeDocument(client, file_info))
 
-        poller = client.begin_analyze_document_from_url(
-            model_id="prebuilt-read",
-            document_url=file_url
-        )
-        result = poller.result()
-        document_id = str(uuid.uuid4())  
+    return results
 
-        for page_num, page in enumerate(result.pages, start=1):
-            page_text = " ".join([line.content for line in page.lines])
 
-            parsed_result = {
-                "id": f"{document_id}-page{page_num}",  
-                "file_name": file_name,
-                "page_number": page_num,
-                "content": page_text, 
-            }
+####################
+# Ingestion Pipeline
+##################
+INGESTION_UPLOAD_WORKERS = int(os.getenv("INGESTION_UPLOAD_WORKERS", "4"))
+INGESTION_ANALYZE_WORKERS = int(os.getenv("INGESTION_ANALYZE_WORKERS", "4"))
+INGESTION_CHUNK_WORKERS = int(os.getenv("INGESTION_CHUNK_WORKERS", "2"))
+INGESTION_EMBED_WORKERS = int(os.getenv("INGESTION_EMBED_WORKERS", "2"))
+INGESTION_INDEX_WORKERS = int(os.getenv("INGESTION_INDEX_WORKERS", "2"))
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", "4")) #files waiting between two stages before the previous stage blocks
 
-            results.append(parsed_result)
+_PIPELINE_DONE = object()
 
-    return results
+def runPipeline(jobs, stages, queue_size=INGESTION_QUEUE_SIZE, on_failure=None):
+    """
+    Runs every job through the stages in order. stages is a list of (stage_name, function, workers):
+    each stage has its own worker threads and a bounded input queue, so jobs overlap across stages and a
+    slow stage blocks the ones before it instead of piling up work in memory.
+    A stage function receives the job dict and updates it in place. If it raises, the job leaves the pipeline
+    with job["error"] and job["failed_stage"] set and on_failure(job) is called.
+    Returns the jobs in their original order.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    remaining_workers = [workers for _, _, workers in stages]
+    lock = threading.Lock()
+
+    def worker(stage_position):
+        stage_name, function, _ = stages[stage_position]
+        is_last = stage_position == len(stages) - 1
+        while True:
+            job = queues[stage_position].get()
+            if job is _PIPELINE_DONE:
+                break
+            try:
+                with Metrics.timer(f"ingestion.{stage_name}"), Tracing.span(f"ingestion.{stage_name}", file_name=job.get("file_name")):
+                    function(job)
+            except Exception as e:
+                logging.exception("Ingestion of %s failed at the %s stage", job.get("file_name"), stage_name)
+                job["error"] = str(e)
+                job["failed_stage"] = stage_name
+                if on_failure:
+                    on_failure(job)
+                continue
+            if not is_last:
+                queues[stage_position + 1].put(job)
+
+        #the last worker of a stage tells the next stage that no more jobs are coming
+        with lock:
+            remaining_workers[stage_position] -= 1
+            stage_finished = remaining_workers[stage_position] == 0
+        if stage_finished and not is_last:
+            for _ in range(stages[stage_position + 1][2]):
+                queues[stage_position + 1].put(_PIPELINE_DONE)
+
+    threads = [
+        threading.Thread(target=Tracing.bindContext(worker), args=(stage_position,), daemon=True)
+        for stage_position, (_, _, workers) in enumerate(stages)
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    for job in jobs:
+        queues[0].put(job)
+    for _ in range(stages[0][2]):
+        queues[0].put(_PIPELINE_DONE)
+
+    for thread in threads:
+        thread.join()
+    return jobs
 
 
 ####################
@@ -304,8 +763,16 @@ def scanDocuments(files):
 def addDocumentHelper(index_name, files):
     """
     Receives a dict of uploaded files (werkzeug.datastructures.FileStorage),
-    Returns a list of successfully added file names.
+    Returns one result per file: {"file_name", "status": "added" | "failed", "chunks", "seconds", "error"}.
+    Added files also report "indexing_seconds" and "chunks_per_second" of their chunk -> embed -> index stages.
+    Files go through an upload -> analyze -> chunk -> embed -> index pipeline so several files are processed at once.
+    A blob is always deleted once its file has been analyzed or has failed.
+    Every stage of every file is traced under an ingestion span (see Tracing).
     """
+    with Tracing.span("ingestion", index_name=index_name, files=len(files)):
+        return _addDocuments(index_name, files)
+
+def _addDocuments(index_name, files):
     # Connecting to blob storage
     account_name = AZURE_STORAGE_ACCOUNT_NAME
     storage_account_key = AZURE_STORAGE_ACCOUNT_API_KEY
@@ -318,62 +785,93 @@ def addDocumentHelper(index_name, files):
 
     container_name = AZURE_STORAGE_ACCOUNT_CONTAINER_NAME
     container_client = blob_service_client.get_container_client(container_name)
-
-    uploaded_files = []
-    added_files = [] #files successfully added to the index
-    for file_key in files:
-        file = files[file_key]
-
+    analysis_client = initializeDocumentAnalysisClient()
+
+    def deleteBlob(job):
+        blob_client = job.pop("blob_client", None)
+        if blob_client is None:
+            return
+        try:
+            blob_client.delete_blob(delete_snapshots="include")
+        except Exception:
+            logging.exception("Could not delete the blob of %s", job["file_name"])
+
+    def upload(job):
         # Generate unique file name by appending UUID
+        file = job["file"]
         unique_id = uuid.uuid4().hex
         name, ext = os.path.splitext(file.filename)
         unique_filename = f"{name}_{unique_id}{ext}"
         
         # Uploading file to blob storage
-        blob_client = container_client.get_blob_client(unique_filename)
-        blob_client.upload_blob(file.stream, overwrite=True)
-
-        current_file = {
-            "file_name": file.filename,
-            "url": blob_client.url
-        }
-        uploaded_files.append(current_file)
+        job["blob_client"] = container_client.get_blob_client(unique_filename)
+        job["blob_client"].upload_blob(file.stream, overwrite=True)
 
+    def analyze(job):
         #processing uploaded file with document intelligence
-        processed_file = scanDocuments([current_file])
-        addDocuments(index_name, processed_file, ["content"])
-        blob_client.delete_blob(delete_snapshots="include") #deleting the file after processing
-        added_files.append(file.filename)
+        try:
+            job["documents"] = analyzeDocument(analysis_client, {"file_name": job["file_name"], "url": job["blob_client"].url})
+        finally:
+            deleteBlob(job) #deleting the file after processing
+
+    def chunk(job):
+        job["indexing_started_at"] = time.perf_counter()
+        job["docs_to_upload"], job["chunks_to_vectorize"] = buildChunks(job.pop("documents"), ["content"])
+
+    def embed(job):
+        embedChunks(job.pop("chunks_to_vectorize"))
+
+    def index(job):
+        uploadChunks(index_name, job["docs_to_upload"])
+        #throughput of the chunk -> embed -> index stages of the file, like addDocuments
+        job["ingestion"] = ingestionStats(len(job.pop("docs_to_upload")), time.perf_counter() - job["indexing_started_at"])
+
+    jobs = [
+        {"file_name": files[file_key].filename, "file": files[file_key], "started_at": time.perf_counter()}
+        for file_key in files
+    ]
+    stages = [
+        ("upload", upload, INGESTION_UPLOAD_WORKERS),
+        ("analyze", analyze, INGESTION_ANALYZE_WORKERS),
+        ("chunk", chunk, INGESTION_CHUNK_WORKERS),
+        ("embed", embed, INGESTION_EMBED_WORKERS),
+        ("index", index, INGESTION_INDEX_WORKERS),
+    ]
+    runPipeline(jobs, stages, on_failure=deleteBlob)
+
+    results = []
+    for job in jobs:
+        result = {
+            "file_name": job["file_name"],
+            "status": "failed" if "error" in job else "added",
+            "chunks": job.get("ingestion", {}).get("chunks", 0),
+            "seconds": round(time.perf_counter() - job["started_at"], 3)
+        }
+        if "ingestion" in job:
+            result["indexing_seconds"] = job["ingestion"]["seconds"]
+            result["chunks_per_second"] = job["ingestion"]["chunks_per_second"]
+        if "error" in job:
+            result["error"] = f"{job['failed_stage']}: {job['error']}"
+        results.append(result)
 
-    return added_files
+    return results
 
 
 ####################
 # Find which field is the key field
 ##################
 def getKeyField(index_name):
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    index_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=credential)
-
-    index = index_client.get_index(index_name)
-    for field in index.fields:
-        if getattr(field, "key", False):  
-            return field.name
-
-    raise ValueError(f"No key field found for index {index_name}")
+    key_field = getIndexSchemaCache().get(index_name)["key_field"]
+    if key_field is None:
+        raise ValueError(f"No key field found for index {index_name}")
+    return key_field
 
 #################
 # Get fields info
 ###############
 def getFields(index_name):
     #Returns a list of dics containing info about each field
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    index_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=credential)
-    index = index_client.get_index(index_name)
-    fields = []
-
-    for field in index.fields:
-        fields.append({"name": field.name, "type": field.type})
+    return [{"name": field["name"], "type": field["type"]} for field in getIndexSchemaCache().get(index_name)["fields"]]
 
 ###################
 # Delete a Document in an Index
@@ -382,11 +880,10 @@ def deleteDocument(index_name, file_name):
     """
     deletes all the documents in the index with the same fileName field
     """
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    search_client = SearchClient(endpoint=AZURE_SEARCH_ENDPOINT, index_name=index_name, credential=credential)
+    search_client = Clients.getSearchClient(index_name)
 
     # Search for documents with the given filename
-    results = search_client.search(search_text="", filter=f"file_name eq '{file_name}'")
+    results = search_client.search(search_text="", filter=f"file_name eq {_odataString(file_name)}")
 
     # Collect document keys
     keys_to_delete = []
@@ -395,19 +892,25 @@ def deleteDocument(index_name, file_name):
         keys_to_delete.append({"@search.action": "delete", id_field: doc[id_field]})
 
     if not keys_to_delete:
-        print(f"No documents found with file_name = {file_name}")
+        logging.info("No documents found with file_name = %s in %s", file_name, index_name)
         return
 
     #deleting keys
     search_client.upload_documents(documents=keys_to_delete)
-    print(f"Deleted {len(keys_to_delete)} documents with fileName = {file_name}")
+    LocalSearch.syncDocuments(index_name, keys_to_delete)
+    AnswerCache.invalidate(index_name)
+    logging.info("Deleted %s documents with file_name = %s from %s", len(keys_to_delete), file_name, index_name)
 
 ###############
 # Delete Index
 ##############
 def deleteIndex(index_name):
-    credential = AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    index_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=credential)
-
-    index_client.delete_index(index_name)     
+    index_client = Clients.getSearchIndexClient()
+
+    try:
+        index_client.delete_index(index_name)
+    finally:
+        getIndexSchemaCache().invalidate()
+    LocalSearch.dropIndex(index_name)
+    AnswerCache.invalidate(index_name)     
 
@@ -0,0 +1,146 @@
+#################
+# Opt-in semantic cache of answers (SEMANTIC_CACHE_ENABLED=true).
+# A new question whose embedding is close enough (cosine similarity) to a recently answered one
+# gets the cached answer back without calling the model or the search index.
+# Only questions asked without conversation context are cached (see Chatbot.lookupCachedAnswer), since the
+# answer to a follow-up depends on the turns before it.
+# Entries are scoped by search index and dropped whenever documents of that index are added or deleted. The cache
+# lives in the memory of a Function instance: documents changed through another instance are only picked up when
+# the entries expire, so SEMANTIC_CACHE_TTL_SECONDS bounds how long an answer can be served from outdated sources.
+################
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+import os
+
+import Metrics
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "256"))  # per index
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+
+
+def _unitVector(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+class AnswerCache:
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._indexes = {}  # index_name -> OrderedDict(query -> entry)
+        self._matrices = {}  # index_name -> (queries, entries, matrix of their unit embeddings), rebuilt after a store
+        self._generations = {}  # index_name -> number of invalidations so far
+        self._lock = threading.Lock()
+
+    def generation(self, index_name):
+        #capture this before retrieving sources and pass it to store(), so an answer built
+        #from documents that changed in the meantime is not cached
+        with self._lock:
+            return self._generations.get(index_name, 0)
+
+    def _snapshot(self, index_name):
+        #(queries, entries, matrix) of the index. The lock is only held to copy the entry references,
+        #the matrix is stacked and scanned outside of it
+        with self._lock:
+            snapshot = self._matrices.get(index_name)
+            if snapshot is not None:
+                return snapshot
+            entries = self._indexes.get(index_name)
+            if not entries:
+                return None
+            queries, values = list(entries.keys()), list(entries.values())
+
+        snapshot = (queries, values, np.stack([entry["embedding"] for entry in values]))
+        with self._lock:
+            #only kept if no entry was stored or dropped in the meantime
+            current = self._indexes.get(index_name)
+            if current is not None and len(current) == len(values) and all(current.get(query) is entry for query, entry in zip(queries, values)):
+                self._matrices[index_name] = snapshot
+        return snapshot
+
+    def lookup(self, index_name, embedding):
+        #returns the most similar cached entry {"query", "sources", "answer", "similarity"} above the threshold, or None
+        vector = _unitVector(embedding)
+        snapshot = self._snapshot(index_name) if vector is not None else None
+        if snapshot is None:
+            if vector is not None:
+                Metrics.increment("answerCache.misses")
+            return None
+
+        queries, entries, matrix = snapshot
+        similarities = matrix @ vector
+        expired = np.fromiter((entry["created_at"] for entry in entries), dtype=np.float64, count=len(entries)) < time.time() - self.ttl_seconds
+        similarities[expired] = -1.0
+        best = int(np.argmax(similarities))
+        best_similarity = float(similarities[best])
+
+        with self._lock:
+            if expired.any():
+                self._dropEntries(index_name, [(query, entry) for query, entry, is_expired in zip(queries, entries, expired) if is_expired])
+            current = self._indexes.get(index_name)
+            if best_similarity < self.threshold or current is None or current.get(queries[best]) is not entries[best]:
+                Metrics.increment("answerCache.misses")
+                return None
+            current.move_to_end(queries[best])
+
+        Metrics.increment("answerCache.hits")
+        entry = entries[best]
+        return {
+            "query": queries[best],
+            "sources": entry["sources"],
+            "answer": entry["answer"],
+            "similarity": best_similarity
+        }
+
+    def _dropEntries(self, index_name, expired_entries):
+        #called with the lock held, skips entries that were replaced since the snapshot
+        entries = self._indexes.get(index_name)
+        if entries is None:
+            return
+        for query, entry in expired_entries:
+            if entries.get(query) is entry:
+                del entries[query]
+                self._matrices.pop(index_name, None)
+
+    def store(self, index_name, query, embedding, sources, answer, generation):
+        vector = _unitVector(embedding)
+        if vector is None or not answer:
+            return
+
+        with self._lock:
+            if self._generations.get(index_name, 0) != generation:
+                return  #the knowledge base changed while the answer was being generated
+            entries = self._indexes.setdefault(index_name, OrderedDict())
+            entries[query] = {
+                "embedding": vector,
+                "sources": sources,
+                "answer": answer,
+                "created_at": time.time()
+            }
+            entries.move_to_end(query)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._matrices.pop(index_name, None)
+
+    def invalidate(self, index_name):
+        with self._lock:
+            self._indexes.pop(index_name, None)
+            self._matrices.pop(index_name, None)
+            self._generations[index_name] = self._generations.get(index_name, 0) + 1
+        Metrics.increment("answerCache.invalidations")
+
+
+_cache = AnswerCache()
+
+def getCache():
+    return _cache
+
+def invalidate(index_name):
+    #called by AISearch whenever the documents of an index change
+    _cache.invalidate(index_name)
@@ -0,0 +1,267 @@
+#################
+# asyncio implementation of the chat path (sendMessageHelper -> sendMessage -> hybridSearch).
+# It uses the async OpenAI, Search and Cosmos clients so one Function worker can serve many conversations
+# at once while they wait on the model, the search index or the database.
+# Prompts, tools, context building and result formatting are shared with the synchronous Chatbot module.
+################
+import asyncio
+import logging
+import json
+
+import AsyncDatabase
+import AnswerCache
+import EmbeddingCache
+import Chatbot
+import Clients
+import LocalSearch
+import Metrics
+import Tracing
+
+from Chatbot import (
+    AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
+    AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME,
+    AZURE_SEARCH_INDEX_NAME,
+    MAX_TOKENS,
+    SEARCH_NEIGHBOUR_WINDOW,
+    SEARCH_SELECT_FIELDS,
+    SUMMARY_PROMPT,
+    TOOL_CALL_MAX_WORKERS,
+    TOOL_CALL_TIMEOUT_SECONDS,
+    TOOL_MAX_ROUNDS,
+)
+
+
+####################
+## Client Initialization
+####################
+def initializeClients():
+    #pooled async clients of the running event loop. They must not be closed by the caller
+    search_client = LocalSearch.getAsyncIndex() if LocalSearch.isEnabled() else Clients.getAsyncSearchClient()
+    return Clients.getAsyncOpenAIClient(), search_client
+
+####################
+## Conversation Context
+####################
+async def loadContext(user_id, session_id):
+    #see Chatbot.loadContext
+    with Tracing.span("db.loadContext") as current:
+        checkpoint = await AsyncDatabase.getSummaryCheckpoint(user_id, session_id)
+        history = await AsyncDatabase.getMessagesAfter(user_id, session_id, *Chatbot.checkpointPosition(checkpoint))
+        current.setAttribute("messages", len(history))
+    return Chatbot.buildContext(checkpoint, history), history
+
+async def ensureTokenLimit(openai_client, user_id, session_id, messages, history=None):
+    #see Chatbot.ensureTokenLimit
+    if not Chatbot.needsSummary(messages, history):
+        return messages
+
+    keep, covered_messages, tail_messages = Chatbot.splitForSummary(messages, history)
+
+    with Tracing.span("llm.summarize", messages=len(covered_messages)):
+        response = await openai_client.chat.completions.create(
+            stream=False,
+            messages=covered_messages + [{"role": "user", "content": SUMMARY_PROMPT}],
+            max_tokens=MAX_TOKENS,
+            temperature=0.75,
+            model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME
+        )
+    full_reply = response.choices[0].message.content
+    summary_message = Chatbot.summaryMessage(full_reply)
+
+    if history:
+        last_covered = history[-keep - 1]
+        await AsyncDatabase.saveSummaryCheckpoint(
+            user_id, session_id,
+            summary=full_reply,
+            last_message_id=last_covered["id"],
+            last_message_sent_at=last_covered["sentAt"],
+            token_count=Chatbot.num_tokens_from_messages([summary_message]),
+            last_message_seq=last_covered.get("seq")
+        )
+
+    return [messages[0], summary_message] + tail_messages
+
+####################
+## Hybrid Search
+####################
+async def expandNeighbours(search_client, hits, window=SEARCH_NEIGHBOUR_WINDOW):
+    #see Chatbot.expandNeighbours
+    if window <= 0 or not hits:
+        return list({doc["id"]: doc for doc in hits}.values())
+
+    neighbor_filter, top = Chatbot.neighbourQuery(hits, window)
+    with Metrics.timer("hybridSearch.expansion"), Tracing.span("search.expand", hits=len(hits)):
+        neighbors = await search_client.search(
+            search_text="*",
+            filter=neighbor_filter,
+            select=SEARCH_SELECT_FIELDS,
+            top=top
+        )
+        chunks_by_parent = {}
+        async for n in neighbors:
+            chunks_by_parent.setdefault(n["parent_id"], {})[int(n["chunk_index"])] = n
+    Metrics.increment("hybridSearch.expansion_queries")
+
+    return Chatbot.mergeNeighbours(hits, chunks_by_parent, window)
+
+async def hybridSearch(query, window=SEARCH_NEIGHBOUR_WINDOW):
+    #see Chatbot.hybridSearch
+    openai_client, search_client = initializeClients()
+    with Tracing.span("search.embed"):
+        embed_query = await EmbeddingCache.embedQueryAsync(openai_client, query, AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME)
+
+    with Metrics.timer("hybridSearch.search"), Tracing.span("search.query", exhaustive=Chatbot.SEARCH_EXHAUSTIVE, k=Chatbot.SEARCH_VECTOR_K):
+        results = await search_client.search(**Chatbot.searchArguments(query, embed_query))
+        search_results = [doc async for doc in results]
+
+    expanded_results = await expandNeighbours(search_client, search_results, window)
+    return Chatbot.formatSources(expanded_results)
+
+####################
+## Tools
+####################
+async def executeToolCall(tool_call_id, function_name, arguments):
+    #see Chatbot.executeToolCall
+    function_args = json.loads(arguments)
+
+    with Tracing.span(f"tool.{function_name}"):
+        if function_name == "hybridSearch":
+            function_response = await hybridSearch(
+                query=function_args.get("query")
+            )
+        else:
+            function_response = json.dumps({"error": "Unknown function"})
+
+    return Chatbot.toolMessage(tool_call_id, function_name, function_response)
+
+async def executeToolCalls(tool_calls, max_workers=TOOL_CALL_MAX_WORKERS, timeout=TOOL_CALL_TIMEOUT_SECONDS):
+    #see Chatbot.executeToolCalls
+    if not tool_calls:
+        return []
+
+    Metrics.increment("tools.calls", len(tool_calls))
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def run(tool_call_id, function_name, arguments):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(executeToolCall(tool_call_id, function_name, arguments), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Tool call %s (%s) timed out after %ss", tool_call_id, function_name, timeout)
+                Metrics.increment("tools.timeouts")
+                return Chatbot.toolErrorMessage(tool_call_id, function_name, f"The tool call timed out after {timeout} seconds")
+            except Exception as e:
+                logging.exception("Tool call %s (%s) failed", tool_call_id, function_name)
+                Metrics.increment("tools.errors")
+                return Chatbot.toolErrorMessage(tool_call_id, function_name, str(e))
+
+    with Metrics.timer("tools.batch"):
+        #gather keeps the order of tool_calls
+        return await asyncio.gather(*(run(*tool_call) for tool_call in tool_calls))
+
+####################
+## Tool Routing
+####################
+async def completeWithTools(openai_client, messages, max_rounds=TOOL_MAX_ROUNDS):
+    #see Chatbot.completeWithTools
+    tool_messages = []
+    round_trips = tool_rounds = 0
+    while True:
+        with Tracing.span("llm.completion", round=round_trips + 1):
+            response = await openai_client.chat.completions.create(
+                stream=False,
+                messages=messages,
+                max_tokens=MAX_TOKENS,
+                model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
+                **Chatbot.completionOptions(tool_rounds < max_rounds)
+            )
+        round_trips += 1
+
+        response_message = response.choices[0].message
+        if not response_message.tool_calls:
+            Chatbot.recordTurn(round_trips, tool_rounds)
+            return response_message.content, tool_messages
+
+        messages.append(response_message)
+        with Tracing.span("tools.execute", calls=len(response_message.tool_calls)):
+            round_messages = await executeToolCalls([
+                (tool_call.id, tool_call.function.name, tool_call.function.arguments)
+                for tool_call in response_message.tool_calls
+            ])
+        tool_messages.extend(round_messages)
+        messages.extend(round_messages)
+        tool_rounds += 1
+
+####################
+## Semantic Answer Cache
+####################
+async def lookupCachedAnswer(openai_client, messages):
+    #see Chatbot.lookupCachedAnswer
+    query = messages[-1]['content']
+    if not AnswerCache.SEMANTIC_CACHE_ENABLED or not query or Chatbot.hasConversationContext(messages):
+        return None, None, None
+
+    with Tracing.span("cache.lookup") as current:
+        cache = AnswerCache.getCache()
+        generation = cache.generation(AZURE_SEARCH_INDEX_NAME)
+        query_embedding = await EmbeddingCache.embedQueryAsync(openai_client, query, AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME)
+        entry = cache.lookup(AZURE_SEARCH_INDEX_NAME, query_embedding)
+        current.setAttribute("hit", entry is not None)
+    return entry, query_embedding, generation
+
+####################
+## Send Message
+####################
+async def sendMessage(user_id, openai_client, session_id, messages, history=None):
+    #see Chatbot.sendMessage
+
+    query = messages[-1]['content']
+    latest_message = messages[-1]
+
+    #semantic answer cache: a near-duplicate of a recent question skips straight to the answer
+    cached_answer, query_embedding, cache_generation = await lookupCachedAnswer(openai_client, messages)
+    if cached_answer is not None:
+        full_reply = cached_answer["answer"]
+        tool_messages = []
+    else:
+        #applying sliding window + summarization to ensure the context window is met
+        messages.pop() #removing the query before in case messages needs to be summarized
+        messages = await ensureTokenLimit(openai_client, user_id, session_id, messages, history)
+        messages.append(latest_message)
+
+        full_reply, tool_messages = await completeWithTools(openai_client, messages)
+
+    with Tracing.span("db.saveMessages"):
+        await AsyncDatabase.addMessages(user_id, session_id, [(latest_message['role'], query), ("assistant", full_reply)])
+    Chatbot.storeCachedAnswer(query, query_embedding, cache_generation, tool_messages, full_reply)
+
+    messages.append({
+        "role": "assistant",
+        "content": full_reply
+    })
+
+    return messages
+
+####################
+## Send Message Helper
+####################
+async def sendMessageHelper(user_id, session_id, query):
+    #asyncio counterpart of Chatbot.sendMessageHelper, returns the reply
+    with Tracing.span("chat.turn", session_id=session_id):
+        openai_client, _ = initializeClients()
+        messages, history = await loadContext(user_id=user_id, session_id=session_id)
+
+        messages.append({
+            "role": "user",
+            "content": query
+        })
+
+        updated_messages = await sendMessage(
+            user_id=user_id,
+            openai_client=openai_client,
+            session_id=session_id,
+            messages=messages,
+            history=history,
+        )
+
+    return updated_messages[-1]["content"]
@@ -0,0 +1,203 @@
+#################
+# asyncio variants of the Database functions used on the chat path, built on the azure.cosmos.aio client.
+# Documents and queries are built by the same helpers as Database, so both APIs read and write the same data.
+################
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosBatchOperationError
+from azure.core.pipeline.transport import AioHttpTransport
+import aiohttp
+import asyncio
+import weakref
+
+import Database
+import Clients
+import Metrics
+import CosmosMetrics
+
+##################
+## Container Provider
+###############
+
+class AsyncContainerProvider:
+    """
+    asyncio counterpart of Database.ContainerProvider. The client and its aiohttp session are bound to the event loop
+    that creates them, so there is one per running loop: it is pooled by Clients.getAsyncClient on first use and
+    closed with the other async clients of the loop by Clients.closeAsyncClients (or when the worker exits).
+    """
+    def __init__(self, uri=None, key=None, database_name=None, container_name=None,
+                 max_connections=None, preferred_regions=None):
+        self.uri = uri or Database.COSMO_DB_URI
+        self.key = key or Database.COSMO_DB_PRIMARY_KEY
+        self.database_name = database_name or Database.COSMO_DB_NAME
+        self.container_name = container_name or Database.COSMO_DB_CONVERSATIONS_CONTAINER_NAME
+        self.max_connections = max_connections or Database.COSMO_DB_MAX_CONNECTIONS
+        self.preferred_regions = preferred_regions if preferred_regions is not None else Database.COSMO_DB_PREFERRED_REGIONS
+        self._name = ("cosmos", id(self))  # key of the clients of this provider in the Clients pool
+        self._containers = weakref.WeakKeyDictionary()  # pooled client -> its container handle
+
+    def _createClient(self):
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return CosmosClient(
+            self.uri,
+            credential=self.key,
+            preferred_locations=self.preferred_regions or None,
+            transport=AioHttpTransport(session=session, session_owner=True),
+            **Database.throttleRetryOptions() #addMessages and the other writes retry 429s like Database
+        )
+
+    async def getContainer(self):
+        client = Clients.getAsyncClient(self._name, self._createClient)
+        container = self._containers.get(client)
+        if container is None:
+            container = client.get_database_client(self.database_name).get_container_client(self.container_name)
+            self._containers[client] = container
+        return container
+
+    async def close(self):
+        #closes the client of the current event loop
+        await Clients.closeAsyncClient(self._name)
+
+
+_container_provider = AsyncContainerProvider()
+
+def setContainerProvider(provider):
+    # Any object with an async getContainer() works, eg: a wrapper around LocalContainer.InMemoryContainer
+    global _container_provider
+    previous = _container_provider
+    _container_provider = provider
+    Database.getUserCache().clear()
+    return previous
+
+_instrumented_containers = {}  # label -> AsyncInstrumentedContainer
+
+async def initializeContainer(label):
+    #see Database.initializeContainer
+    container = await _container_provider.getContainer()
+    instrumented = _instrumented_containers.get(label)
+    if instrumented is None or instrumented.container is not container:
+        instrumented = _instrumented_containers[label] = CosmosMetrics.AsyncInstrumentedContainer(container, label)
+    return instrumented
+
+async def _queryAll(container, query, parameters, partition_key):
+    return [item async for item in container.query_items(
+        query=query,
+        parameters=parameters,
+        partition_key=partition_key
+    )]
+
+##################
+## User Functions
+###############
+
+async def getUserProfile(user_id):
+    #see Database.getUserProfile, both share the same user cache
+    user_cache = Database.getUserCache()
+    hit, profile = user_cache.get(user_id)
+    if hit:
+        return profile
+
+    container = await initializeContainer("getUserProfile")
+    try:
+        item = await container.read_item(item=user_id, partition_key=user_id)
+    except CosmosResourceNotFoundError:
+        item = None
+    profile = Database.userProfile(item)
+    user_cache.put(user_id, profile, Database.lastRequestCharge(container))
+    return profile
+
+async def userIsValid(user_id):
+    return await getUserProfile(user_id) is not None
+
+##################
+## Chatbot Functions
+################
+
+async def addMessages(user_id, session_id, messages, write_behind=None):
+    #see Database.addMessages. Write-behind batches go to the same MessageWriter as the synchronous API
+    if not await userIsValid(user_id):
+        raise ValueError("This user does not exist")
+    if write_behind is None:
+        write_behind = Database.MESSAGE_WRITE_BEHIND
+
+    documents = Database.buildMessages(user_id, session_id, messages)
+    if write_behind:
+        Database.getMessageWriter().submit(user_id, session_id, documents)
+        return documents
+
+    await writeMessages(await initializeContainer("addMessages"), user_id, documents)
+    return documents
+
+async def readSequence(container, user_id, session_id):
+    #see Database.readSequence
+    session = await container.read_item(item=session_id, partition_key=user_id)
+    if session.get("lastSeq") is not None:
+        return session["lastSeq"], True
+    query, parameters = Database.messagesQuery(session_id)
+    return Database.storedSequence(session, await _queryAll(container, query, parameters, user_id)), False
+
+async def writeMessages(container, user_id, documents):
+    #see Database.writeMessages
+    pending = [document for document in documents if document.get("seq") is None]
+    for i in range(0, len(pending), Database.COSMO_DB_BATCH_SIZE - 1):
+        batch = pending[i:i + Database.COSMO_DB_BATCH_SIZE - 1]
+        session_id = batch[0]["sessionId"]
+        for attempt in range(Database.SESSION_SEQUENCE_RETRIES + 1):
+            last_seq, counted = Database.cachedSequence(session_id), True
+            if last_seq is None:
+                last_seq, counted = await readSequence(container, user_id, session_id)
+            operations, numbered = Database.messageBatch(session_id, last_seq, batch, counted)
+            try:
+                await container.execute_item_batch(batch_operations=operations, partition_key=user_id)
+                break
+            except CosmosBatchOperationError as error:
+                Database.forgetSequence(session_id)
+                if not Database.isSequenceConflict(error) or attempt == Database.SESSION_SEQUENCE_RETRIES:
+                    raise
+                Metrics.increment("cosmos.sequence_conflicts")
+        Database.rememberSequence(session_id, numbered[-1]["seq"])
+        for document, stored in zip(batch, numbered):
+            document["seq"] = stored["seq"]
+    Metrics.increment("cosmos.message_batches")
+
+async def addMessage(user_id, session_id, role, content):
+    await addMessages(user_id, session_id, [(role, content)], write_behind=False)
+
+async def _waitForPendingWrites(session_id):
+    #waits for the write-behind batches of the session without blocking the event loop
+    writer = Database.getMessageWriter()
+    if session_id in writer.pendingSessions():
+        await asyncio.to_thread(writer.waitForSession, session_id)
+
+async def getMessages(user_id, session_id):
+    #see Database.getMessages
+    if not await userIsValid(user_id):
+        raise ValueError("This user does not exist")
+
+    await _waitForPendingWrites(session_id)
+    query, parameters = Database.messagesQuery(session_id)
+    container = await initializeContainer("getMessages")
+    messages = await _queryAll(container, query, parameters, user_id)
+    return [{"role": message["role"], "content": message["content"]} for message in Database.orderMessages(messages)]
+
+async def getMessagesAfter(user_id, session_id, after_seq=None, after_sent_at=None):
+    #see Database.getMessagesAfter
+    if not await userIsValid(user_id):
+        raise ValueError("This user does not exist")
+
+    await _waitForPendingWrites(session_id)
+    query, parameters = Database.messagesAfterQuery(session_id, after_seq, after_sent_at)
+    container = await initializeContainer("getMessagesAfter")
+    return Database.orderMessages(await _queryAll(container, query, parameters, user_id))
+
+async def getSummaryCheckpoint(user_id, session_id):
+    container = await initializeContainer("getSummaryCheckpoint")
+    try:
+        return await container.read_item(item=Database.summaryId(session_id), partition_key=user_id)
+    except CosmosResourceNotFoundError:
+        return None
+
+async def saveSummaryCheckpoint(user_id, session_id, summary, last_message_id, last_message_sent_at, token_count, last_message_seq=None):
+    checkpoint = Database.buildSummaryCheckpoint(user_id, session_id, summary, last_message_id, last_message_sent_at, token_count, last_message_seq)
+    container = await initializeContainer("saveSummaryCheckpoint")
+    await container.upsert_item(body=checkpoint)
+    return checkpoint
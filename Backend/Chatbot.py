@@ -1,16 +1,21 @@
-import azure.identity
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.models import VectorizedQuery
 import azure.cognitiveservices.speech as speechsdk
 
-from openai import AzureOpenAI
-import tiktoken
+import logging
 import json
+import time
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 import Database
+import Clients
+import Tokens
+import Metrics
+import Tracing
+import EmbeddingCache
+import AnswerCache
+import LocalSearch
 
 # Retrieve environment variables
 # global AZURE_FOUNDRY_ENDPOINT, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY, AZURE_OPENAI_MODEL_NAME, AZURE_OPENAI_CHAT_DEPLOYMENT_NAME, AZURE_OPENAI_API_VERSION
@@ -64,17 +69,10 @@ Remember: Stay professional, helpful, and upbeat — like a real car salesman wh
 ## Client Initialization
 ####################
 def initializeClients(): 
-    openai_client = AzureOpenAI(
-        api_version=AZURE_OPENAI_API_VERSION,
-        azure_endpoint=AZURE_AI_FOUNDRY_ENDPOINT,
-        api_key=AZURE_OPENAI_API_KEY,
-    )
-
-    search_client = SearchClient(
-        endpoint=AZURE_SEARCH_ENDPOINT,
-        index_name=AZURE_SEARCH_INDEX_NAME,
-        credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
-    )
+    #returns the process-wide pooled clients. They must not be closed by the caller
+    #with SEARCH_BACKEND=local the search client is the in-process LocalSearch index
+    openai_client = Clients.getOpenAIClient()
+    search_client = LocalSearch.getIndex() if LocalSearch.isEnabled() else Clients.getSearchClient()
 
     return openai_client, search_client
 
@@ -82,59 +80,107 @@ def initializeClients():
 ## Token Counter
 ####################
 def num_tokens_from_messages(messages):
-    encoding = tiktoken.encoding_for_model(AZURE_OPENAI_MODEL_NAME)
-    num_tokens = 0
-    for message in messages:
-        num_tokens += 4  # every message overhead
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-    num_tokens += 2  # every reply overhead
-    return num_tokens
+    #messages may mix dicts and the message objects returned by the openai client
+    return Tokens.num_tokens_from_messages(messages)
+
+def countContextTokens(messages, history=None):
+    #Token count of the context window. The messages backed by a stored document (history) use the
+    #token count saved when they were written, so only the prefix (system prompt/summary) is encoded.
+    if not history:
+        return num_tokens_from_messages(messages)
+
+    prefix = messages[:len(messages) - len(history)]
+    return Tokens.storedTokens(history) + num_tokens_from_messages(prefix)
+
+####################
+## Conversation Context
+####################
+def loadContext(user_id, session_id):
+    #Builds the context window of a session from its summary checkpoint (if any) and the messages after it.
+    #Returns (messages, history) where messages are plain role/content dicts for the model and history
+    #holds the stored documents of the messages after the checkpoint, in the same order.
+
+    with Tracing.span("db.loadContext") as current:
+        checkpoint = Database.getSummaryCheckpoint(user_id, session_id)
+        history = Database.getMessagesAfter(user_id, session_id, *checkpointPosition(checkpoint))
+        current.setAttribute("messages", len(history))
+    return buildContext(checkpoint, history), history
+
+def checkpointPosition(checkpoint):
+    #(after_seq, after_sent_at) of the first message not covered by the checkpoint, see Database.getMessagesAfter
+    if not checkpoint:
+        return None, None
+    return checkpoint.get("lastSeq"), checkpoint.get("lastSentAt")
+
+def buildContext(checkpoint, history):
+    #system prompt + checkpoint summary (when the session was summarized) + the messages in history
+    messages = []
+    if checkpoint:
+        messages.append({"role": "system", "content": DEFAULT_CHATBOT_PROMPT})
+        messages.append(summaryMessage(checkpoint["summary"]))
+
+    messages.extend({"role": doc["role"], "content": doc["content"]} for doc in history)
+    return messages
+
+def summaryMessage(summary):
+    return {
+        "role": "system",
+        "content": f"Summary of the conversation so far:\n{summary}"
+    }
 
 ####################
 ## Ensuring Token Limit
 ####################
-def ensureTokenLimit(openai_client, search_client, user_id, session_id, messages):
+SUMMARY_TAIL_MESSAGES = 6 #number of most recent messages kept verbatim after a summary checkpoint
+SUMMARY_PROMPT = "Summarize the conversation so far in a concise manner, retaining important details and context. " \
+    "The summary should be brief and to the point, capturing the essence of the discussion without unnecessary elaboration. " \
+    "The summary will be used to maintain context in future interactions, so ensure it is clear and informative."
+
+def needsSummary(messages, history=None):
+    return countContextTokens(messages, history) >= MAX_TOKENS* 0.8 and len(messages)>2
+
+def splitForSummary(messages, history=None):
+    #Returns (keep, covered_messages, tail_messages).
+    #the last messages stay verbatim as long as the history behind them is known
+    keep = SUMMARY_TAIL_MESSAGES if history and len(history) > SUMMARY_TAIL_MESSAGES else 0
+    covered_messages = messages[:-keep] if keep else messages
+    tail_messages = messages[-keep:] if keep else []
+    return keep, covered_messages, tail_messages
+
+def ensureTokenLimit(openai_client, search_client, user_id, session_id, messages, history=None):
     #This function checks if the token limit is almost reached and if so performs a combination of sliding window and summarization
-    #If the limit is almost reached, it summarizes the conversation and creates a new messages list
-    #It returns the new/old messages list. If summarized, the message list is only returned with 
-    # the summary not the summarization prompt
+    #If the limit is almost reached, it summarizes everything except the last few messages and creates a new messages list
+    #(system prompt + summary + last messages).
+    #When the stored history behind messages is given, the summary is saved as a checkpoint in the database so
+    # the following turns start from it instead of re-summarizing the whole conversation again.
     
-    if num_tokens_from_messages(messages) >= MAX_TOKENS* 0.8 and len(messages)>2:
-
-        summary_prompt = "Summarize the conversation so far in a concise manner, retaining important details and context. " \
-        "The summary should be brief and to the point, capturing the essence of the discussion without unnecessary elaboration. " \
-        "The summary will be used to maintain context in future interactions, so ensure it is clear and informative."
+    if needsSummary(messages, history):
 
-        messages.append({
-            "role": "user",
-            "content": summary_prompt
-        })
+        keep, covered_messages, tail_messages = splitForSummary(messages, history)
 
-        response = openai_client.chat.completions.create(
-            stream=False,
-            messages=messages,
-            max_tokens=MAX_TOKENS,
-            temperature=0.75,
-            model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME
-        )
+        with Tracing.span("llm.summarize", messages=len(covered_messages)):
+            response = openai_client.chat.completions.create(
+                stream=False,
+                messages=covered_messages + [{"role": "user", "content": SUMMARY_PROMPT}],
+                max_tokens=MAX_TOKENS,
+                temperature=0.75,
+                model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME
+            )
         full_reply = response.choices[0].message.content
-        messages.pop() #removing the summary prompt
-        messages.append({
-            "role": "assistant",
-            "content": full_reply
-        }) 
-
-
-        #last 5 messages + summary will be kept in history. 
-        #The rest of the messages will be displayed but not stored within the context window
-        if(len(messages) > 10):
-            summary_messages = messages[:2] + messages[-7:] 
-
-        else:
-            summary_messages = messages[:2] + messages[-2:] #only keep the summary and the system prompt 
+        summary_message = summaryMessage(full_reply)
+
+        if history:
+            last_covered = history[-keep - 1]
+            Database.saveSummaryCheckpoint(
+                user_id, session_id,
+                summary=full_reply,
+                last_message_id=last_covered["id"],
+                last_message_sent_at=last_covered["sentAt"],
+                token_count=num_tokens_from_messages([summary_message]),
+                last_message_seq=last_covered.get("seq")
+            )
 
-        return summary_messages
+        return [messages[0], summary_message] + tail_messages
     
     else:
         return messages
@@ -142,58 +188,106 @@ def ensureTokenLimit(openai_client, search_client, user_id, session_id, messages
 ####################
 ## Hybrid Search
 ####################
-def hybridSearch(query):
+SEARCH_SELECT_FIELDS = "id, chunk, file_name, page_number, chunk_index, parent_id"
+SEARCH_NEIGHBOUR_WINDOW = int(os.getenv("SEARCH_NEIGHBOUR_WINDOW", "1")) #how many neighbouring chunks do we take from each direction
+SEARCH_TOP = int(os.getenv("SEARCH_TOP", "5")) #number of hits returned by a hybrid search (before expansion)
+SEARCH_VECTOR_K = int(os.getenv("SEARCH_VECTOR_K", "5")) #nearest neighbours of the vector query fused with the keyword results
+SEARCH_EXHAUSTIVE = os.getenv("SEARCH_EXHAUSTIVE", "true").lower() == "true" #true: brute-force scan of every vector, false: HNSW graph
+SEARCH_OVERSAMPLING = float(os.getenv("SEARCH_OVERSAMPLING")) if os.getenv("SEARCH_OVERSAMPLING") else None #only for compressed vector fields
+
+def _odataString(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def expandNeighbours(search_client, hits, window=SEARCH_NEIGHBOUR_WINDOW):
+    #Contextual expansion: fetches the chunks around every hit with a single OR-combined filter query.
+    #Returns the hits and their neighbours without duplicates, in rank order (each hit followed by its neighbours by chunk_index)
+
+    if window <= 0 or not hits:
+        return list({doc["id"]: doc for doc in hits}.values())
+
+    neighbor_filter, top = neighbourQuery(hits, window)
+    with Metrics.timer("hybridSearch.expansion"), Tracing.span("search.expand", hits=len(hits)):
+        neighbors = search_client.search(
+            search_text="*",
+            filter=neighbor_filter,
+            select=SEARCH_SELECT_FIELDS,
+            top=top
+        )
+        chunks_by_parent = {}
+        for n in neighbors:
+            chunks_by_parent.setdefault(n["parent_id"], {})[int(n["chunk_index"])] = n
+    Metrics.increment("hybridSearch.expansion_queries")
+
+    return mergeNeighbours(hits, chunks_by_parent, window)
+
+def neighbourQuery(hits, window):
+    #returns the OR-combined filter matching every chunk within window of a hit, and the max number of matches
+    windows = dict.fromkeys((doc["parent_id"], int(doc["chunk_index"])) for doc in hits)
+    neighbor_filter = " or ".join(
+        f"(parent_id eq {_odataString(parent_id)} and chunk_index ge {chunk_index - window} and chunk_index le {chunk_index + window})"
+        for parent_id, chunk_index in windows
+    )
+    return neighbor_filter, len(windows) * (2 * window + 1)
+
+def mergeNeighbours(hits, chunks_by_parent, window):
+    #chunks_by_parent = {parent_id: {chunk_index: chunk}}
+    expanded_results = []
+    ids_in_expanded_results = set()
+    for doc in hits:
+        parent_chunks = chunks_by_parent.get(doc["parent_id"], {})
+        chunk_index = int(doc["chunk_index"])
+        neighbours = [parent_chunks[i] for i in range(chunk_index - window, chunk_index + window + 1)
+                      if i != chunk_index and i in parent_chunks]
+
+        for chunk in [doc] + neighbours:
+            if chunk["id"] not in ids_in_expanded_results:
+                expanded_results.append(chunk)
+                ids_in_expanded_results.add(chunk["id"])
+
+    return expanded_results
+
+def hybridSearch(query, window=SEARCH_NEIGHBOUR_WINDOW):
     #This function is used to perform a hybrid search on the search index with context expansion
+    #window is the number of neighbouring chunks added on each side of every hit
     #It returns the search results
 
     #embedding the query
     openai_client, search_client = initializeClients()
-    embed_query = openai_client.embeddings.create(
-        input=query,
-        model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME
-    ).data[0].embedding
-
-    vector_query = VectorizedQuery(
-            vector=embed_query,
-            k_nearest_neighbors=5,
-            fields="content_vector",
-            kind="vector",
-            exhaustive=True
-        )
+    with Tracing.span("search.embed"):
+        embed_query = EmbeddingCache.embedQuery(openai_client, query, AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME)
 
-    search_results = search_client.search(
-                include_total_count=True,
-                search_text=query,  
-                select="id, chunk, file_name, page_number, chunk_index, parent_id",
-                top=5,
-                vector_queries=[vector_query]
-            )
+    with Metrics.timer("hybridSearch.search"), Tracing.span("search.query", exhaustive=SEARCH_EXHAUSTIVE, k=SEARCH_VECTOR_K):
+        search_results = list(search_client.search(**searchArguments(query, embed_query)))
 
     #fetchin neighbouring chunks (Contextual expansion)
-    window= 1 #how many neighbouring chunks do we take from each direction
-    expanded_results = []
-    ids_in_expanded_results = []
-    for doc in search_results:
+    expanded_results = expandNeighbours(search_client, search_results, window)
 
-        if doc["id"] not in ids_in_expanded_results:
-            expanded_results.append(doc)
-            ids_in_expanded_results.append(doc["id"])
+    return formatSources(expanded_results)
 
-        parent_id = doc["parent_id"]
-        chunk_index = doc["chunk_index"]
-        neighbor_filter = f"parent_id eq '{parent_id}' and chunk_index ge {chunk_index - window} and chunk_index le {chunk_index + window}"
-
-        neighbors = search_client.search(
-            search_text="*",
-            filter=neighbor_filter,
-            select="id, chunk, file_name, page_number, chunk_index, parent_id"
+def buildVectorQuery(embed_query, k=SEARCH_VECTOR_K, exhaustive=SEARCH_EXHAUSTIVE, oversampling=SEARCH_OVERSAMPLING):
+    #exhaustive=False searches the HNSW graph of the index instead of scanning every vector.
+    #oversampling (compressed vector fields only) fetches k * oversampling candidates and rescores them with the full vectors
+    options = {"oversampling": oversampling} if oversampling else {}
+    return VectorizedQuery(
+            vector=embed_query,
+            k_nearest_neighbors=k,
+            fields="content_vector",
+            kind="vector",
+            exhaustive=exhaustive,
+            **options
         )
 
-        for n in neighbors:
-            if n["id"] != doc["id"] and n["id"] not in ids_in_expanded_results: 
-                expanded_results.append(n)
-                ids_in_expanded_results.append(n["id"])
+def searchArguments(query, embed_query, top=SEARCH_TOP, **vector_options):
+    #arguments of the hybrid search_client.search call, vector_options are passed to buildVectorQuery
+    return {
+        "include_total_count": True,
+        "search_text": query,
+        "select": SEARCH_SELECT_FIELDS,
+        "top": top,
+        "vector_queries": [buildVectorQuery(embed_query, **vector_options)]
+    }
 
+def formatSources(expanded_results):
     #formatting results to pass to model
     sources_formatted = "\n\n".join([
         f"chunk: {doc['chunk']}\n"
@@ -206,88 +300,204 @@ def hybridSearch(query):
     return json.dumps({"vector_search_results": sources_formatted})
     
 
+####################
+## Tools
+####################
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "hybridSearch",
+            "description": "Performs hybrid search on the search index to retrieve relevant documents. Useful for when you need to find relevant information in the knowledge base to answer the query.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "The user prompt that was sent to the chat completion model. It the last user message.",
+                    },
+                },
+                "required": ["query"],
+            },
+        }
+    }
+]
+
+def executeToolCall(tool_call_id, function_name, arguments):
+    #runs one tool call requested by the model and returns the tool message to append to the context
+    function_args = json.loads(arguments)
+
+    with Tracing.span(f"tool.{function_name}"):
+        if function_name == "hybridSearch":
+            function_response = hybridSearch(
+                query=function_args.get("query")
+            )
+        else:
+            function_response = json.dumps({"error": "Unknown function"})
+
+    return toolMessage(tool_call_id, function_name, function_response)
+
+def toolMessage(tool_call_id, function_name, content):
+    return {
+        "tool_call_id": tool_call_id,
+        "role": "tool",
+        "name": function_name,
+        "content": content,
+    }
+
+def toolErrorMessage(tool_call_id, function_name, error):
+    #tool message telling the model that a tool call failed, so the turn can still be answered
+    return toolMessage(tool_call_id, function_name, json.dumps({"error": error}))
+
+TOOL_CALL_MAX_WORKERS = int(os.getenv("TOOL_CALL_MAX_WORKERS", "4"))
+TOOL_CALL_TIMEOUT_SECONDS = float(os.getenv("TOOL_CALL_TIMEOUT_SECONDS", "20"))
+
+def executeToolCalls(tool_calls, max_workers=TOOL_CALL_MAX_WORKERS, timeout=TOOL_CALL_TIMEOUT_SECONDS):
+    #tool_calls: list of (tool_call_id, function_name, arguments)
+    #Runs the tool calls of one model response concurrently, at most max_workers at a time, and returns their
+    #tool messages in the order of tool_calls. A call that fails or takes more than timeout seconds
+    #is answered with an error tool message instead.
+    if not tool_calls:
+        return []
+
+    Metrics.increment("tools.calls", len(tool_calls))
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tool_calls))))
+    try:
+        with Metrics.timer("tools.batch"):
+            futures = [executor.submit(Tracing.bindContext(executeToolCall), *tool_call) for tool_call in tool_calls]
+            deadline = time.monotonic() + timeout
+
+            tool_messages = []
+            for (tool_call_id, function_name, _), future in zip(tool_calls, futures):
+                try:
+                    tool_messages.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+                except FutureTimeoutError:
+                    logging.warning("Tool call %s (%s) timed out after %ss", tool_call_id, function_name, timeout)
+                    Metrics.increment("tools.timeouts")
+                    tool_messages.append(toolErrorMessage(tool_call_id, function_name, f"The tool call timed out after {timeout} seconds"))
+                except Exception as e:
+                    logging.exception("Tool call %s (%s) failed", tool_call_id, function_name)
+                    Metrics.increment("tools.errors")
+                    tool_messages.append(toolErrorMessage(tool_call_id, function_name, str(e)))
+    finally:
+        #do not wait for the calls that timed out, their results are discarded
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return tool_messages
+
+####################
+## Semantic Answer Cache
+####################
+def hasConversationContext(messages):
+    #True when the last message of messages follows earlier user turns (or a summary of them). The answer to such
+    #a question may depend on them (eg: "and what about its warranty?"), so it is neither cached nor answered from the cache
+    return any(message["role"] == "user" for message in messages[:-1]) or \
+        any(message["role"] == "system" and str(message.get("content")).startswith("Summary of the conversation so far") for message in messages)
+
+def lookupCachedAnswer(openai_client, messages):
+    #Returns (cached entry or None, query embedding, cache generation) for the last message of messages.
+    #All three are None when the semantic cache is disabled or the question has conversation context.
+    query = messages[-1]['content']
+    if not AnswerCache.SEMANTIC_CACHE_ENABLED or not query or hasConversationContext(messages):
+        return None, None, None
+
+    with Tracing.span("cache.lookup") as current:
+        cache = AnswerCache.getCache()
+        generation = cache.generation(AZURE_SEARCH_INDEX_NAME)
+        query_embedding = EmbeddingCache.embedQuery(openai_client, query, AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME)
+        entry = cache.lookup(AZURE_SEARCH_INDEX_NAME, query_embedding)
+        current.setAttribute("hit", entry is not None)
+    return entry, query_embedding, generation
+
+def storeCachedAnswer(query, query_embedding, generation, tool_messages, answer):
+    #only answers grounded on the knowledge base are cached, small talk and follow-ups answered without a search are not.
+    #query_embedding is None when lookupCachedAnswer skipped the question
+    if query_embedding is None or not tool_messages:
+        return
+
+    sources = [tool_message["content"] for tool_message in tool_messages]
+    AnswerCache.getCache().store(AZURE_SEARCH_INDEX_NAME, query, query_embedding, sources, answer, generation)
+
+####################
+## Tool Routing
+####################
+TOOL_MAX_ROUNDS = int(os.getenv("TOOL_MAX_ROUNDS", "3")) #tool rounds allowed per turn before the model has to answer
+
+def completionOptions(use_tools):
+    #the first completion of a turn may call tools, once TOOL_MAX_ROUNDS is reached the model has to answer
+    return {"tools": TOOLS, "tool_choice": "auto", "temperature": 0.8} if use_tools else {}
+
+def recordTurn(round_trips, tool_rounds):
+    Metrics.observe("chat.llm_round_trips", round_trips)
+    Metrics.observe("chat.tool_rounds", tool_rounds)
+    logging.info("Chat turn completed: llm_round_trips=%s tool_rounds=%s", round_trips, tool_rounds)
+
+def completeWithTools(openai_client, messages, max_rounds=TOOL_MAX_ROUNDS):
+    #Asks the model for an answer, running the tools it requests in between. The answer of a completion without
+    #tool calls is returned as is, so a turn answered without tools costs a single round trip.
+    #Returns (reply, tool messages). messages is extended with the tool calls and their results.
+    tool_messages = []
+    round_trips = tool_rounds = 0
+    while True:
+        with Tracing.span("llm.completion", round=round_trips + 1):
+            response = openai_client.chat.completions.create(
+                stream=False,
+                messages=messages,
+                max_tokens=MAX_TOKENS,
+                model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
+                **completionOptions(tool_rounds < max_rounds)
+            )
+        round_trips += 1
+
+        response_message = response.choices[0].message
+        if not response_message.tool_calls:
+            recordTurn(round_trips, tool_rounds)
+            return response_message.content, tool_messages
+
+        messages.append(response_message)
+        with Tracing.span("tools.execute", calls=len(response_message.tool_calls)):
+            round_messages = executeToolCalls([
+                (tool_call.id, tool_call.function.name, tool_call.function.arguments)
+                for tool_call in response_message.tool_calls
+            ])
+        tool_messages.extend(round_messages)
+        messages.extend(round_messages)
+        tool_rounds += 1
+
 ####################
 ## Send Message
 ####################
-def sendMessage(user_id, openai_client, search_client, session_id, messages):
+def sendMessage(user_id, openai_client, search_client, session_id, messages, history=None):
     #This function is used to handle user messages.
     #It sends the api request to the ai search model then passes the results to the openai model with the user query.
+    #history is the list of stored messages behind messages (see loadContext), used to checkpoint summaries
 
 
-    #add the user query
-    Database.addMessage(user_id, session_id, messages[-1]['role'], messages[-1]['content']) 
+    #The user query and the reply are stored together at the end of the turn (see Database.addMessages)
 
     query = messages[-1]['content']
     latest_message = messages[-1]
 
+    #semantic answer cache: a near-duplicate of a recent question skips straight to the answer
+    cached_answer, query_embedding, cache_generation = lookupCachedAnswer(openai_client, messages)
+    if cached_answer is not None:
+        with Tracing.span("db.saveMessages"):
+            Database.addMessages(user_id, session_id, [(latest_message['role'], query), ("assistant", cached_answer["answer"])])
+        messages.append({
+            "role": "assistant",
+            "content": cached_answer["answer"]
+        })
+        return messages
+
     #applying sliding window + summarization to ensure the context window is met
     messages.pop() #removing the query before in case messages needs to be summarized
-    messages = ensureTokenLimit(openai_client, search_client, user_id, session_id, messages)
+    messages = ensureTokenLimit(openai_client, search_client, user_id, session_id, messages, history)
     messages.append(latest_message)
 
-    tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": "hybridSearch",
-                "description": "Performs hybrid search on the search index to retrieve relevant documents. Useful for when you need to find relevant information in the knowledge base to answer the query.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "query": {
-                            "type": "string",
-                            "description": "The user prompt that was sent to the chat completion model. It the last user message.",
-                        },
-                    },
-                    "required": ["query"],
-                },
-            }
-        }
-    ]
-
-    # First API call: Ask the model to use the functions
-    response = openai_client.chat.completions.create(
-        stream=False,
-        messages=messages,
-        max_tokens=MAX_TOKENS,
-        temperature=0.8,
-        model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
-        tools=tools,
-        tool_choice="auto",
-        )
-
-    response_message = response.choices[0].message
-    messages.append(response_message)
-
-    # Handle function calls
-    if response_message.tool_calls:
-        for tool_call in response_message.tool_calls:
-            function_name = tool_call.function.name
-            function_args = json.loads(tool_call.function.arguments)
-            
-            if function_name == "hybridSearch":
-                function_response = hybridSearch(
-                    query=function_args.get("query")
-                )
-            else:
-                function_response = json.dumps({"error": "Unknown function"})
-            
-            messages.append({
-                "tool_call_id": tool_call.id,
-                "role": "tool",
-                "name": function_name,
-                "content": function_response,
-            })
-
-    # Second API call: Get the final response from the model
-    final_response = openai_client.chat.completions.create(
-        model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
-        messages=messages,
-        max_tokens=MAX_TOKENS,
-    )
-
-    full_reply = final_response.choices[0].message.content
-    Database.addMessage(user_id, session_id, "assistant", full_reply)
+    full_reply, tool_messages = completeWithTools(openai_client, messages)
+    with Tracing.span("db.saveMessages"):
+        Database.addMessages(user_id, session_id, [(latest_message['role'], query), ("assistant", full_reply)])
+    storeCachedAnswer(query, query_embedding, cache_generation, tool_messages, full_reply)
 
     messages.append({
         "role": "assistant",
@@ -300,28 +510,167 @@ def sendMessage(user_id, openai_client, search_client, session_id, messages):
 ## Send Message Helper
 ####################
 def sendMessageHelper(user_id, session_id, query):
-    
-    openai_client, search_client = initializeClients()
-    messages = Database.getMessages(user_id=user_id, session_id=session_id)
+    #every stage of the turn is traced under a chat.turn span (see Tracing)
 
-    messages.append({
-        "role": "user",
-        "content": query
-    })
+    with Tracing.span("chat.turn", session_id=session_id):
+        openai_client, search_client = initializeClients()
+        messages, history = loadContext(user_id=user_id, session_id=session_id)
 
-    # Call your existing function
-    updated_messages = sendMessage(
-        user_id=user_id,
-        openai_client=openai_client,
-        search_client=search_client,
-        session_id=session_id,
-        messages=messages,
-    )
+        messages.append({
+            "role": "user",
+            "content": query
+        })
+
+        # Call your existing function
+        updated_messages = sendMessage(
+            user_id=user_id,
+            openai_client=openai_client,
+            search_client=search_client,
+            session_id=session_id,
+            messages=messages,
+            history=history,
+        )
     
     reply = updated_messages[-1]["content"]
-    openai_client.close()
     return reply
 
+####################
+## Stream Message
+####################
+def _streamCompletion(openai_client, messages, use_tools):
+    #Streams a chat completion. Yields ("token", text) for every content delta and
+    #finally ("tool_calls", [...]) with the tool calls reassembled from their deltas
+    stream = openai_client.chat.completions.create(
+        stream=True,
+        messages=messages,
+        max_tokens=MAX_TOKENS,
+        model=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
+        **completionOptions(use_tools)
+    )
+
+    tool_calls = {}
+    for chunk in stream:
+        if not chunk.choices: #azure sends the content filter results in a chunk without choices
+            continue
+        delta = chunk.choices[0].delta
+
+        if delta.content:
+            yield "token", delta.content
+
+        for tool_call_delta in delta.tool_calls or []:
+            tool_call = tool_calls.setdefault(tool_call_delta.index, {
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if tool_call_delta.id:
+                tool_call["id"] = tool_call_delta.id
+            if tool_call_delta.function:
+                tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+
+    yield "tool_calls", [tool_calls[index] for index in sorted(tool_calls)]
+
+def streamMessage(user_id, openai_client, search_client, session_id, messages, history=None):
+    #Streaming variant of sendMessage. It is a generator of events:
+    # {"event": "token", "content": ...} for every generated token and a final
+    # {"event": "done", "reply": ..., "time_to_first_token_ms": ..., "total_ms": ..., "llm_round_trips": ...}
+    #The user query and the assistant reply are only stored once the whole stream has been generated.
+
+    started_at = time.perf_counter()
+    first_token_at = None
+
+    query = messages[-1]['content']
+    query_role = messages[-1]['role']
+    cached_answer, query_embedding, cache_generation = lookupCachedAnswer(openai_client, messages)
+    if cached_answer is not None:
+        with Tracing.span("db.saveMessages"):
+            Database.addMessages(user_id, session_id, [(query_role, query), ("assistant", cached_answer["answer"])])
+        total_ms = round((time.perf_counter() - started_at) * 1000, 1)
+        yield {"event": "token", "content": cached_answer["answer"]}
+        yield {"event": "done", "reply": cached_answer["answer"], "time_to_first_token_ms": total_ms, "total_ms": total_ms, "llm_round_trips": 0}
+        return
+
+    latest_message = messages.pop()
+    messages = ensureTokenLimit(openai_client, search_client, user_id, session_id, messages, history)
+    messages.append(latest_message)
+
+    reply_parts = []
+    tool_messages = []
+    round_trips = tool_rounds = 0
+    while True:
+        tool_calls = []
+        round_trips += 1
+        with Tracing.span("llm.completion", round=round_trips):
+            for kind, value in _streamCompletion(openai_client, messages, tool_rounds < TOOL_MAX_ROUNDS):
+                if kind == "tool_calls":
+                    tool_calls = value
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                reply_parts.append(value)
+                yield {"event": "token", "content": value}
+
+        if not tool_calls:
+            break
+
+        #the model asked for the knowledge base: run the tools and stream the answer of the next completion.
+        #Text streamed before the tool calls (eg: "Let me look that up") stays with them instead of the stored reply
+        messages.append({"role": "assistant", "content": "".join(reply_parts) or None, "tool_calls": tool_calls})
+        reply_parts = []
+        with Tracing.span("tools.execute", calls=len(tool_calls)):
+            round_messages = executeToolCalls([
+                (tool_call["id"], tool_call["function"]["name"], tool_call["function"]["arguments"])
+                for tool_call in tool_calls
+            ])
+        tool_messages.extend(round_messages)
+        messages.extend(round_messages)
+        tool_rounds += 1
+
+    recordTurn(round_trips, tool_rounds)
+    full_reply = "".join(reply_parts)
+    with Tracing.span("db.saveMessages"):
+        Database.addMessages(user_id, session_id, [(query_role, query), ("assistant", full_reply)])
+    storeCachedAnswer(query, query_embedding, cache_generation, tool_messages, full_reply)
+
+    finished_at = time.perf_counter()
+    time_to_first_token_ms = round((first_token_at - started_at) * 1000, 1) if first_token_at else None
+    total_ms = round((finished_at - started_at) * 1000, 1)
+    logging.info("Chat stream completed: time_to_first_token_ms=%s total_ms=%s", time_to_first_token_ms, total_ms)
+
+    yield {
+        "event": "done",
+        "reply": full_reply,
+        "time_to_first_token_ms": time_to_first_token_ms,
+        "total_ms": total_ms,
+        "llm_round_trips": round_trips
+    }
+
+def streamMessageHelper(user_id, session_id, query):
+    #Generator of server-sent events (text/event-stream) for the streaming message endpoint.
+    #The turn is traced under a chat.turn span like sendMessageHelper, see Tracing.bindIterator
+    return Tracing.bindIterator(_streamTurn(user_id, session_id, query))
+
+def _streamTurn(user_id, session_id, query):
+    try:
+        with Tracing.span("chat.turn", session_id=session_id, streamed=True):
+            openai_client, search_client = initializeClients()
+            messages, history = loadContext(user_id=user_id, session_id=session_id)
+            messages.append({
+                "role": "user",
+                "content": query
+            })
+
+            for event in streamMessage(user_id, openai_client, search_client, session_id, messages, history):
+                yield formatServerSentEvent(event.pop("event"), event)
+
+    except Exception as e:
+        logging.exception("Error while streaming a chat message")
+        yield formatServerSentEvent("error", {"error": str(e)})
+
+def formatServerSentEvent(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 ###################
 ## Initialize Chat
 ###################
@@ -349,15 +698,13 @@ def initializeChat(user_id, session_id):
 
     full_reply = response.choices[0].message.content
 
-    Database.addMessage(user_id, session_id, messages[-1]['role'], messages[-1]['content']) 
-    Database.addMessage(user_id, session_id, "assistant", full_reply)
+    Database.addMessages(user_id, session_id, [(messages[-1]['role'], messages[-1]['content']), ("assistant", full_reply)])
 
     messages.append({
         "role": "assistant",
         "content": full_reply
     })
         
-    openai_client.close()
     return messages
 
 
@@ -378,10 +725,11 @@ def createSession(user_id, session_name):
 ## Clear Chat
 ###################
 def clearChat(user_id, session_id):
+    #returns the messages of the reset session and the delete stats of Database.clearSession
 
-    Database.clearSession(user_id=user_id, session_id=session_id)
+    delete_stats = Database.clearSession(user_id=user_id, session_id=session_id)
     messages = initializeChat(user_id, session_id)
-    return messages
+    return messages, delete_stats
 
         
 ###################
@@ -0,0 +1,92 @@
+#################
+# Token-aware text chunking for ingestion.
+# Chunks target a token budget measured with the same tiktoken encoding as the chat model, overlap by a
+# configurable number of tokens and, by default, only break between sentences.
+# Every sentence is encoded once, so chunking a document is linear in its length.
+################
+import re
+import os
+
+import Tokens
+
+CHUNK_SIZE_TOKENS = int(os.getenv("CHUNK_SIZE_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+
+# a sentence ends after ., ! or ? followed by whitespace, or at a blank line
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+
+def splitSentences(text):
+    #str -> list[str], every sentence keeps its trailing whitespace so the pieces add up to the original text
+    sentences = []
+    start = 0
+    for boundary in _SENTENCE_BOUNDARY.finditer(text):
+        sentences.append(text[start:boundary.end()])
+        start = boundary.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+def _sentenceUnits(text, chunk_size):
+    #list of (piece, token_count). Sentences longer than chunk_size are split into chunk_size token pieces
+    encoding = Tokens.getEncoding()
+    sentences = splitSentences(text)
+    units = []
+    for sentence, tokens in zip(sentences, encoding.encode_ordinary_batch(sentences)):
+        if len(tokens) <= chunk_size:
+            units.append((sentence, len(tokens)))
+            continue
+        for start in range(0, len(tokens), chunk_size):
+            piece = tokens[start:start + chunk_size]
+            units.append((encoding.decode(piece), len(piece)))
+    return units
+
+def chunkByTokens(text, chunk_size=CHUNK_SIZE_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    #fixed token windows, ignoring sentences
+    encoding = Tokens.getEncoding()
+    tokens = encoding.encode_ordinary(text)
+    step = max(1, chunk_size - overlap)
+    chunks = []
+    for start in range(0, len(tokens), step):
+        chunks.append(encoding.decode(tokens[start:start + chunk_size]))
+        if start + chunk_size >= len(tokens):
+            break
+    return chunks
+
+def chunkText(text, chunk_size=CHUNK_SIZE_TOKENS, overlap=CHUNK_OVERLAP_TOKENS, snap_to_sentences=True):
+    #str, int, int, bool -> list[str]
+    #Packs whole sentences into chunks of at most chunk_size tokens. The next chunk starts with the last
+    #sentences of the previous one, up to overlap tokens, so context is not lost at the chunk borders.
+    if not text or not text.strip():
+        return []
+    if overlap >= chunk_size:
+        raise ValueError("The chunk overlap must be smaller than the chunk size")
+    if not snap_to_sentences:
+        return chunkByTokens(text, chunk_size, overlap)
+
+    units = _sentenceUnits(text, chunk_size)
+    chunks = []
+    start = 0
+    while start < len(units):
+        end, chunk_tokens = start, 0
+        while end < len(units) and (end == start or chunk_tokens + units[end][1] <= chunk_size):
+            chunk_tokens += units[end][1]
+            end += 1
+
+        chunk = "".join(piece for piece, _ in units[start:end]).strip()
+        if chunk:
+            chunks.append(chunk)
+        if end == len(units):
+            break
+
+        #step back over the last sentences of this chunk while they fit in the overlap and still leave room
+        #for the next new sentence, so every chunk moves forward
+        next_start, overlap_tokens = end, 0
+        while (next_start - 1 > start
+               and overlap_tokens + units[next_start - 1][1] <= overlap
+               and overlap_tokens + units[next_start - 1][1] + units[end][1] <= chunk_size):
+            next_start -= 1
+            overlap_tokens += units[next_start][1]
+        start = next_start
+
+    return chunks
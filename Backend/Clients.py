@@ -0,0 +1,225 @@
+#################
+# This module holds the process-wide pool of AzureOpenAI, SearchClient and SearchIndexClient instances
+# (and of the async clients of other modules, eg: the Cosmos DB client of AsyncDatabase).
+# Clients are created lazily on first use and reused by every request handled by the worker,
+# so TLS handshakes and connection pools are only paid for once.
+################
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.search.documents.indexes import SearchIndexClient
+from azure.core.credentials import AzureKeyCredential
+from openai import AzureOpenAI, AsyncAzureOpenAI
+import threading
+import asyncio
+import logging
+import atexit
+import time
+import os
+
+AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
+AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
+AZURE_AI_FOUNDRY_ENDPOINT = os.getenv("AZURE_AI_FOUNDRY_ENDPOINT")
+
+AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
+AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
+AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME")
+
+# how often (in seconds) a pooled client is checked before being handed out again
+CLIENT_HEALTH_CHECK_INTERVAL = float(os.getenv("CLIENT_HEALTH_CHECK_INTERVAL", "60"))
+
+_lock = threading.Lock()
+_openai_clients = {}  # (endpoint, api_version) -> {"client": ..., "checked_at": ...}
+_search_clients = {}  # (endpoint, index_name) -> {"client": ..., "checked_at": ...}
+_search_index_clients = {}  # endpoint -> {"client": ..., "checked_at": ...}
+# async clients are bound to the event loop that created them, so their keys also hold the loop
+_async_openai_clients = {}  # (endpoint, api_version, loop) -> {"client": ..., "checked_at": ...}
+_async_search_clients = {}  # (endpoint, index_name, loop) -> {"client": ..., "checked_at": ...}
+_async_clients = {}  # (name, loop) -> {"client": ..., "checked_at": ...}, see getAsyncClient
+_ASYNC_POOLS = (_async_openai_clients, _async_search_clients, _async_clients)
+
+
+####################
+## Health Checks
+####################
+def _openaiClientIsHealthy(client):
+    #the underlying httpx client is closed if someone called .close() on the pooled instance
+    is_closed = getattr(client, "is_closed", None)
+    return not (callable(is_closed) and is_closed())
+
+def _searchClientIsHealthy(client):
+    #azure-core transports reopen their session on the next request after close(), so a pooled
+    #SearchClient only needs replacing if it has lost its pipeline altogether
+    return getattr(client, "_client", None) is not None
+
+
+def _getPooled(pool, key, factory, is_healthy):
+    #returns the pooled client for key, creating or replacing it if it is missing or unhealthy
+    now = time.monotonic()
+    entry = pool.get(key)
+    if entry is not None and now - entry["checked_at"] < CLIENT_HEALTH_CHECK_INTERVAL:
+        return entry["client"]
+
+    with _lock:
+        entry = pool.get(key)
+        if entry is not None:
+            if is_healthy(entry["client"]):
+                entry["checked_at"] = now
+                return entry["client"]
+            logging.warning("Pooled client for %s failed its health check, recreating it", key)
+            _closeQuietly(entry["client"])
+
+        client = factory()
+        pool[key] = {"client": client, "checked_at": now}
+        return client
+
+
+####################
+## Client Getters
+####################
+def getOpenAIClient(endpoint=None, api_version=None):
+    #Returns the shared AzureOpenAI client for the given endpoint (defaults to the AI Foundry endpoint).
+    #Deployments are selected per call through the model argument, so one client serves all of them.
+    endpoint = endpoint or AZURE_AI_FOUNDRY_ENDPOINT
+    api_version = api_version or AZURE_OPENAI_API_VERSION
+
+    def factory():
+        return AzureOpenAI(
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            api_key=AZURE_OPENAI_API_KEY,
+        )
+
+    return _getPooled(_openai_clients, (endpoint, api_version), factory, _openaiClientIsHealthy)
+
+def getSearchClient(index_name=None, endpoint=None):
+    #Returns the shared SearchClient for the given index (defaults to the chatbot's index)
+    index_name = index_name or AZURE_SEARCH_INDEX_NAME
+    endpoint = endpoint or AZURE_SEARCH_ENDPOINT
+
+    def factory():
+        return SearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
+        )
+
+    return _getPooled(_search_clients, (endpoint, index_name), factory, _searchClientIsHealthy)
+
+def getSearchIndexClient(endpoint=None):
+    #Returns the shared SearchIndexClient used to manage the indexes of the search service
+    endpoint = endpoint or AZURE_SEARCH_ENDPOINT
+
+    def factory():
+        return SearchIndexClient(
+            endpoint=endpoint,
+            credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
+        )
+
+    return _getPooled(_search_index_clients, endpoint, factory, _searchClientIsHealthy)
+
+
+####################
+## Async Client Getters
+####################
+def getAsyncOpenAIClient(endpoint=None, api_version=None):
+    #asyncio counterpart of getOpenAIClient, shared by every coroutine running on the current event loop
+    endpoint = endpoint or AZURE_AI_FOUNDRY_ENDPOINT
+    api_version = api_version or AZURE_OPENAI_API_VERSION
+
+    def factory():
+        return AsyncAzureOpenAI(
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            api_key=AZURE_OPENAI_API_KEY,
+        )
+
+    key = (endpoint, api_version, asyncio.get_running_loop())
+    return _getPooled(_async_openai_clients, key, factory, _openaiClientIsHealthy)
+
+def getAsyncSearchClient(index_name=None, endpoint=None):
+    #asyncio counterpart of getSearchClient
+    index_name = index_name or AZURE_SEARCH_INDEX_NAME
+    endpoint = endpoint or AZURE_SEARCH_ENDPOINT
+
+    def factory():
+        return AsyncSearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
+        )
+
+    key = (endpoint, index_name, asyncio.get_running_loop())
+    return _getPooled(_async_search_clients, key, factory, _searchClientIsHealthy)
+
+def getAsyncClient(name, factory):
+    #Pools the async client created by factory() under name for the current event loop, so modules with their own
+    #clients get one per loop, closed with the others by closeAsyncClients. The client must have an async close()
+    key = (name, asyncio.get_running_loop())
+    return _getPooled(_async_clients, key, factory, lambda client: True)
+
+async def closeAsyncClient(name):
+    #closes the client pooled under name for the current event loop, if any
+    with _lock:
+        entry = _async_clients.pop((name, asyncio.get_running_loop()), None)
+    if entry is not None:
+        await _closeAsyncEntries([entry])
+
+
+####################
+## Shutdown
+####################
+def _closeQuietly(client):
+    try:
+        client.close()
+    except Exception:
+        logging.exception("Error while closing a pooled client")
+
+def closeClients():
+    #Closes every pooled client. Registered to run when the worker process exits.
+    with _lock:
+        for pool in (_openai_clients, _search_clients, _search_index_clients):
+            for entry in pool.values():
+                _closeQuietly(entry["client"])
+            pool.clear()
+
+def _takeAsyncClients(loop):
+    #removes the async clients created on loop from the pools and returns their entries
+    with _lock:
+        entries = []
+        for pool in _ASYNC_POOLS:
+            for key in [key for key in pool if key[-1] is loop]:
+                entries.append(pool.pop(key))
+    return entries
+
+async def _closeAsyncEntries(entries):
+    for entry in entries:
+        try:
+            await entry["client"].close()
+        except Exception:
+            logging.exception("Error while closing a pooled async client")
+
+async def closeAsyncClients():
+    #Closes the async clients created on the current event loop
+    await _closeAsyncEntries(_takeAsyncClients(asyncio.get_running_loop()))
+
+def closeAsyncClientsAtExit(timeout=5.0):
+    #Closes the async clients of every event loop. Registered to run when the worker process exits, since the
+    #Functions runtime has no shutdown hook for the app: the clients of a loop that is still open are closed on it,
+    #those of a loop that is already closed are released with the process
+    with _lock:
+        loops = {key[-1] for pool in _ASYNC_POOLS for key in pool}
+
+    for loop in loops:
+        entries = _takeAsyncClients(loop)
+        if loop.is_closed():
+            continue
+        try:
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(_closeAsyncEntries(entries), loop).result(timeout)
+            else:
+                loop.run_until_complete(_closeAsyncEntries(entries))
+        except Exception:
+            logging.exception("Could not close the async clients of an event loop")
+
+atexit.register(closeClients)
+atexit.register(closeAsyncClientsAtExit)
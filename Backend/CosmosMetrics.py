@@ -0,0 +1,194 @@
+#################
+# Request unit and latency instrumentation of the Cosmos DB container.
+# InstrumentedContainer (and AsyncInstrumentedContainer for azure.cosmos.aio) wrap a container and record, for every
+# read, create, upsert, delete, batch and query: the request charge, the latency, the number of items and the
+# partition scope. Operations are labeled with the Database/AsyncDatabase function that started them, passed to
+# initializeContainer(label).
+# Totals per label are returned by stats(), and every operation is logged as a JSON line (COSMO_DB_LOG_OPERATIONS).
+################
+import threading
+import logging
+import json
+import time
+import os
+
+import Metrics
+
+COSMO_DB_LOG_OPERATIONS = os.getenv("COSMO_DB_LOG_OPERATIONS", "true").lower() == "true"
+
+_lock = threading.Lock()
+_stats = {}  # label -> {"operations": ..., "request_charge": ..., "max_request_charge": ..., "total_ms": ..., "items": ..., "cross_partition": ...}
+
+
+def requestCharge(headers):
+    try:
+        return float((headers or {}).get("x-ms-request-charge", 0.0))
+    except (TypeError, ValueError):
+        return 0.0
+
+def record(label, operation, request_charge, elapsed_ms, item_count, scope):
+    #scope: "point" (single item), "partition" (query or batch within one partition) or "cross-partition"
+    with _lock:
+        stats = _stats.setdefault(label, {
+            "operations": 0, "request_charge": 0.0, "max_request_charge": 0.0,
+            "total_ms": 0.0, "items": 0, "cross_partition": 0
+        })
+        stats["operations"] += 1
+        stats["request_charge"] += request_charge
+        stats["max_request_charge"] = max(stats["max_request_charge"], request_charge)
+        stats["total_ms"] += elapsed_ms
+        stats["items"] += item_count
+        stats["cross_partition"] += scope == "cross-partition"
+
+    Metrics.increment("cosmos.request_charge", request_charge)
+    Metrics.recordLatency(f"cosmos.{label}.{operation}", elapsed_ms)
+    if COSMO_DB_LOG_OPERATIONS:
+        logging.info("cosmos_operation %s", json.dumps({
+            "label": label,
+            "operation": operation,
+            "request_charge": round(request_charge, 2),
+            "elapsed_ms": round(elapsed_ms, 2),
+            "items": item_count,
+            "scope": scope
+        }))
+
+def stats():
+    #per label totals, the most expensive labels first
+    with _lock:
+        labels = {label: dict(values) for label, values in _stats.items()}
+    for values in labels.values():
+        values["avg_request_charge"] = round(values["request_charge"] / values["operations"], 3) if values["operations"] else 0.0
+        values["avg_ms"] = round(values["total_ms"] / values["operations"], 3) if values["operations"] else 0.0
+        values["request_charge"] = round(values["request_charge"], 3)
+        values["total_ms"] = round(values["total_ms"], 3)
+    return dict(sorted(labels.items(), key=lambda item: item[1]["request_charge"], reverse=True))
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def _queryScope(kwargs):
+    if kwargs.get("partition_key") is not None:
+        return "partition"
+    return "cross-partition" if kwargs.get("enable_cross_partition_query") else "partition"
+
+
+def _countItem(result):
+    return int(result is not None)
+
+def _countItems(result):
+    return len(result or [])
+
+
+class _Charge:
+    #collects the request charge reported through the response_hook of one operation
+    def __init__(self):
+        self.value = 0.0
+        self.reported = False
+
+    def __call__(self, headers, *args):
+        self.value += requestCharge(headers)
+        self.reported = True
+
+
+class InstrumentedContainer:
+    """
+    Wraps a ContainerProxy (or LocalContainer.InMemoryContainer). Instrumented operations take the same
+    arguments as the wrapped container, every other attribute is delegated to it.
+    Query results are read completely before they are returned so the whole query is measured.
+    Operations are recorded under label.
+    """
+    def __init__(self, container, label="unknown"):
+        self.container = container
+        self.label = label
+
+    def __getattr__(self, name):
+        return getattr(self.container, name)
+
+    def _lastCharge(self):
+        #charge of the last response of the client, used when the SDK did not call the response hook
+        client_connection = getattr(self.container, "client_connection", None)
+        return requestCharge(getattr(client_connection, "last_response_headers", None))
+
+    def _run(self, operation, scope, call, count_items, args, kwargs):
+        label = self.label
+        charge = _Charge()
+        started_at = time.perf_counter()
+        result = None
+        try:
+            result = call(*args, response_hook=charge, **kwargs)
+            if operation == "query":
+                result = list(result)
+        finally:
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            request_charge = charge.value if charge.reported else self._lastCharge()
+            record(label, operation, request_charge, elapsed_ms, count_items(result), scope)
+        return iter(result) if operation == "query" else result
+
+    def read_item(self, *args, **kwargs):
+        return self._run("read", "point", self.container.read_item, _countItem, args, kwargs)
+
+    def create_item(self, *args, **kwargs):
+        return self._run("create", "point", self.container.create_item, _countItem, args, kwargs)
+
+    def upsert_item(self, *args, **kwargs):
+        return self._run("upsert", "point", self.container.upsert_item, _countItem, args, kwargs)
+
+    def delete_item(self, *args, **kwargs):
+        return self._run("delete", "point", self.container.delete_item, lambda result: 1, args, kwargs)
+
+    def execute_item_batch(self, *args, **kwargs):
+        return self._run("batch", "partition", self.container.execute_item_batch, _countItems, args, kwargs)
+
+    def query_items(self, *args, **kwargs):
+        return self._run("query", _queryScope(kwargs), self.container.query_items, _countItems, args, kwargs)
+
+
+class AsyncInstrumentedContainer(InstrumentedContainer):
+    """
+    InstrumentedContainer for an azure.cosmos.aio ContainerProxy. query_items stays synchronous and returns
+    an async iterator, like the aio SDK.
+    """
+    async def _runAsync(self, operation, scope, call, count_items, args, kwargs):
+        label = self.label
+        charge = _Charge()
+        started_at = time.perf_counter()
+        result = None
+        try:
+            result = await call(*args, response_hook=charge, **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            request_charge = charge.value if charge.reported else self._lastCharge()
+            record(label, operation, request_charge, elapsed_ms, count_items(result), scope)
+        return result
+
+    async def read_item(self, *args, **kwargs):
+        return await self._runAsync("read", "point", self.container.read_item, _countItem, args, kwargs)
+
+    async def create_item(self, *args, **kwargs):
+        return await self._runAsync("create", "point", self.container.create_item, _countItem, args, kwargs)
+
+    async def upsert_item(self, *args, **kwargs):
+        return await self._runAsync("upsert", "point", self.container.upsert_item, _countItem, args, kwargs)
+
+    async def delete_item(self, *args, **kwargs):
+        return await self._runAsync("delete", "point", self.container.delete_item, lambda result: 1, args, kwargs)
+
+    async def execute_item_batch(self, *args, **kwargs):
+        return await self._runAsync("batch", "partition", self.container.execute_item_batch, _countItems, args, kwargs)
+
+    def query_items(self, *args, **kwargs):
+        return self._queryAsync(self.label, args, kwargs)
+
+    async def _queryAsync(self, label, args, kwargs):
+        charge = _Charge()
+        started_at = time.perf_counter()
+        item_count = 0
+        try:
+            async for item in self.container.query_items(*args, response_hook=charge, **kwargs):
+                item_count += 1
+                yield item
+        finally:
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            request_charge = charge.value if charge.reported else self._lastCharge()
+            record(label, "query", request_charge, elapsed_ms, item_count, _queryScope(kwargs))
@@ -1,29 +1,232 @@
 from azure.cosmos import CosmosClient, PartitionKey
 from azure.identity import DefaultAzureCredential
-from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosBatchOperationError
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
 
 import uuid
 from datetime import datetime, timezone
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+import atexit
+import queue
+import time
+import requests
 import os
 import bcrypt
 
+import Tokens
+import Metrics
+import CosmosMetrics
 
 
 COSMO_DB_URI = os.getenv("COSMO_DB_URI")
 COSMO_DB_PRIMARY_KEY = os.getenv("COSMO_DB_PRIMARY_KEY")
 COSMO_DB_NAME = os.getenv("COSMO_DB_NAME")
 COSMO_DB_CONVERSATIONS_CONTAINER_NAME = os.getenv("COSMO_DB_CONVERSATIONS_CONTAINER_NAME")
+COSMO_DB_MAX_CONNECTIONS = int(os.getenv("COSMO_DB_MAX_CONNECTIONS", "50"))
+# comma separated list of Azure regions, eg: "West Europe, North Europe"
+COSMO_DB_PREFERRED_REGIONS = [r.strip() for r in os.getenv("COSMO_DB_PREFERRED_REGIONS", "").split(",") if r.strip()]
+COSMO_DB_BATCH_SIZE = 100 # maximum number of operations of a Cosmos DB transactional batch
+COSMO_DB_DELETE_CONCURRENCY = int(os.getenv("COSMO_DB_DELETE_CONCURRENCY", "4"))
+# throttled (429) requests are retried by the Cosmos SDK after the x-ms-retry-after-ms of the response,
+# up to COSMO_DB_THROTTLE_RETRIES times and COSMO_DB_THROTTLE_MAX_WAIT_SECONDS in total (see throttleRetryOptions)
+COSMO_DB_THROTTLE_RETRIES = int(os.getenv("COSMO_DB_THROTTLE_RETRIES", "5"))
+COSMO_DB_THROTTLE_MAX_WAIT_SECONDS = int(os.getenv("COSMO_DB_THROTTLE_MAX_WAIT_SECONDS", "30"))
+# when enabled, the messages of a turn are written by a background thread after the reply is returned
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "false").lower() == "true"
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "1024"))
 
-# Initialize Cosmos client only when instance is created
-client = CosmosClient(COSMO_DB_URI, credential=COSMO_DB_PRIMARY_KEY)
-database = client.get_database_client(COSMO_DB_NAME)
-container = database.get_container_client(COSMO_DB_CONVERSATIONS_CONTAINER_NAME)
+##################
+## Container Provider
+###############
+
+class ContainerProvider:
+    """
+    Lazily creates a single CosmosClient and container handle and hands out the same handle
+    to every caller. The HTTP connection pool size and the preferred read/write regions are configurable.
+    """
+    def __init__(self, uri=None, key=None, database_name=None, container_name=None,
+                 max_connections=None, preferred_regions=None):
+        self.uri = uri or COSMO_DB_URI
+        self.key = key or COSMO_DB_PRIMARY_KEY
+        self.database_name = database_name or COSMO_DB_NAME
+        self.container_name = container_name or COSMO_DB_CONVERSATIONS_CONTAINER_NAME
+        self.max_connections = max_connections or COSMO_DB_MAX_CONNECTIONS
+        self.preferred_regions = preferred_regions if preferred_regions is not None else COSMO_DB_PREFERRED_REGIONS
+        self._client = None
+        self._container = None
+        self._lock = threading.Lock()
+
+    def getContainer(self):
+        if self._container is None:
+            with self._lock:
+                if self._container is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.max_connections, pool_maxsize=self.max_connections)
+                    session.mount("https://", adapter)
+
+                    self._client = CosmosClient(
+                        self.uri,
+                        credential=self.key,
+                        preferred_locations=self.preferred_regions or None,
+                        transport=RequestsTransport(session=session, session_owner=True),
+                        **throttleRetryOptions()
+                    )
+                    database = self._client.get_database_client(self.database_name)
+                    self._container = database.get_container_client(self.container_name)
+        return self._container
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            self._client = None
+            self._container = None
+
+
+def throttleRetryOptions():
+    #CosmosClient settings of the SDK retry policy for throttled requests, the only retry of 429 responses.
+    #The SDK falls back to its own default (9 retries) when given 0, so at least one retry is made
+    return {
+        "retry_throttle_total": max(1, COSMO_DB_THROTTLE_RETRIES),
+        "retry_throttle_backoff_max": COSMO_DB_THROTTLE_MAX_WAIT_SECONDS
+    }
+
+_container_provider = ContainerProvider()
+
+def setContainerProvider(provider):
+    # Swaps the provider used by every Database function (eg: LocalContainer.InMemoryContainerProvider for tests and benchmarks)
+    # Returns the previous provider so it can be restored
+    global _container_provider
+    previous = _container_provider
+    _container_provider = provider
+    _user_cache.clear()
+    return previous
 
-def initializeContainer():
-    client = CosmosClient(COSMO_DB_URI, credential=COSMO_DB_PRIMARY_KEY)
-    database = client.get_database_client(COSMO_DB_NAME)
-    container = database.get_container_client(COSMO_DB_CONVERSATIONS_CONTAINER_NAME)
-    return container
+def getContainerProvider():
+    return _container_provider
+
+##################
+## User Cache
+###############
+
+class UserCache:
+    """
+    Per-process cache of the user profile fields used by userIsValid and isAdmin, so the point read
+    of a user is not repeated on every call of a chat turn. Entries expire after ttl_seconds and the
+    least recently used ones are dropped past max_entries. Unknown users are cached too.
+    Users are never updated or deleted by this module, so entries are not invalidated on writes: a profile changed
+    directly in Cosmos DB (eg: a user promoted to admin) is seen by every worker after at most ttl_seconds
+    (USER_CACHE_TTL_SECONDS). Code that changes a profile should call invalidate, which only affects its own worker.
+    """
+    def __init__(self, ttl_seconds=USER_CACHE_TTL_SECONDS, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> (expires_at, profile or None)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._miss_ru = 0.0  # request charge of the reads done on misses
+
+    def get(self, user_id):
+        #returns (True, profile) on a hit, profile being None for an unknown user, and (False, None) on a miss
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self._hits += 1
+                saved_ru = self._miss_ru / self._misses if self._misses else 1.0
+                hit = True
+            else:
+                if entry is not None:
+                    del self._entries[user_id]
+                self._misses += 1
+                hit = False
+
+        if hit:
+            Metrics.increment("userCache.hits")
+            Metrics.increment("userCache.saved_ru", saved_ru)
+            return True, entry[1]
+        Metrics.increment("userCache.misses")
+        return False, None
+
+    def put(self, user_id, profile, request_charge=1.0):
+        with self._lock:
+            self._miss_ru += request_charge
+            self._entries[user_id] = (time.monotonic() + self.ttl_seconds, profile)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            avg_read_ru = self._miss_ru / self._misses if self._misses else 0.0
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "avg_read_ru": round(avg_read_ru, 3),
+                "saved_ru_estimate": round(self._hits * avg_read_ru, 3)
+            }
+
+
+_user_cache = UserCache()
+
+def getUserCache():
+    return _user_cache
+
+def userProfile(item):
+    #the fields of a user document kept in the user cache, None when item is not a user
+    if item is None or item.get("documentType") != "user":
+        return None
+    return {"documentType": item["documentType"], "user_type": item.get("user_type")}
+
+def lastRequestCharge(container):
+    #RU charge of the last request made with container, 1 RU (a point read of a small document) when unknown
+    headers = getattr(getattr(container, "client_connection", None), "last_response_headers", None) or {}
+    try:
+        return float(headers.get("x-ms-request-charge", 1.0))
+    except (TypeError, ValueError):
+        return 1.0
+
+def getUserProfile(user_id):
+    #cached {"documentType", "user_type"} of a user, None if the user does not exist
+    hit, profile = _user_cache.get(user_id)
+    if hit:
+        return profile
+
+    container = initializeContainer("getUserProfile")
+    try:
+        item = container.read_item(item=user_id, partition_key=user_id)
+    except CosmosResourceNotFoundError:
+        item = None
+    profile = userProfile(item)
+    _user_cache.put(user_id, profile, lastRequestCharge(container))
+    return profile
+
+_instrumented_containers = {}  # label -> InstrumentedContainer
+
+def initializeContainer(label):
+    #returns the shared container handle of the current provider, wrapped to record the RU charge of every operation under label
+    container = _container_provider.getContainer()
+    instrumented = _instrumented_containers.get(label)
+    if instrumented is None or instrumented.container is not container:
+        instrumented = _instrumented_containers[label] = CosmosMetrics.InstrumentedContainer(container, label)
+    return instrumented
     
 ##################
 ## User Management Functions
@@ -34,7 +237,7 @@ def addUser(first_name, last_name, username, password, user_type="user"):
     # Returns None if the username already exists
     # user_type = user || admin
 
-    container = initializeContainer()
+    container = initializeContainer("addUser")
     query = """
         SELECT c.userId
         FROM c
@@ -76,27 +279,18 @@ def addUser(first_name, last_name, username, password, user_type="user"):
     return id
 
 def isAdmin(user_id):
-    container = initializeContainer()
-    try:
-        user = container.read_item(item=user_id, partition_key=user_id)
-        return user.get("documentType") == "user" and user.get("user_type") == "admin"
-    except CosmosResourceNotFoundError:
-        return False
+    profile = getUserProfile(user_id)
+    return profile is not None and profile.get("user_type") == "admin"
 
 def userIsValid(user_id):
-    container = initializeContainer()
-    try:
-        item = container.read_item(item=user_id, partition_key=user_id)
-        return item.get("documentType") == "user"
-    except CosmosResourceNotFoundError:
-        return False
+    return getUserProfile(user_id) is not None
 
 def login(username, password):
     """
     Attempt to log in a user by username and password.
     Returns a dictionary with userId and user_type if found, otherwise None.
     """
-    container = initializeContainer()
+    container = initializeContainer("login")
 
     query = """
         SELECT c.userId, c.user_type, c.password
@@ -125,21 +319,144 @@ def login(username, password):
 ## Chatbot Functions
 ################
     
-def addMessage(user_id, session_id, role, content):
-    if not userIsValid(user_id):
-        raise ValueError("This user does not exist")
-    
-    message = {
+# seq of the last message written by this instance per session, so a turn does not read the session document
+# first. A stale value (another instance wrote to the session since) only costs a failed batch and a retry
+_session_sequences = OrderedDict()
+_session_sequences_lock = threading.Lock()
+SESSION_SEQUENCE_CACHE_SIZE = 1024
+SESSION_SEQUENCE_RETRIES = 5
+
+def cachedSequence(session_id):
+    with _session_sequences_lock:
+        return _session_sequences.get(session_id)
+
+def rememberSequence(session_id, last_seq):
+    with _session_sequences_lock:
+        _session_sequences[session_id] = last_seq
+        _session_sequences.move_to_end(session_id)
+        while len(_session_sequences) > SESSION_SEQUENCE_CACHE_SIZE:
+            _session_sequences.popitem(last=False)
+
+def forgetSequence(session_id):
+    with _session_sequences_lock:
+        _session_sequences.pop(session_id, None)
+
+def legacySequence(sent_at):
+    #sequence number of a message stored before seq existed, from its sentAt in microseconds
+    try:
+        return int(datetime.fromisoformat(sent_at).timestamp() * 1_000_000)
+    except (TypeError, ValueError):
+        return 0
+
+def messageOrder(message):
+    seq = message.get("seq")
+    return (seq if seq is not None else legacySequence(message.get("sentAt")), message.get("id") or "")
+
+def orderMessages(messages):
+    #messages of a session in conversation order. Messages stored before sequence numbers have no seq and are
+    #ordered by their sentAt, so the order is applied here instead of in the query
+    return sorted(messages, key=messageOrder)
+
+def storedSequence(session, messages=()):
+    #last seq of a session: its lastSeq counter or, for sessions created before the counter, the highest
+    #sequence of its messages (the clock based seq or sentAt of older messages) so new messages sort after them
+    if session.get("lastSeq") is not None:
+        return session["lastSeq"]
+    return max((messageOrder(message)[0] for message in messages), default=0)
+
+def sequenceCondition(last_seq, counted=True):
+    #filter predicate of the counter patch: the batch fails with 412 when another writer moved the counter
+    if not counted:
+        return "FROM c WHERE NOT IS_DEFINED(c.lastSeq)"
+    return f"FROM c WHERE c.lastSeq = {int(last_seq)}"
+
+def messageBatch(session_id, last_seq, documents, counted=True):
+    #operations of one transactional batch: the patch moving the session counter forward, then the creation of
+    #the documents numbered after last_seq. Returns (operations, numbered documents)
+    numbered = [dict(document, seq=last_seq + position) for position, document in enumerate(documents, start=1)]
+    counter = (
+        "patch",
+        (session_id, [{"op": "set", "path": "/lastSeq", "value": last_seq + len(documents)}]),
+        {"filter_predicate": sequenceCondition(last_seq, counted)}
+    )
+    return [counter] + [("create", (document,)) for document in numbered], numbered
+
+def isSequenceConflict(error):
+    #the counter patch (first operation of the batch) failed its filter predicate
+    return error.error_index == 0 and error.status_code == 412
+
+def buildMessage(user_id, session_id, role, content):
+    #the seq of the message is assigned when it is written (see writeMessages)
+    return {
         "id": str(uuid.uuid4()),  # unique per document
         "userId": user_id,        # partition key
         "sessionId": session_id,
         "documentType": "message",
         "role": role,             # "user" or "assistant"
         "content": content,
+        "tokenCount": Tokens.messageTokens({"role": role, "content": content}),
         "sentAt": datetime.now(timezone.utc).isoformat()
     }
-    container = initializeContainer()
-    container.create_item(body=message)
+
+def buildMessages(user_id, session_id, messages):
+    #messages: list of (role, content) -> message documents, in the given order
+    return [buildMessage(user_id, session_id, role, content) for role, content in messages]
+
+def readSequence(container, user_id, session_id):
+    #(last seq, whether the session document has the lastSeq counter) read from Cosmos DB
+    session = container.read_item(item=session_id, partition_key=user_id)
+    if session.get("lastSeq") is not None:
+        return session["lastSeq"], True
+    query, parameters = messagesQuery(session_id)
+    messages = container.query_items(query=query, parameters=parameters, partition_key=user_id)
+    return storedSequence(session, messages), False
+
+def writeMessages(container, user_id, documents):
+    #Creates the message documents of one session with transactional batches (a single batch for a chat turn).
+    #Each batch also moves the lastSeq counter of the session forward, so the documents are numbered after
+    #every message already stored; if another writer moved the counter first the batch is retried.
+    #The documents are numbered in place once written, so a retried call skips them.
+    pending = [document for document in documents if document.get("seq") is None]
+    for i in range(0, len(pending), COSMO_DB_BATCH_SIZE - 1):
+        batch = pending[i:i + COSMO_DB_BATCH_SIZE - 1]
+        session_id = batch[0]["sessionId"]
+        for attempt in range(SESSION_SEQUENCE_RETRIES + 1):
+            last_seq, counted = cachedSequence(session_id), True
+            if last_seq is None:
+                last_seq, counted = readSequence(container, user_id, session_id)
+            operations, numbered = messageBatch(session_id, last_seq, batch, counted)
+            try:
+                container.execute_item_batch(batch_operations=operations, partition_key=user_id)
+                break
+            except CosmosBatchOperationError as error:
+                forgetSequence(session_id)
+                if not isSequenceConflict(error) or attempt == SESSION_SEQUENCE_RETRIES:
+                    raise
+                Metrics.increment("cosmos.sequence_conflicts")
+        rememberSequence(session_id, numbered[-1]["seq"])
+        for document, stored in zip(batch, numbered):
+            document["seq"] = stored["seq"]
+    Metrics.increment("cosmos.message_batches")
+
+def addMessages(user_id, session_id, messages, write_behind=None):
+    #Stores the messages [(role, content), ...] of a session in one transactional batch, in the given order.
+    #With write_behind (MESSAGE_WRITE_BEHIND by default) the batch is queued to the MessageWriter and written
+    #in the background. Returns the message documents.
+    if not userIsValid(user_id):
+        raise ValueError("This user does not exist")
+
+    if write_behind is None:
+        write_behind = MESSAGE_WRITE_BEHIND
+
+    documents = buildMessages(user_id, session_id, messages)
+    if write_behind:
+        getMessageWriter().submit(user_id, session_id, documents)
+    else:
+        writeMessages(initializeContainer("addMessages"), user_id, documents)
+    return documents
+
+def addMessage(user_id, session_id, role, content):
+    addMessages(user_id, session_id, [(role, content)], write_behind=False)
 
 def addSession(user_id, session_title):
     if not userIsValid(user_id):
@@ -151,9 +468,10 @@ def addSession(user_id, session_title):
         "userId": user_id,
         "documentType": "session",
         "sessionTitle": session_title,
-        "createdAt": datetime.now(timezone.utc).isoformat()
+        "createdAt": datetime.now(timezone.utc).isoformat(),
+        "lastSeq": 0  # seq of the last message of the session, see writeMessages
     }
-    container = initializeContainer()
+    container = initializeContainer("addSession")
     container.create_item(body=session)
     return session_id
 
@@ -170,7 +488,7 @@ def getSessions(user_id):
             ORDER BY c.createdAt DESC
         """
     
-    container = initializeContainer()    
+    container = initializeContainer("getSessions")    
     sessions = list(container.query_items(
         query=query,
         partition_key=user_id  
@@ -190,32 +508,49 @@ def getMessages(user_id, session_id):
     if not userIsValid(user_id):
         raise ValueError("This user does not exist")
     
+    _message_writer.waitForSession(session_id)
+    query, parameters = messagesQuery(session_id)
+    container = initializeContainer("getMessages")
+    messages = list(container.query_items(
+        query=query,
+        parameters=parameters,
+        partition_key=user_id  #since the partition key is userId, the query will only search within the user's documents
+        ))
+    return [{"role": message["role"], "content": message["content"]} for message in orderMessages(messages)]
+
+def messagesQuery(session_id):
     query = """
-            SELECT c.role, c.content 
+            SELECT c.id, c.role, c.content, c.seq, c.sentAt
             FROM c 
             WHERE c.documentType="message" AND c.sessionId=@sessionId
-            ORDER BY c.sentAt ASC
         """
         
     parameters = [
         {"name": "@sessionId", "value": session_id}
     ]
-    
-    container = initializeContainer()
+    return query, parameters
+
+def getMessagesAfter(user_id, session_id, after_seq=None, after_sent_at=None):
+    #returns the stored message documents (id, role, content, tokenCount, seq, sentAt) of a session after the
+    #message numbered after_seq (or, for checkpoints written before sequence numbers, sent after after_sent_at)
+    #used to load the tail of the conversation that is not covered by the summary checkpoint
+
+    if not userIsValid(user_id):
+        raise ValueError("This user does not exist")
+
+    _message_writer.waitForSession(session_id)
+    query, parameters = messagesAfterQuery(session_id, after_seq, after_sent_at)
+    container = initializeContainer("getMessagesAfter")
     messages = list(container.query_items(
         query=query,
         parameters=parameters,
-        partition_key=user_id  #since the partition key is userId, the query will only search within the user's documents
+        partition_key=user_id
         ))
-    return messages
+    return orderMessages(messages)
 
-def deleteSession(user_id, session_id):
-    if not userIsValid(user_id):
-        raise ValueError("This user does not exist")
-    
-    # Delete all messages associated with the session
-    query_messages = """
-            SELECT c.id 
+def messagesAfterQuery(session_id, after_seq=None, after_sent_at=None):
+    query = """
+            SELECT c.id, c.role, c.content, c.tokenCount, c.seq, c.sentAt
             FROM c 
             WHERE c.documentType="message" AND c.sessionId=@sessionId
         """
@@ -223,24 +558,165 @@ def deleteSession(user_id, session_id):
         {"name": "@sessionId", "value": session_id}
     ]
 
-    container = initializeContainer()
-    messages = list(container.query_items(
-        query=query_messages,
-        parameters=parameters,
-        partition_key=user_id
-        ))
-    
-    for message in messages:
-        container.delete_item(item=message['id'], partition_key=user_id)
-    
-    # Delete the session itself
-    container.delete_item(item=session_id, partition_key=user_id)
+    if after_seq is not None:
+        query += " AND c.seq > @afterSeq"
+        parameters.append({"name": "@afterSeq", "value": after_seq})
+    elif after_sent_at is not None:
+        query += " AND c.sentAt > @afterSentAt"
+        parameters.append({"name": "@afterSentAt", "value": after_sent_at})
+    return query, parameters
 
-def clearSession(user_id, session_id):
-    if not userIsValid(user_id):
-        raise ValueError("This user does not exist")
-    
-    # Delete all messages associated with the session
+##################
+## Message Writer
+################
+
+class MessageWriter:
+    """
+    Write-behind queue for addMessages. A background thread writes every queued batch with writeMessages,
+    retrying failed batches a few times. Reads of a session wait for its pending batches (waitForSession)
+    so a new turn always sees the messages of the previous one.
+    """
+    def __init__(self, max_retries=3):
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._pending = {}  # session_id -> number of queued batches
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, user_id, session_id, documents):
+        with self._condition:
+            self._pending[session_id] = self._pending.get(session_id, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="MessageWriter", daemon=True)
+                self._thread.start()
+        self._queue.put((user_id, session_id, documents))
+
+    def waitForSession(self, session_id, timeout=10.0):
+        #blocks until the queued batches of session_id are written, returns False on timeout
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending.get(session_id), timeout)
+
+    def pendingSessions(self):
+        with self._condition:
+            return [session_id for session_id, count in self._pending.items() if count]
+
+    def flush(self, timeout=10.0):
+        #blocks until every queued batch is written, returns False on timeout
+        with self._condition:
+            return self._condition.wait_for(lambda: not any(self._pending.values()), timeout)
+
+    def _run(self):
+        while True:
+            user_id, session_id, documents = self._queue.get()
+            for attempt in range(self.max_retries + 1):
+                try:
+                    writeMessages(initializeContainer("MessageWriter"), user_id, documents)
+                    break
+                except Exception:
+                    if attempt == self.max_retries:
+                        logging.exception("Dropping %s messages of session %s after %s attempts", len(documents), session_id, attempt + 1)
+                        Metrics.increment("cosmos.message_batches_dropped")
+                    else:
+                        time.sleep(0.1 * 2 ** attempt)
+            with self._condition:
+                self._pending[session_id] -= 1
+                if not self._pending[session_id]:
+                    del self._pending[session_id]
+                self._condition.notify_all()
+
+
+_message_writer = MessageWriter()
+atexit.register(_message_writer.flush)
+
+def getMessageWriter():
+    return _message_writer
+
+##################
+## Summary Checkpoints
+################
+# A session has at most one rolling summary document. It holds the summary of every message
+# up to and including lastMessageId, so the chat context is the summary plus the messages after it.
+
+def summaryId(session_id):
+    return f"{session_id}-summary"
+
+def getSummaryCheckpoint(user_id, session_id):
+    #returns the summary checkpoint document of the session or None if it was never summarized
+    container = initializeContainer("getSummaryCheckpoint")
+    try:
+        return container.read_item(item=summaryId(session_id), partition_key=user_id)
+    except CosmosResourceNotFoundError:
+        return None
+
+def buildSummaryCheckpoint(user_id, session_id, summary, last_message_id, last_message_sent_at, token_count, last_message_seq=None):
+    return {
+        "id": summaryId(session_id),
+        "userId": user_id,
+        "sessionId": session_id,
+        "documentType": "summary",
+        "summary": summary,
+        "lastMessageId": last_message_id,
+        "lastSeq": last_message_seq,
+        "lastSentAt": last_message_sent_at,
+        "tokenCount": token_count,
+        "updatedAt": datetime.now(timezone.utc).isoformat()
+    }
+
+def saveSummaryCheckpoint(user_id, session_id, summary, last_message_id, last_message_sent_at, token_count, last_message_seq=None):
+    checkpoint = buildSummaryCheckpoint(user_id, session_id, summary, last_message_id, last_message_sent_at, token_count, last_message_seq)
+    container = initializeContainer("saveSummaryCheckpoint")
+    container.upsert_item(body=checkpoint)
+    return checkpoint
+
+def _deleteSummaryCheckpoint(container, user_id, session_id):
+    #returns True if the session had a summary checkpoint
+    try:
+        container.delete_item(item=summaryId(session_id), partition_key=user_id)
+        return True
+    except CosmosResourceNotFoundError:
+        return False
+
+##################
+## Bulk Deletes
+################
+
+def _deleteBatch(container, partition_key, ids):
+    #deletes ids with one transactional batch and returns the number of deleted items.
+    #A batch fails as a whole if one of its items is already gone, the items are then deleted one by one
+    try:
+        container.execute_item_batch(
+            batch_operations=[("delete", (item_id,)) for item_id in ids],
+            partition_key=partition_key
+        )
+        return len(ids)
+    except CosmosBatchOperationError:
+        deleted = 0
+        for item_id in ids:
+            try:
+                container.delete_item(item=item_id, partition_key=partition_key)
+                deleted += 1
+            except CosmosResourceNotFoundError:
+                pass
+        return deleted
+
+def deleteItems(container, partition_key, ids, batch_size=COSMO_DB_BATCH_SIZE, concurrency=COSMO_DB_DELETE_CONCURRENCY):
+    #Deletes every id of one partition in transactional batches of batch_size, at most concurrency batches at a time.
+    #Returns the number of deleted items
+    if not ids:
+        return 0
+
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    with Metrics.timer("cosmos.bulk_delete"):
+        if len(batches) == 1 or concurrency <= 1:
+            deleted = sum(_deleteBatch(container, partition_key, batch) for batch in batches)
+        else:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as executor:
+                deleted = sum(executor.map(lambda batch: _deleteBatch(container, partition_key, batch), batches))
+    Metrics.increment("cosmos.deleted_items", deleted)
+    return deleted
+
+def _deleteSessionMessages(container, user_id, session_id):
+    # Delete all messages associated with the session, returns how many were deleted
     query_messages = """
             SELECT c.id 
             FROM c 
@@ -249,15 +725,40 @@ def clearSession(user_id, session_id):
     parameters = [
         {"name": "@sessionId", "value": session_id}
     ]
-    container = initializeContainer()
     messages = list(container.query_items(
         query=query_messages,
         parameters=parameters,
         partition_key=user_id
         ))
+    return deleteItems(container, user_id, [message['id'] for message in messages])
+
+def deleteSession(user_id, session_id):
+    # Returns {"deleted": number of deleted documents, "duration_ms": ...}
+    if not userIsValid(user_id):
+        raise ValueError("This user does not exist")
+
+    started_at = time.perf_counter()
+    _message_writer.waitForSession(session_id)
+    container = initializeContainer("deleteSession")
+    deleted = _deleteSessionMessages(container, user_id, session_id)
+    deleted += _deleteSummaryCheckpoint(container, user_id, session_id)
     
-    for message in messages:
-        container.delete_item(item=message['id'], partition_key=user_id)
+    # Delete the session itself
+    container.delete_item(item=session_id, partition_key=user_id)
+    forgetSequence(session_id)
+    deleted += 1
+
+    return {"deleted": deleted, "duration_ms": round((time.perf_counter() - started_at) * 1000, 1)}
 
+def clearSession(user_id, session_id):
+    # Returns {"deleted": number of deleted documents, "duration_ms": ...}
+    if not userIsValid(user_id):
+        raise ValueError("This user does not exist")
 
+    started_at = time.perf_counter()
+    _message_writer.waitForSession(session_id)
+    container = initializeContainer("clearSession")
+    deleted = _deleteSessionMessages(container, user_id, session_id)
+    deleted += _deleteSummaryCheckpoint(container, user_id, session_id)
 
+    return {"deleted": deleted, "duration_ms": round((time.perf_counter() - started_at) * 1000, 1)}
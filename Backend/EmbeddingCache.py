@@ -0,0 +1,201 @@
+#################
+# Cache of query embeddings keyed by the normalized query text and the embedding deployment.
+# Entries are bounded by an LRU and a TTL, vectors are kept as float32 arrays and can optionally be
+# persisted to a local sqlite file (EMBEDDING_CACHE_PATH) so a warm worker does not re-embed repeated questions.
+################
+from collections import OrderedDict
+from array import array
+import threading
+import hashlib
+import asyncio
+import sqlite3
+import time
+import re
+import os
+
+import Metrics
+
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "2048"))
+EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")  # eg: /tmp/embedding_cache.sqlite, disabled when empty
+
+
+def normalizeText(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def cacheKey(text, deployment):
+    return hashlib.sha256(f"{deployment}\n{normalizeText(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=EMBEDDING_CACHE_MAX_ENTRIES, ttl_seconds=EMBEDDING_CACHE_TTL_SECONDS, path=EMBEDDING_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (created_at, array("f"))
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._miss_ms = 0.0  # time spent computing the embeddings that were missing
+        self._saved_ms = 0.0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, created_at REAL)")
+            self._db.commit()
+
+    ##############
+    # Lookups
+    ##############
+    def get(self, text, deployment):
+        #returns the cached vector as a list of floats or None
+        key = cacheKey(text, deployment)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None and self._db is not None:
+                entry = self._readPersisted(key, now)
+                if entry is not None:
+                    self._store(key, entry)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1].tolist()
+
+    def put(self, text, deployment, vector):
+        key = cacheKey(text, deployment)
+        entry = (time.time(), array("f", vector))
+        with self._lock:
+            self._store(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                    (key, entry[1].tobytes(), entry[0])
+                )
+                self._db.commit()
+
+    def getOrCreate(self, text, deployment, embed):
+        #returns the cached embedding of text, calling embed(text) and caching its result on a miss
+        vector = self.get(text, deployment)
+        if vector is not None:
+            self._recordHit()
+            return vector
+
+        started_at = time.perf_counter()
+        vector = embed(text)
+        self._recordMiss(text, deployment, vector, started_at)
+        return vector
+
+    async def getOrCreateAsync(self, text, deployment, embed):
+        #same as getOrCreate for a coroutine function embed. With a sqlite file the lookup and the write
+        #run in a worker thread, so the event loop is not blocked by the disk
+        persisted = self._db is not None
+        vector = await asyncio.to_thread(self.get, text, deployment) if persisted else self.get(text, deployment)
+        if vector is not None:
+            self._recordHit()
+            return vector
+
+        started_at = time.perf_counter()
+        vector = await embed(text)
+        if persisted:
+            await asyncio.to_thread(self._recordMiss, text, deployment, vector, started_at)
+        else:
+            self._recordMiss(text, deployment, vector, started_at)
+        return vector
+
+    def _recordHit(self):
+        with self._lock:
+            self._hits += 1
+            saved_ms = self._miss_ms / self._misses if self._misses else 0.0
+            self._saved_ms += saved_ms
+        Metrics.increment("embeddingCache.hits")
+        Metrics.increment("embeddingCache.saved_ms", saved_ms)
+
+    def _recordMiss(self, text, deployment, vector, started_at):
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        with self._lock:
+            self._misses += 1
+            self._miss_ms += elapsed_ms
+        Metrics.increment("embeddingCache.misses")
+        self.put(text, deployment, vector)
+
+    ##############
+    # Internals
+    ##############
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _readPersisted(self, key, now):
+        row = self._db.execute("SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl_seconds:
+            self._db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            self._db.commit()
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return (row[1], vector)
+
+    ##############
+    # Stats
+    ##############
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "avg_miss_ms": self._miss_ms / self._misses if self._misses else 0.0,
+                "saved_ms": self._saved_ms
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def getCache():
+    #process-wide cache, created on first use
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
+
+def embedQuery(openai_client, text, deployment):
+    #embedding of a search query, served from the cache when the same question was embedded before
+    def embed(value):
+        return openai_client.embeddings.create(input=value, model=deployment).data[0].embedding
+
+    return getCache().getOrCreate(text, deployment, embed)
+
+async def embedQueryAsync(openai_client, text, deployment):
+    #embedQuery for an AsyncAzureOpenAI client
+    async def embed(value):
+        response = await openai_client.embeddings.create(input=value, model=deployment)
+        return response.data[0].embedding
+
+    return await getCache().getOrCreateAsync(text, deployment, embed)
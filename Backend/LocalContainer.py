@@ -0,0 +1,216 @@
+#################
+# In-memory stand-in for the Cosmos DB conversations container.
+# It implements the subset of the ContainerProxy API and of the Cosmos SQL dialect that Database.py uses,
+# so the Database functions can run against it in tests and benchmarks:
+#
+#   import Database, LocalContainer
+#   Database.setContainerProvider(LocalContainer.InMemoryContainerProvider())
+################
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError, CosmosBatchOperationError
+
+import copy
+import re
+import threading
+
+_SELECT_PATTERN = re.compile(
+    r"^\s*SELECT\s+(?P<projection>.+?)\s+FROM\s+c"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?"
+    r"(?:\s+ORDER\s+BY\s+c\.(?P<order_field>\w+)(?:\s+(?P<order_dir>ASC|DESC))?)?\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+_CONDITION_PATTERN = re.compile(r"^\s*c\.(?P<field>\w+)\s*(?P<op>!=|>=|<=|=|>|<)\s*(?P<value>.+?)\s*$", re.DOTALL)
+_DEFINED_PATTERN = re.compile(r"^\s*(?P<negated>NOT\s+)?IS_DEFINED\(\s*c\.(?P<field>\w+)\s*\)\s*$", re.IGNORECASE)
+_PREDICATE_PATTERN = re.compile(r"^\s*FROM\s+c\s+WHERE\s+(?P<where>.+?)\s*$", re.IGNORECASE | re.DOTALL)
+
+
+def _parseLiteral(token, parameters):
+    token = token.strip()
+    if token.startswith("@"):
+        return parameters[token]
+    if token[0] in "\"'" and token[-1] == token[0]:
+        return token[1:-1]
+    if token.lower() in ("true", "false"):
+        return token.lower() == "true"
+    if token.lower() == "null":
+        return None
+    return float(token) if "." in token else int(token)
+
+def _compare(left, op, right):
+    if op == "=":
+        return left == right
+    if op == "!=":
+        return left != right
+    if left is None or right is None:
+        return False
+    if op == ">=":
+        return left >= right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    return left < right
+
+def _parseConditions(where, parameters):
+    #WHERE clause -> list of item predicates, supports comparisons and IS_DEFINED joined with AND
+    conditions = []
+    for clause in re.split(r"\s+AND\s+", where, flags=re.IGNORECASE):
+        defined = _DEFINED_PATTERN.match(clause)
+        if defined is not None:
+            negated = defined.group("negated") is not None
+            conditions.append(lambda item, f=defined.group("field"), n=negated: (f in item) != n)
+            continue
+        condition = _CONDITION_PATTERN.match(clause)
+        if condition is None:
+            raise ValueError(f"Unsupported condition for the in-memory container: {clause}")
+        field, op, value = condition.group("field"), condition.group("op"), _parseLiteral(condition.group("value"), parameters)
+        conditions.append(lambda item, f=field, o=op, v=value: _compare(item.get(f), o, v))
+    return conditions
+
+def _applyPatch(item, operations):
+    #patch operations on top level fields: set, add, replace, remove and incr
+    patched = copy.deepcopy(item)
+    for operation in operations:
+        field = operation["path"].lstrip("/")
+        if operation["op"] in ("set", "add", "replace"):
+            patched[field] = copy.deepcopy(operation["value"])
+        elif operation["op"] == "remove":
+            patched.pop(field, None)
+        elif operation["op"] == "incr":
+            patched[field] = patched.get(field, 0) + operation["value"]
+        else:
+            raise ValueError(f"Unsupported patch operation for the in-memory container: {operation['op']}")
+    return patched
+
+
+class InMemoryContainer:
+    def __init__(self, partition_key_path="userId"):
+        self.partition_key_path = partition_key_path
+        self._items = {}  # (partition_key, id) -> item
+        self._lock = threading.Lock()
+
+    ##############
+    # Point operations
+    ##############
+    def create_item(self, body, **kwargs):
+        key = (body.get(self.partition_key_path), body["id"])
+        with self._lock:
+            if key in self._items:
+                raise CosmosResourceExistsError(status_code=409, message=f"Entity with id {body['id']} already exists")
+            self._items[key] = copy.deepcopy(body)
+        return copy.deepcopy(body)
+
+    def upsert_item(self, body, **kwargs):
+        key = (body.get(self.partition_key_path), body["id"])
+        with self._lock:
+            self._items[key] = copy.deepcopy(body)
+        return copy.deepcopy(body)
+
+    def read_item(self, item, partition_key, **kwargs):
+        with self._lock:
+            found = self._items.get((partition_key, item))
+        if found is None:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Entity with id {item} does not exist")
+        return copy.deepcopy(found)
+
+    def delete_item(self, item, partition_key, **kwargs):
+        with self._lock:
+            if self._items.pop((partition_key, item), None) is None:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Entity with id {item} does not exist")
+
+    ##############
+    # Transactional batch
+    ##############
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        #supports the create, upsert, read, delete and patch operations (with filter_predicate). Like Cosmos DB,
+        #either every operation is applied or none is, and the index of the first failing operation is reported
+        with self._lock:
+            staged = dict(self._items)
+            responses = []
+            for index, (operation, args, *options) in enumerate(batch_operations):
+                body = args[0]
+                item_id = body["id"] if isinstance(body, dict) else body
+                key = (partition_key, item_id)
+                status_code = {"create": 201, "upsert": 200, "read": 200, "delete": 204, "patch": 200}[operation.lower()]
+                if operation.lower() == "create" and key in staged:
+                    status_code = 409
+                elif operation.lower() in ("read", "delete", "patch") and key not in staged:
+                    status_code = 404
+                elif operation.lower() == "patch" and not self._matchesPredicate(staged[key], (options or [{}])[0]):
+                    status_code = 412
+
+                if status_code >= 400:
+                    raise CosmosBatchOperationError(
+                        error_index=index,
+                        headers={},
+                        status_code=status_code,
+                        message=f"Batch operation {index} ({operation} {item_id}) failed with status {status_code}",
+                        operation_responses=responses + [{"statusCode": status_code}]
+                    )
+
+                if operation.lower() in ("create", "upsert"):
+                    staged[key] = copy.deepcopy(body)
+                elif operation.lower() == "delete":
+                    del staged[key]
+                elif operation.lower() == "patch":
+                    staged[key] = _applyPatch(staged[key], args[1])
+                responses.append({
+                    "statusCode": status_code,
+                    "resourceBody": copy.deepcopy(staged[key]) if key in staged else None
+                })
+            self._items = staged
+        return responses
+
+    @staticmethod
+    def _matchesPredicate(item, options):
+        predicate = options.get("filter_predicate")
+        if predicate is None:
+            return True
+        match = _PREDICATE_PATTERN.match(predicate)
+        if match is None:
+            raise ValueError(f"Unsupported filter predicate for the in-memory container: {predicate}")
+        return all(condition(item) for condition in _parseConditions(match.group("where"), {}))
+
+    ##############
+    # Queries
+    ##############
+    def query_items(self, query, parameters=None, partition_key=None, enable_cross_partition_query=False, **kwargs):
+        match = _SELECT_PATTERN.match(query)
+        if match is None:
+            raise ValueError(f"Unsupported query for the in-memory container: {query}")
+        params = {p["name"]: p["value"] for p in (parameters or [])}
+
+        conditions = _parseConditions(match.group("where"), params) if match.group("where") else []
+
+        with self._lock:
+            items = [
+                item for (pk, _), item in self._items.items()
+                if partition_key is None or pk == partition_key
+            ]
+        results = [item for item in items if all(condition(item) for condition in conditions)]
+
+        if match.group("order_field"):
+            field = match.group("order_field")
+            descending = (match.group("order_dir") or "ASC").upper() == "DESC"
+            results.sort(key=lambda item: (item.get(field) is not None, item.get(field)), reverse=descending)
+
+        projection = match.group("projection").strip()
+        if projection == "*":
+            return iter(copy.deepcopy(results))
+        fields = [f.strip()[2:] for f in projection.split(",")]
+        return iter([{f: item[f] for f in fields if f in item} for item in results])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class InMemoryContainerProvider:
+    # Same interface as Database.ContainerProvider
+    def __init__(self, container=None):
+        self.container = container or InMemoryContainer()
+
+    def getContainer(self):
+        return self.container
+
+    def close(self):
+        pass
@@ -0,0 +1,741 @@
+#################
+# Embedded retrieval backend for small knowledge bases.
+# LocalSearchIndex keeps the chunks of an AI Search index in process: the vectors in NumPy float32 matrices
+# (exact cosine search), the searchable text in a BM25 inverted index, and hybrid queries are ranked with
+# reciprocal rank fusion like AI Search. It exposes the subset of SearchClient used by Chatbot and AISearch
+# (search with search_text, filter, select, top, skip, order_by and vector_queries, and upload_documents), so it can
+# replace the SearchClient of hybridSearch with SEARCH_BACKEND=local.
+#
+# Snapshots (LOCAL_SEARCH_SNAPSHOT_PATH/<index_name>/) hold one .npy matrix per vector field, loaded memory-mapped,
+# and the other fields in documents.json. They are exported from the Azure index with exportSnapshot
+# (python LocalSearch.py export <index_name>) and kept in sync by AISearch on addDocuments/deleteDocument:
+# every batch is appended to changes.jsonl next to the snapshot, which is only rewritten once the log
+# reaches LOCAL_SEARCH_COMPACT_BYTES.
+################
+import threading
+import logging
+import shutil
+import math
+import json
+import time
+import re
+import os
+
+import numpy as np
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "azure").lower() #azure or local
+LOCAL_SEARCH_SNAPSHOT_PATH = os.getenv("LOCAL_SEARCH_SNAPSHOT_PATH", "")
+LOCAL_SEARCH_RELOAD_INTERVAL = float(os.getenv("LOCAL_SEARCH_RELOAD_INTERVAL", "30")) #seconds between checks for a snapshot written by another worker
+LOCAL_SEARCH_COMPACT_BYTES = int(os.getenv("LOCAL_SEARCH_COMPACT_BYTES", str(64 * 1024 * 1024))) #size of the change log that triggers a new snapshot
+
+AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60 #rank constant of reciprocal rank fusion, same as AI Search
+DEFAULT_TOP = 50
+
+_SNAPSHOT_DOCUMENTS = "documents.json"
+_SNAPSHOT_META = "meta.json"
+_SNAPSHOT_CHANGES = "changes.jsonl"
+
+
+def tokenize(text):
+    return re.findall(r"\w+", str(text or "").lower())
+
+####################
+## Filters
+####################
+# The OData subset used by the backend: comparisons (eq, ne, gt, ge, lt, le) of a field with a string, number,
+# boolean or null, combined with and, or, not and parentheses.
+_FILTER_TOKEN = re.compile(r"\s*(\(|\)|'(?:[^']|'')*'|[^\s()]+)")
+_COMPARISONS = {
+    "eq": lambda a, b: a == b,
+    "ne": lambda a, b: a != b,
+    "gt": lambda a, b: a > b,
+    "ge": lambda a, b: a >= b,
+    "lt": lambda a, b: a < b,
+    "le": lambda a, b: a <= b,
+}
+
+def _literal(token):
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    lowered = token.lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    if lowered == "null":
+        return None
+    try:
+        return float(token)
+    except ValueError:
+        raise ValueError(f"Unsupported value in filter: {token}")
+
+def _compare(operator, value, literal):
+    if value is None or literal is None:
+        return operator == "eq" and value is literal or operator == "ne" and value is not literal
+    if isinstance(literal, float) and not isinstance(value, bool):
+        try:
+            value = float(value) #numbers stored as strings (eg: chunk_index) are compared as numbers
+        except (TypeError, ValueError):
+            return operator == "ne"
+    elif isinstance(literal, str):
+        value = str(value)
+    try:
+        return _COMPARISONS[operator](value, literal)
+    except TypeError:
+        return False
+
+def parseFilter(search_filter):
+    #returns a predicate over a document dict
+    tokens = _FILTER_TOKEN.findall(search_filter)
+    position = 0
+
+    def peek():
+        return tokens[position].lower() if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError(f"Unexpected end of filter: {search_filter}")
+        position += 1
+        return tokens[position - 1]
+
+    def parseOr():
+        predicates = [parseAnd()]
+        while peek() == "or":
+            take()
+            predicates.append(parseAnd())
+        return predicates[0] if len(predicates) == 1 else lambda doc: any(p(doc) for p in predicates)
+
+    def parseAnd():
+        predicates = [parseNot()]
+        while peek() == "and":
+            take()
+            predicates.append(parseNot())
+        return predicates[0] if len(predicates) == 1 else lambda doc: all(p(doc) for p in predicates)
+
+    def parseNot():
+        if peek() == "not":
+            take()
+            predicate = parseNot()
+            return lambda doc: not predicate(doc)
+        if peek() == "(":
+            take()
+            predicate = parseOr()
+            if take() != ")":
+                raise ValueError(f"Missing closing parenthesis in filter: {search_filter}")
+            return predicate
+        field, operator, literal = take(), take().lower(), _literal(take())
+        if operator not in _COMPARISONS:
+            raise ValueError(f"Unsupported operator in filter: {operator}")
+        return lambda doc: _compare(operator, doc.get(field), literal)
+
+    predicate = parseOr()
+    if position != len(tokens):
+        raise ValueError(f"Unsupported filter: {search_filter}")
+    return predicate
+
+####################
+## Sorting
+####################
+# $orderby: comma separated "<field> [asc|desc]" clauses, search.score() sorts on the score of the result
+_ORDER_CLAUSE = re.compile(r"^\s*(?P<field>search\.score\(\)|\w+)(?:\s+(?P<direction>asc|desc))?\s*$", re.IGNORECASE)
+
+def parseOrderBy(order_by):
+    #list of (field, descending) from the order_by argument of search (a list of clauses or a comma separated string)
+    clauses = order_by.split(",") if isinstance(order_by, str) else list(order_by)
+    parsed = []
+    for clause in clauses:
+        match = _ORDER_CLAUSE.match(clause)
+        if match is None:
+            raise ValueError(f"Unsupported order_by clause: {clause}")
+        parsed.append((match.group("field"), (match.group("direction") or "asc").lower() == "desc"))
+    return parsed
+
+def _sortValue(value):
+    #like AI Search, null sorts before any value in ascending order
+    return (value is not None, value)
+
+####################
+## Index
+####################
+class SearchResults(list):
+    #list of results with the get_count() of the SearchClient result pages
+    def __init__(self, results, count=None):
+        super().__init__(results)
+        self._count = count
+
+    def get_count(self):
+        return self._count
+
+
+class LocalSearchIndex:
+    """
+    In-process index of the chunks of an AI Search index.
+    Documents are stored by row: deleted rows are tombstoned and reclaimed by compact(), vector matrices grow
+    by doubling. Vector search is exact (exhaustive) cosine similarity, keyword search is BM25 over text_fields.
+    """
+    def __init__(self, key_field="chunk_id", text_fields=("chunk",), vector_fields=("content_vector",)):
+        self.key_field = key_field
+        self.text_fields = tuple(text_fields)
+        self.vector_fields = list(vector_fields)
+        self._lock = threading.RLock()
+        self._documents = []  # row -> document without its vectors, None once deleted
+        self._rows = {}  # key -> row
+        self._vectors = {}  # vector field -> float32 matrix (capacity x dimensions)
+        self._norms = {}  # vector field -> norm of every row, 0 when the row has no vector
+        self._postings = {}  # term -> {row: term frequency}
+        self._lengths = np.zeros(0, dtype=np.float32)  # row -> number of terms
+        self._total_length = 0.0
+        self._count = 0  # live documents
+
+    def __len__(self):
+        return self._count
+
+    def get_document_count(self):
+        return self._count
+
+    ####################
+    ## Writes
+    ####################
+    def _reserve(self, rows):
+        #grows the row arrays to hold at least rows rows. Memory-mapped snapshot arrays are copied on the first write
+        capacity = len(self._lengths)
+        if rows <= capacity and all(isinstance(matrix, np.ndarray) and matrix.flags.writeable for matrix in self._vectors.values()):
+            return
+        capacity = max(rows, capacity * 2 if rows > capacity else capacity, 64)
+        self._lengths = _resized(self._lengths, capacity)
+        for field in list(self._vectors):
+            self._vectors[field] = _resized(self._vectors[field], capacity)
+            self._norms[field] = _resized(self._norms[field], capacity)
+
+    def _addVectorField(self, field, dimensions):
+        self._vectors[field] = np.zeros((len(self._lengths), dimensions), dtype=np.float32)
+        self._norms[field] = np.zeros(len(self._lengths), dtype=np.float32)
+        if field not in self.vector_fields:
+            self.vector_fields.append(field)
+
+    def _isVector(self, field, value):
+        return field in self.vector_fields or (field.endswith("_vector") and isinstance(value, (list, tuple, np.ndarray)))
+
+    def _unindex(self, row):
+        document = self._documents[row]
+        for term in set(self._terms(document)):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(row, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= float(self._lengths[row])
+        self._lengths[row] = 0
+        for norms in self._norms.values():
+            norms[row] = 0
+        self._documents[row] = None
+        self._count -= 1
+
+    def _terms(self, document):
+        return [term for field in self.text_fields for term in tokenize(document.get(field))]
+
+    def _write(self, document):
+        key = str(document[self.key_field])
+        previous = self._rows.get(key)
+        if previous is not None:
+            self._unindex(previous)
+
+        row = len(self._documents)
+        self._reserve(row + 1)
+        stored = {}
+        for field, value in document.items():
+            if field.startswith("@"):
+                continue
+            if value is not None and self._isVector(field, value):
+                vector = np.asarray(value, dtype=np.float32)
+                if field not in self._vectors:
+                    self._addVectorField(field, len(vector))
+                matrix = self._vectors[field]
+                if len(vector) != matrix.shape[1]:
+                    raise ValueError(f"{field} of {key} has {len(vector)} dimensions instead of {matrix.shape[1]}")
+                matrix[row] = vector
+                self._norms[field][row] = np.linalg.norm(vector)
+            else:
+                stored[field] = value
+
+        self._documents.append(stored)
+        self._rows[key] = row
+        terms = self._terms(stored)
+        for term in terms:
+            postings = self._postings.setdefault(term, {})
+            postings[row] = postings.get(row, 0) + 1
+        self._lengths[row] = len(terms)
+        self._total_length += len(terms)
+        self._count += 1
+
+    def upload_documents(self, documents):
+        #same contract as SearchClient.upload_documents: documents with "@search.action": "delete" are removed,
+        #the others are added or replace the document with the same key
+        results = []
+        with self._lock:
+            for document in documents:
+                key = document.get(self.key_field)
+                if document.get("@search.action") == "delete":
+                    row = self._rows.pop(str(key), None)
+                    if row is not None:
+                        self._unindex(row)
+                else:
+                    self._write(document)
+                results.append({"key": key, "succeeded": True})
+            if len(self._documents) > 2 * self._count + 64:
+                self.compact()
+        return results
+
+    def delete_documents(self, documents):
+        return self.upload_documents([{**document, "@search.action": "delete"} for document in documents])
+
+    def compact(self):
+        #rebuilds the index without the rows of deleted documents
+        with self._lock:
+            documents = [self.document(row) for row in range(len(self._documents)) if self._documents[row] is not None]
+            self._documents, self._rows, self._postings = [], {}, {}
+            self._lengths = np.zeros(0, dtype=np.float32)
+            self._vectors = {field: np.zeros((0, matrix.shape[1]), dtype=np.float32) for field, matrix in self._vectors.items()}
+            self._norms = {field: np.zeros(0, dtype=np.float32) for field in self._norms}
+            self._total_length, self._count = 0.0, 0
+            self._reserve(len(documents))
+            for document in documents:
+                self._write(document)
+
+    def document(self, row, fields=None):
+        #the document of a row with its vectors (as lists), restricted to fields if given
+        stored = self._documents[row]
+        document = {}
+        for field in fields or list(stored) + list(self._vectors):
+            if field in self._vectors:
+                if self._norms[field][row] > 0:
+                    document[field] = self._vectors[field][row].tolist()
+            elif field in stored:
+                document[field] = stored[field]
+        return document
+
+    ####################
+    ## Search
+    ####################
+    def _liveRows(self):
+        rows = np.zeros(len(self._documents), dtype=bool)
+        rows[list(self._rows.values())] = True
+        return rows
+
+    def _keywordRanking(self, search_text, candidates):
+        #rows matching at least one term of search_text, best BM25 score first
+        terms = set(tokenize(search_text))
+        rows_count = len(self._documents)
+        scores = np.zeros(rows_count, dtype=np.float32)
+        if not terms or self._count == 0:
+            return np.zeros(0, dtype=np.int64), scores
+
+        average_length = self._total_length / self._count or 1.0
+        lengths = self._lengths[:rows_count]
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            rows = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            frequencies = np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            idf = math.log(1 + (self._count - len(postings) + 0.5) / (len(postings) + 0.5))
+            scores[rows] += idf * frequencies * (BM25_K1 + 1) / (frequencies + BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / average_length))
+
+        matching = np.flatnonzero((scores > 0) & candidates)
+        return matching[np.argsort(-scores[matching], kind="stable")], scores
+
+    def _vectorRanking(self, vector_query, candidates):
+        #[(rows, similarities)] of the k nearest rows for every field of the vector query
+        vector = _queryAttribute(vector_query, "vector")
+        k = _queryAttribute(vector_query, "k_nearest_neighbors") or DEFAULT_TOP
+        fields = _queryAttribute(vector_query, "fields") or ",".join(self.vector_fields)
+        query = np.asarray(vector, dtype=np.float32)
+        query_norm = np.linalg.norm(query) or 1.0
+
+        rankings = []
+        rows_count = len(self._documents)
+        for field in (field.strip() for field in fields.split(",")):
+            if field not in self._vectors:
+                if field not in self.vector_fields:
+                    raise ValueError(f"{field} is not a vector field of the local index")
+                rankings.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))) #no document has it yet
+                continue
+            norms = self._norms[field][:rows_count]
+            usable = np.flatnonzero(candidates & (norms > 0))
+            if len(usable) == 0:
+                rankings.append((usable, np.zeros(0, dtype=np.float32)))
+                continue
+            similarities = (self._vectors[field][usable] @ query) / (norms[usable] * query_norm)
+            if len(usable) > k:
+                nearest = np.argpartition(-similarities, k - 1)[:k]
+            else:
+                nearest = np.arange(len(usable))
+            nearest = nearest[np.argsort(-similarities[nearest], kind="stable")]
+            rankings.append((usable[nearest], similarities[nearest]))
+        return rankings
+
+    def _sortRanked(self, ranked, order):
+        #ranked [(row, score)] sorted on the order_by clauses, the ranking breaks ties
+        for field, descending in reversed(order):
+            if field.lower() == "search.score()":
+                ranked.sort(key=lambda item: item[1], reverse=descending)
+                continue
+            if field in self._vectors or field in self.vector_fields:
+                raise ValueError(f"{field} is a vector field and cannot be sorted")
+            ranked.sort(key=lambda item: _sortValue(self._documents[item[0]].get(field)), reverse=descending)
+        return ranked
+
+    def search(self, search_text=None, filter=None, select=None, top=None, skip=None, vector_queries=None,
+               include_total_count=False, order_by=None, **kwargs):
+        #Returns SearchResults of documents with their "@search.score":
+        #keyword only: BM25 score, vector only: cosine similarity, hybrid: reciprocal rank fusion of every ranking.
+        #Other SearchClient arguments (eg: query_type, facets) are not emulated and raise a ValueError
+        if kwargs:
+            raise ValueError(f"Unsupported search arguments for the local index: {', '.join(sorted(kwargs))}")
+        top = DEFAULT_TOP if top is None else top
+        skip = skip or 0
+        fields = [field.strip() for field in select.split(",")] if isinstance(select, str) else select
+        predicate = parseFilter(filter) if filter else None
+        order = parseOrderBy(order_by) if order_by else []
+
+        with self._lock:
+            candidates = self._liveRows()
+            if predicate is not None:
+                for row in np.flatnonzero(candidates):
+                    candidates[row] = predicate(self._documents[row])
+
+            rankings = []
+            keyword_scores = None
+            if search_text and search_text.strip() != "*":
+                keyword_rows, keyword_scores = self._keywordRanking(search_text, candidates)
+                rankings.append((keyword_rows, keyword_scores[keyword_rows]))
+            for vector_query in vector_queries or []:
+                rankings.extend(self._vectorRanking(vector_query, candidates))
+
+            if not rankings:
+                #match all: documents in insertion order
+                ranked = [(row, 1.0) for row in np.flatnonzero(candidates)]
+            elif len(rankings) == 1:
+                ranked = list(zip(*rankings[0]))
+            else:
+                fused = {}
+                for rows, _ in rankings:
+                    for rank, row in enumerate(rows):
+                        fused[row] = fused.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+                ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+            if order:
+                ranked = self._sortRanked(list(ranked), order)
+
+            results = []
+            for row, score in ranked[skip:skip + top]:
+                document = self.document(int(row), fields)
+                document["@search.score"] = float(score)
+                results.append(document)
+            return SearchResults(results, len(ranked) if include_total_count else None)
+
+    def close(self):
+        pass
+
+    ####################
+    ## Snapshots
+    ####################
+    def saveSnapshot(self, path):
+        #writes the index to the directory path. Files are replaced one by one, meta.json last
+        with self._lock:
+            if len(self._documents) != self._count:
+                self.compact()
+            os.makedirs(path, exist_ok=True)
+            for field, matrix in self._vectors.items():
+                #rows without a vector are saved as zeros and left out of vector search by their zero norm
+                _replaceFile(os.path.join(path, f"{field}.npy"), lambda file: np.save(file, np.ascontiguousarray(matrix[:self._count])))
+            documents = list(self._documents)
+            _replaceFile(os.path.join(path, _SNAPSHOT_DOCUMENTS), lambda file: file.write(json.dumps(documents).encode("utf-8")))
+            meta = {
+                "key_field": self.key_field,
+                "text_fields": list(self.text_fields),
+                "vector_fields": list(self._vectors),
+                "count": self._count,
+                "saved_at": time.time()
+            }
+            _replaceFile(os.path.join(path, _SNAPSHOT_META), lambda file: file.write(json.dumps(meta).encode("utf-8")))
+
+    @classmethod
+    def loadSnapshot(cls, path, mmap=True):
+        #loads a snapshot written by saveSnapshot. With mmap the vector matrices are memory-mapped read-only
+        #(copied to memory on the first write), so workers sharing a snapshot share its pages
+        with open(os.path.join(path, _SNAPSHOT_META), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        with open(os.path.join(path, _SNAPSHOT_DOCUMENTS), "r", encoding="utf-8") as file:
+            documents = json.load(file)
+
+        index = cls(key_field=meta["key_field"], text_fields=meta["text_fields"], vector_fields=meta["vector_fields"])
+        count = len(documents)
+        index._documents = documents
+        index._rows = {str(document[index.key_field]): row for row, document in enumerate(documents)}
+        index._count = count
+        for field in meta["vector_fields"]:
+            matrix = np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r" if mmap else None)
+            if matrix.shape[0] != count:
+                raise ValueError(f"Snapshot {path} has {matrix.shape[0]} {field} rows for {count} documents")
+            index._vectors[field] = matrix
+            index._norms[field] = np.linalg.norm(matrix, axis=1).astype(np.float32)
+
+        index._lengths = np.zeros(count, dtype=np.float32)
+        for row, document in enumerate(documents):
+            terms = index._terms(document)
+            for term in terms:
+                postings = index._postings.setdefault(term, {})
+                postings[row] = postings.get(row, 0) + 1
+            index._lengths[row] = len(terms)
+        index._total_length = float(index._lengths.sum())
+        return index
+
+
+def _resized(array, rows):
+    resized = np.zeros((rows,) + array.shape[1:], dtype=array.dtype)
+    count = min(rows, array.shape[0])
+    resized[:count] = array[:count]
+    return resized
+
+def _replaceFile(path, write):
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        write(file)
+    os.replace(temporary, path)
+
+def _queryAttribute(vector_query, name):
+    #VectorizedQuery or a dict with the same keys
+    if isinstance(vector_query, dict):
+        return vector_query.get(name)
+    return getattr(vector_query, name, None)
+
+
+class _AsyncResults:
+    def __init__(self, results):
+        self._results = results
+        self._iterator = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def get_count(self):
+        return self._results.get_count()
+
+
+class AsyncLocalSearchIndex:
+    #azure.search.documents.aio interface over a LocalSearchIndex. Searches take a few milliseconds and run inline
+    def __init__(self, index):
+        self.index = index
+
+    async def search(self, **kwargs):
+        return _AsyncResults(self.index.search(**kwargs))
+
+    async def upload_documents(self, documents):
+        return self.index.upload_documents(documents)
+
+    async def close(self):
+        pass
+
+####################
+## Process-wide Indexes
+####################
+_lock = threading.Lock()
+_indexes = {}  # index_name -> {"index", "loaded_mtime", "log_inode", "log_offset", "checked_at"}
+
+
+def isEnabled():
+    return SEARCH_BACKEND == "local"
+
+def snapshotPath(index_name):
+    return os.path.join(LOCAL_SEARCH_SNAPSHOT_PATH, index_name) if LOCAL_SEARCH_SNAPSHOT_PATH else None
+
+def _snapshotMtime(index_name):
+    path = snapshotPath(index_name)
+    try:
+        return os.path.getmtime(os.path.join(path, _SNAPSHOT_META)) if path else None
+    except OSError:
+        return None
+
+def _changesPath(path, suffix=""):
+    return os.path.join(path, _SNAPSHOT_CHANGES + suffix) if path else None
+
+def _logState(index_name):
+    #(inode, size) of the change log of index_name, (None, 0) when there is none
+    try:
+        stat = os.stat(_changesPath(snapshotPath(index_name)))
+        return stat.st_ino, stat.st_size
+    except (OSError, TypeError):
+        return None, 0
+
+def _readChanges(log_path, offset=0):
+    #the batches appended to a change log after offset, and the offset after the last complete one.
+    #A batch still being appended by another worker is read on the next check
+    try:
+        with open(log_path, "rb") as file:
+            file.seek(offset)
+            data = file.read()
+    except (OSError, TypeError):
+        return [], offset
+    end = data.rfind(b"\n") + 1
+    return [json.loads(line) for line in data[:end].splitlines() if line.strip()], offset + end
+
+def _load(index_name):
+    #the snapshot of index_name with the changes logged after it
+    started_at = time.perf_counter()
+    path = snapshotPath(index_name)
+    mtime = _snapshotMtime(index_name)
+    if mtime is None:
+        logging.info("No local search snapshot for %s, starting from an empty index", index_name)
+        index = LocalSearchIndex()
+    else:
+        index = LocalSearchIndex.loadSnapshot(path)
+
+    #the log of a compaction interrupted (or still running in another worker) comes before the current log.
+    #Batches already in the snapshot are applied again, which leaves the same documents
+    for batch in _readChanges(_changesPath(path, ".compacting"))[0]:
+        index.upload_documents(batch)
+    inode, _ = _logState(index_name)
+    batches, offset = _readChanges(_changesPath(path))
+    for batch in batches:
+        index.upload_documents(batch)
+
+    logging.info("Loaded %s documents of %s (%s logged batches) in %.1f ms", len(index), index_name, len(batches), (time.perf_counter() - started_at) * 1000)
+    return {"index": index, "loaded_mtime": mtime, "log_inode": inode, "log_offset": offset}
+
+def _refresh(index_name, entry):
+    #brings a loaded index up to date with its snapshot and change log: a new snapshot is loaded again,
+    #batches appended to the log by other workers are applied. Called with _lock held
+    inode, size = _logState(index_name)
+    if _snapshotMtime(index_name) != entry["loaded_mtime"] or size < entry["log_offset"] or \
+            (entry["log_offset"] and inode != entry["log_inode"]):
+        return _load(index_name)
+    batches, entry["log_offset"] = _readChanges(_changesPath(snapshotPath(index_name)), entry["log_offset"])
+    entry["log_inode"] = inode
+    for batch in batches:
+        entry["index"].upload_documents(batch)
+    return entry
+
+def getIndex(index_name=None):
+    #Returns the process-wide LocalSearchIndex of index_name (defaults to the chatbot's index), loaded from its
+    #snapshot on first use and kept up to date with the changes written by other workers
+    index_name = index_name or AZURE_SEARCH_INDEX_NAME
+    now = time.monotonic()
+    entry = _indexes.get(index_name)
+    if entry is not None and now - entry["checked_at"] < LOCAL_SEARCH_RELOAD_INTERVAL:
+        return entry["index"]
+
+    with _lock:
+        entry = _indexes.get(index_name)
+        try:
+            entry = _load(index_name) if entry is None else _refresh(index_name, entry)
+            _indexes[index_name] = entry
+        except (OSError, ValueError):
+            if entry is None:
+                raise
+            #a snapshot being rewritten by another worker, the next check loads it
+            logging.exception("Could not reload the local search snapshot of %s", index_name)
+        entry["checked_at"] = now
+        return entry["index"]
+
+def getAsyncIndex(index_name=None):
+    return AsyncLocalSearchIndex(getIndex(index_name))
+
+def syncDocuments(index_name, documents):
+    #Applies an upload_documents batch sent to the Azure index to its local copy, if the local backend is
+    #enabled or the index is loaded, and appends it to the change log of its snapshot. The snapshot itself
+    #is only rewritten once the log reaches LOCAL_SEARCH_COMPACT_BYTES (see compactSnapshot)
+    if not isEnabled() and index_name not in _indexes:
+        return
+    index = getIndex(index_name)
+    index.upload_documents(documents)
+    path = snapshotPath(index_name)
+    if not path:
+        return
+
+    line = (json.dumps(documents) + "\n").encode("utf-8")
+    os.makedirs(path, exist_ok=True)
+    with _lock:
+        with open(_changesPath(path), "ab") as file:
+            position = file.seek(0, os.SEEK_END)
+            file.write(line)
+            inode = os.fstat(file.fileno()).st_ino
+        #the batch is already applied to this worker's index, unless other workers appended before it
+        entry = _indexes.get(index_name)
+        if entry is not None and entry["log_offset"] == position:
+            entry["log_inode"], entry["log_offset"] = inode, position + len(line)
+    if position + len(line) >= LOCAL_SEARCH_COMPACT_BYTES:
+        compactSnapshot(index_name)
+
+def compactSnapshot(index_name):
+    #Writes a new snapshot of index_name holding the logged changes and starts a new change log. The log is
+    #renamed first, so batches appended by other workers in the meantime go to the new log
+    path = snapshotPath(index_name)
+    log_path, compacting_path = _changesPath(path), _changesPath(path, ".compacting")
+    with _lock:
+        entry = _indexes.get(index_name)
+        if entry is None or not os.path.exists(log_path) or os.path.exists(compacting_path):
+            return #nothing to compact, or another worker is compacting
+        os.replace(log_path, compacting_path)
+        #batches of other workers this one has not applied yet
+        batches, _ = _readChanges(compacting_path, entry["log_offset"])
+        for batch in batches:
+            entry["index"].upload_documents(batch)
+        entry["index"].saveSnapshot(path)
+        os.remove(compacting_path)
+        entry["loaded_mtime"] = _snapshotMtime(index_name)
+        entry["log_inode"], entry["log_offset"] = _logState(index_name)[0], 0
+
+def dropIndex(index_name):
+    #forgets the local copy of a deleted index and removes its snapshot
+    with _lock:
+        _indexes.pop(index_name, None)
+        path = snapshotPath(index_name)
+        if path and os.path.isdir(path):
+            shutil.rmtree(path)
+
+def exportSnapshot(index_name=None, path=None, page_size=1000):
+    #Copies every document of the Azure index (with its vectors) into a snapshot. Returns the number of documents
+    import AISearch
+
+    index_name = index_name or AZURE_SEARCH_INDEX_NAME
+    path = path or snapshotPath(index_name)
+    if not path:
+        raise ValueError("No snapshot path: set LOCAL_SEARCH_SNAPSHOT_PATH or pass path")
+
+    index = LocalSearchIndex(key_field=AISearch.getKeyField(index_name))
+    cursor = None
+    while True:
+        page = AISearch.listDocuments(index_name, page_size=page_size, cursor=cursor, include_vectors=True)
+        index.upload_documents(page["documents"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    #the export holds every document, the changes logged for the previous snapshot no longer apply
+    for suffix in (".compacting", ""):
+        if os.path.exists(_changesPath(path, suffix)):
+            os.remove(_changesPath(path, suffix))
+    index.saveSnapshot(path)
+    with _lock:
+        _indexes.pop(index_name, None)
+    return len(index)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print("usage: python LocalSearch.py export [index_name] [path]")
+        sys.exit(1)
+    arguments = sys.argv[2:]
+    exported = exportSnapshot(*arguments)
+    print(f"Exported {exported} documents")
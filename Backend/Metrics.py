@@ -0,0 +1,72 @@
+#################
+# In-process counters and latency timers.
+# Values live for the lifetime of the worker and are read through snapshot().
+################
+from contextlib import contextmanager
+from collections import defaultdict
+import threading
+import time
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_timers = {}  # name -> {"count": ..., "total_ms": ..., "max_ms": ...}
+_distributions = {}  # name -> {"count": ..., "total": ..., "max": ..., "values": {value: count}}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+def recordLatency(name, elapsed_ms):
+    with _lock:
+        timer_stats = _timers.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        timer_stats["count"] += 1
+        timer_stats["total_ms"] += elapsed_ms
+        timer_stats["max_ms"] = max(timer_stats["max_ms"], elapsed_ms)
+
+def observe(name, value):
+    #records one observation of a small discrete value, eg: the number of LLM round trips of a chat turn
+    with _lock:
+        stats = _distributions.setdefault(name, {"count": 0, "total": 0, "max": 0, "values": defaultdict(int)})
+        stats["count"] += 1
+        stats["total"] += value
+        stats["max"] = max(stats["max"], value)
+        stats["values"][value] += 1
+
+@contextmanager
+def timer(name):
+    #with Metrics.timer("hybridSearch.expansion"): ...
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        recordLatency(name, (time.perf_counter() - started_at) * 1000)
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        timers = {
+            name: {
+                "count": stats["count"],
+                "total_ms": round(stats["total_ms"], 3),
+                "avg_ms": round(stats["total_ms"] / stats["count"], 3) if stats["count"] else 0.0,
+                "max_ms": round(stats["max_ms"], 3)
+            }
+            for name, stats in _timers.items()
+        }
+        distributions = {
+            name: {
+                "count": stats["count"],
+                "avg": round(stats["total"] / stats["count"], 3) if stats["count"] else 0.0,
+                "max": stats["max"],
+                "values": {str(value): count for value, count in sorted(stats["values"].items())}
+            }
+            for name, stats in _distributions.items()
+        }
+    return {"counters": counters, "timers": timers, "distributions": distributions}
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        _distributions.clear()
@@ -0,0 +1,62 @@
+#################
+# Token counting helpers shared by the chatbot, the database layer and the chunker.
+# The tiktoken encoding is resolved once per process and reused by every call.
+################
+import tiktoken
+import functools
+import json
+import os
+
+AZURE_OPENAI_MODEL_NAME = os.getenv("AZURE_OPENAI_MODEL_NAME")
+
+MESSAGE_OVERHEAD_TOKENS = 4  # every message overhead
+REPLY_OVERHEAD_TOKENS = 2  # every reply overhead
+DEFAULT_ENCODING_NAME = "o200k_base"  # encoding of the gpt-4o family, used when the model name is unknown to tiktoken
+
+# only these keys are sent to the model, the rest of a stored message document (id, sentAt, ...) is ignored
+MESSAGE_KEYS = ("role", "content", "name", "tool_call_id", "tool_calls")
+
+
+@functools.lru_cache(maxsize=None)
+def getEncoding(model_name=AZURE_OPENAI_MODEL_NAME):
+    #no model name configured (eg: benchmarks and scripts), encoding_for_model(None) raises AttributeError
+    if not model_name:
+        return tiktoken.get_encoding(DEFAULT_ENCODING_NAME)
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except (KeyError, TypeError, AttributeError):
+        return tiktoken.get_encoding(DEFAULT_ENCODING_NAME)
+
+def countTokens(text):
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    return len(getEncoding().encode(text))
+
+def _messageFields(message):
+    #messages are either dicts or the ChatCompletionMessage objects returned by the openai client
+    if isinstance(message, dict):
+        return message
+    if hasattr(message, "model_dump"):
+        return message.model_dump(exclude_none=True)
+    return vars(message)
+
+def messageTokens(message):
+    #str/dict/ChatCompletionMessage -> int
+    fields = _messageFields(message)
+    num_tokens = MESSAGE_OVERHEAD_TOKENS
+    for key in MESSAGE_KEYS:
+        num_tokens += countTokens(fields.get(key))
+    return num_tokens
+
+def num_tokens_from_messages(messages):
+    return sum(messageTokens(message) for message in messages) + REPLY_OVERHEAD_TOKENS
+
+def storedTokens(documents):
+    #sums the tokenCount stored on message documents, encoding only the documents written before it was stored
+    num_tokens = 0
+    for doc in documents:
+        token_count = doc.get("tokenCount")
+        num_tokens += token_count if token_count is not None else messageTokens(doc)
+    return num_tokens
@@ -0,0 +1,219 @@
+#################
+# Lightweight span tracing of the chat and ingestion pipelines.
+#
+#   with Tracing.span("chat.turn", session_id=session_id) as turn:
+#       with Tracing.span("llm.completion"):
+#           ...
+#   turn.trace.breakdown()
+#
+# The first span opened without an active trace starts a new trace, every span opened inside it (including in
+# asyncio tasks, in threads started with bindContext and in generators iterated with bindIterator) becomes its child. Finished traces are sent to the
+# exporter chosen by TRACING_EXPORTER: none (default), console (a JSON log line per trace), file (JSON lines in
+# TRACING_FILE_PATH) or otlp (OpenTelemetry SDK and OTLP exporter, configured with the standard OTEL_* variables).
+################
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+import threading
+import logging
+import json
+import time
+import uuid
+import os
+
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+TRACING_FILE_PATH = os.getenv("TRACING_FILE_PATH", "traces.jsonl")
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace, parent_id=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time_ns = time.time_ns()
+        self._started_at = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+
+    def setAttribute(self, key, value):
+        self.attributes[key] = value
+
+    def _finish(self, error=None):
+        self.duration_ms = (time.perf_counter() - self._started_at) * 1000
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def toDict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ms": round((self.start_time_ns - self.trace.root.start_time_ns) / 1e6, 3),
+            "duration_ms": round(self.duration_ms, 3) if self.duration_ms is not None else None,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.root = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def _add(self, span):
+        with self._lock:
+            if self.root is None:
+                self.root = span
+            self.spans.append(span)
+
+    def breakdown(self):
+        #{"trace_id", "total_ms", "spans": [...]} with the spans in start order, usable in an HTTP response
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start_time_ns)
+        return {
+            "trace_id": self.trace_id,
+            "total_ms": round(self.root.duration_ms, 3) if self.root.duration_ms is not None else None,
+            "spans": [span.toDict() for span in spans]
+        }
+
+
+@contextmanager
+def span(name, **attributes):
+    parent = _current_span.get()
+    current = Span(name, parent.trace if parent else Trace(), parent.span_id if parent else None, attributes)
+    current.trace._add(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current._finish(e)
+        raise
+    else:
+        current._finish()
+    finally:
+        _current_span.reset(token)
+        if parent is None:
+            _export(current.trace)
+
+def currentSpan():
+    return _current_span.get()
+
+def bindContext(function):
+    #runs function in a copy of the current context, so the spans it opens in another thread join the current trace.
+    #Every call needs its own binding: a context cannot be entered by two threads at once
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+def bindIterator(iterator):
+    #Iterates iterator in a copy of the current context. A generator that keeps spans open across its yields has to
+    #be resumed in the context that opened them, which a server streaming it from a thread pool does not guarantee
+    context = copy_context()
+    try:
+        while True:
+            try:
+                item = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            context.run(close)
+
+####################
+## Exporters
+####################
+class ConsoleExporter:
+    def export(self, trace):
+        logging.info("trace %s", json.dumps(trace.breakdown()))
+
+
+class FileExporter:
+    def __init__(self, path=TRACING_FILE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace.breakdown())
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+
+
+class OtlpExporter:
+    """
+    Replays finished traces as OpenTelemetry spans, with their original timings, through an OTLP exporter.
+    Needs the opentelemetry-sdk and opentelemetry-exporter-otlp packages.
+    """
+    def __init__(self):
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry import trace as otel_trace
+
+        self._otel_trace = otel_trace
+        self._provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "azure-ai-chatbot")}))
+        self._provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self._tracer = self._provider.get_tracer("Tracing")
+
+    def export(self, trace):
+        otel_spans = {}
+        for current in sorted(trace.spans, key=lambda span: span.start_time_ns):
+            parent = otel_spans.get(current.parent_id)
+            context = self._otel_trace.set_span_in_context(parent) if parent is not None else None
+            otel_span = self._tracer.start_span(
+                current.name,
+                context=context,
+                start_time=current.start_time_ns,
+                attributes={key: value for key, value in current.attributes.items() if value is not None}
+            )
+            if current.error:
+                otel_span.set_status(self._otel_trace.Status(self._otel_trace.StatusCode.ERROR, current.error))
+            otel_spans[current.span_id] = otel_span
+            otel_span.end(end_time=current.start_time_ns + int((current.duration_ms or 0.0) * 1e6))
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+def _createExporter(kind):
+    if kind == "console":
+        return ConsoleExporter()
+    if kind == "file":
+        return FileExporter()
+    if kind == "otlp":
+        try:
+            return OtlpExporter()
+        except ImportError:
+            logging.warning("TRACING_EXPORTER=otlp needs opentelemetry-sdk and opentelemetry-exporter-otlp, traces are not exported")
+    return None
+
+def getExporter():
+    global _exporter
+    if _exporter is None and TRACING_EXPORTER != "none":
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = _createExporter(TRACING_EXPORTER) or False
+    return _exporter or None
+
+def setExporter(exporter):
+    # Any object with an export(trace) method, eg: to collect traces in a benchmark. Returns the previous exporter
+    global _exporter
+    previous = _exporter
+    _exporter = exporter
+    return previous
+
+def _export(trace):
+    exporter = getExporter()
+    if exporter is None:
+        return
+    try:
+        exporter.export(trace)
+    except Exception:
+        logging.exception("Could not export trace %s", trace.trace_id)
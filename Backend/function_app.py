@@ -1,12 +1,19 @@
 import azure.functions as func
 import azure.identity
+from azurefunctions.extensions.http.fastapi import Request, StreamingResponse, JSONResponse
 import logging
 import json
 import os
 
 import Chatbot
+import AsyncChatbot
 import AISearch
 import Database
+import Metrics
+import CosmosMetrics
+import Tracing
+import EmbeddingCache
+import AnswerCache
 
 TEST_USER_ID = "16b8fef2-4058-4654-bbba-6bffe2058d28"
 
@@ -95,7 +102,7 @@ def httpUserLogin(req: func.HttpRequest) -> func.HttpResponse:
 #
 @app.function_name(name="MessageTrigger")
 @app.route(route="http_chatbot_message", methods=["POST"])
-def httpChatbotTrigger(req: func.HttpRequest) -> func.HttpResponse:
+async def httpChatbotTrigger(req: func.HttpRequest) -> func.HttpResponse:
 
     try:
         # Parse request body
@@ -111,11 +118,17 @@ def httpChatbotTrigger(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         query = req_body.get("query")
+        include_timings = req_body.get("include_timings", False) #debugging: returns the duration of every stage of the turn
+
+        with Tracing.span("http_chatbot_message") as request_span:
+            reply = await AsyncChatbot.sendMessageHelper(user_id, session_id, query)
 
-        reply = Chatbot.sendMessageHelper(user_id, session_id, query)
+        response_body = {"reply": reply}
+        if include_timings:
+            response_body["timings"] = request_span.trace.breakdown()
         
         return func.HttpResponse(
-            json.dumps({"reply": reply}, ensure_ascii=False).encode('utf-8'),
+            json.dumps(response_body, ensure_ascii=False).encode('utf-8'),
             status_code=200,
             mimetype="application/json"
         )    
@@ -128,6 +141,38 @@ def httpChatbotTrigger(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
     
+#
+#########   Sending a Message (streamed) #################
+#
+# Streams the reply as server-sent events while it is being generated:
+#   event: token   data: {"content": "..."}
+#   event: done    data: {"reply": "...", "time_to_first_token_ms": ..., "total_ms": ...}
+#   event: error   data: {"error": "..."}
+# HTTP streams require the PYTHON_ENABLE_INIT_INDEXING app setting to be set to 1
+@app.function_name(name="MessageStreamTrigger")
+@app.route(route="http_chatbot_message_stream", methods=["POST"])
+async def httpChatbotStreamTrigger(req: Request) -> StreamingResponse:
+
+    try:
+        req_body = await req.json()
+        user_id = req_body.get("user_id") 
+        session_id = req_body.get("session_id")
+
+        if not session_id or not user_id:
+            return JSONResponse({"error": "user_id and session_id are required"}, status_code=400)
+
+        query = req_body.get("query")
+
+        return StreamingResponse(
+            Chatbot.streamMessageHelper(user_id, session_id, query),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    except Exception as e:
+        logging.exception("Error in streamMessage HTTP trigger")
+        return JSONResponse({"error": str(e)}, status_code=500)
+    
 #
 #########   Getting the List of Sessions #################
 #
@@ -217,9 +262,10 @@ def httpChatbotDeleteSession(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"
             )
         
-        Database.deleteSession(user_id, session_id)
+        delete_stats = Database.deleteSession(user_id, session_id)
 
         return func.HttpResponse(
+            json.dumps(delete_stats),
             status_code=200,
             mimetype="application/json"
         )
@@ -288,10 +334,10 @@ def httpChatbotTrigger(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"
             )
         
-        messages = Chatbot.clearChat(user_id, session_id)
+        messages, delete_stats = Chatbot.clearChat(user_id, session_id)
 
         return func.HttpResponse(
-            json.dumps({"messages": messages}, ensure_ascii=False).encode('utf-8'),
+            json.dumps({"messages": messages, **delete_stats}, ensure_ascii=False).encode('utf-8'),
             status_code=200,
             mimetype="application/json"
         )      
@@ -353,6 +399,56 @@ def textToSpeech(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(str(e), status_code=500)
 
 
+#################
+# Metrics APIs       
+###############
+
+#
+#########   In-process metrics of this worker #################
+#
+@app.function_name(name="GetMetrics")
+@app.route(route="http_metrics", methods=["GET"])
+def httpGetMetrics(req: func.HttpRequest) -> func.HttpResponse:
+
+    try:
+        user_id = req.params.get("user_id")
+
+        if not user_id:
+            return func.HttpResponse(
+                json.dumps({"error": "user_id is required"}),
+                status_code=400,
+                mimetype="application/json"
+            )
+        
+        if not Database.isAdmin(user_id):
+            return func.HttpResponse(
+                json.dumps({"error": "This function can only be executed by an admin user"}),
+                status_code=400,
+                mimetype="application/json"
+            )
+
+        metrics = Metrics.snapshot()
+        metrics["embedding_cache"] = EmbeddingCache.getCache().stats()
+        metrics["user_cache"] = Database.getUserCache().stats()
+        metrics["index_schema_cache"] = AISearch.getIndexSchemaCache().stats()
+        metrics["cosmos"] = CosmosMetrics.stats()
+        metrics["semantic_cache_enabled"] = AnswerCache.SEMANTIC_CACHE_ENABLED
+
+        return func.HttpResponse(
+            json.dumps(metrics),
+            status_code=200,
+            mimetype="application/json"
+        )
+
+    except Exception as e:
+        logging.exception("Error in GetMetrics HTTP trigger")
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
+            status_code=500,
+            mimetype="application/json"
+        )
+
+
 #################
 # AI Search APIs       
 ###############
@@ -404,7 +500,7 @@ def httpAISearchListIndexes(req: func.HttpRequest) -> func.HttpResponse:
 @app.function_name(name="ListDocuments")
 @app.route(route="http_ai_search_list_documents", methods=["GET"])
 def httpAISearchListIndexes(req: func.HttpRequest) -> func.HttpResponse:
-    #returns a dic with every retreivable field per doc
+    #returns one page of documents with their retreivable non-vector fields, or the chunk count per file
 
     try:
         # Parse request body
@@ -425,10 +521,39 @@ def httpAISearchListIndexes(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"
             )
         
-        docs = AISearch.listDocuments(index_name)
+        # group_by=file_name returns the number of chunks per file instead of the chunks themselves
+        if req.params.get("group_by") == "file_name":
+            files = AISearch.listDocumentFiles(index_name)
+            return func.HttpResponse(
+                json.dumps({"files": files}, ensure_ascii=False).encode('utf-8'),
+                status_code=200,
+                mimetype="application/json"
+            )
+
+        # optional paging/projection: page_size, cursor (next_cursor of the previous page), fields=a,b,c, include_vectors=true
+        fields = req.params.get("fields")
+        cursor = req.params.get("cursor")
+        try:
+            page_size = int(req.params.get("page_size", AISearch.LIST_DOCUMENTS_PAGE_SIZE))
+            if cursor:
+                AISearch.decodeCursor(cursor)
+        except ValueError:
+            return func.HttpResponse(
+                json.dumps({"error": "page_size must be an integer and cursor the next_cursor of a previous page"}),
+                status_code=400,
+                mimetype="application/json"
+            )
+
+        page = AISearch.listDocuments(
+            index_name,
+            page_size=page_size,
+            cursor=cursor,
+            fields=[f.strip() for f in fields.split(",") if f.strip()] if fields else None,
+            include_vectors=req.params.get("include_vectors", "false").lower() == "true"
+        )
         
         return func.HttpResponse(
-            json.dumps({"documents": docs}, ensure_ascii=False).encode('utf-8'),
+            json.dumps(page, ensure_ascii=False).encode('utf-8'),
             status_code=200,
             mimetype="application/json"
         )
@@ -511,6 +636,19 @@ def httpAISearchCreateIndex(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"
             )
         
+        #optional HNSW, metric, compression and vector type settings of content_vector (see AISearch.VECTOR_FIELD_OPTIONS)
+        vector_options = req_body.get("vector_search") or {}
+        try:
+            if not isinstance(vector_options, dict):
+                raise ValueError("vector_search must be an object")
+            vector_settings = AISearch.vectorFieldOptions(vector_options)
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"error": str(e)}),
+                status_code=400,
+                mimetype="application/json"
+            )
+
         index_list = AISearch.listIndexes()
         if(index_name in index_list):
             return func.HttpResponse(
@@ -537,6 +675,7 @@ def httpAISearchCreateIndex(req: func.HttpRequest) -> func.HttpResponse:
                 "field_type": "SimpleField",
                 "data_type": "Edm.String",
                 "filterable": True,
+                "sortable": True, #listDocuments pages in key order
                 "key": True
             },
             {
@@ -553,7 +692,8 @@ def httpAISearchCreateIndex(req: func.HttpRequest) -> func.HttpResponse:
             },
             {
                 "field_name": "content_vector",
-                "field_type": "SearchField"
+                "field_type": "SearchField",
+                **vector_options
             },
             {
                 "field_name": "file_name",
@@ -573,6 +713,7 @@ def httpAISearchCreateIndex(req: func.HttpRequest) -> func.HttpResponse:
         AISearch.createIndex(index_name= index_name, index_fields=index_fields)
         
         return func.HttpResponse(
+            json.dumps({"index_name": index_name, "vector_search": vector_settings}),
             status_code=200,
             mimetype="application/json"
         )
@@ -611,11 +752,18 @@ def httpAISearchAddDocuments(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"
             )
 
-        uploaded_files = AISearch.addDocumentHelper(index_name=index_name, files=files)
+        with Tracing.span("http_ai_search_add_documents") as request_span:
+            results = AISearch.addDocumentHelper(index_name=index_name, files=files)
+        uploaded_files = [result["file_name"] for result in results if result["status"] == "added"]
 
+        response_body = {"uploaded_files": uploaded_files, "results": results}
+        if req.form.get("include_timings", "").lower() == "true": #debugging: returns the duration of every stage of every file
+            response_body["timings"] = request_span.trace.breakdown()
+
+        #per file results are returned even when some files failed. Only a batch where every file failed is an error
         return func.HttpResponse(
-            json.dumps({"uploaded_files": uploaded_files}),
-            status_code=200,
+            json.dumps(response_body),
+            status_code=200 if uploaded_files else 500,
             mimetype="application/json"
         )
 
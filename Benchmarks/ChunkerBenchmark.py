@@ -0,0 +1,97 @@
+#################
+# Microbenchmark of the ingestion chunker.
+# Compares the token-aware Chunker.chunkText with the previous word-split chunker on the same text
+# and reports throughput and the token size spread of the produced chunks.
+#
+#   python Benchmarks/ChunkerBenchmark.py                   (synthetic brochure text)
+#   python Benchmarks/ChunkerBenchmark.py --file brochure.txt --repeat 5
+################
+import statistics
+import argparse
+import random
+import time
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Backend"))
+
+os.environ.setdefault("AZURE_OPENAI_MODEL_NAME", "gpt-4o")  # Tokens picks the encoding of this model when imported
+
+import Chunker
+import Tokens
+
+
+def chunkWords(text, chunk_size=400):
+    #the word-split chunker used before Chunker, kept here as the baseline
+    words = text.split()
+    chunks = []
+    for i in range(0, len(words), chunk_size):
+        chunk = " ".join(words[i:i + chunk_size])
+        chunks.append(chunk)
+    return chunks
+
+def syntheticText(target_words, seed=7):
+    #sentences of 5 to 40 words with an occasional paragraph break, roughly like a brochure page
+    rng = random.Random(seed)
+    vocabulary = ["engine", "torque", "hybrid", "warranty", "interior", "leather", "seats", "horsepower",
+                  "the", "with", "and", "a", "of", "model", "2024", "SUV", "sedan", "fuel", "economy", "km/h",
+                  "safety", "airbags", "infotainment", "display", "trim", "premium", "package", "wheel", "drive"]
+    sentences = []
+    words = 0
+    while words < target_words:
+        length = rng.randint(5, 40)
+        sentence = " ".join(rng.choice(vocabulary) for _ in range(length)).capitalize() + rng.choice([".", ".", "!", "?"])
+        if rng.random() < 0.1:
+            sentence += "\n\n"
+        sentences.append(sentence)
+        words += length
+    return " ".join(sentences)
+
+def measure(name, function, text, repeat):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        chunks = function(text)
+        timings.append(time.perf_counter() - started_at)
+
+    token_sizes = [Tokens.countTokens(chunk) for chunk in chunks]
+    best = min(timings)
+    return {
+        "chunker": name,
+        "chunks": len(chunks),
+        "best_seconds": round(best, 4),
+        "mb_per_second": round(len(text.encode("utf-8")) / 1e6 / best, 2) if best > 0 else None,
+        "tokens_min": min(token_sizes, default=0),
+        "tokens_mean": round(statistics.mean(token_sizes), 1) if token_sizes else 0,
+        "tokens_max": max(token_sizes, default=0),
+        "tokens_stdev": round(statistics.pstdev(token_sizes), 1) if token_sizes else 0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunker microbenchmark")
+    parser.add_argument("--file", help="text file to chunk (defaults to synthetic text)")
+    parser.add_argument("--words", type=int, default=200000, help="size of the synthetic text in words")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=Chunker.CHUNK_SIZE_TOKENS)
+    parser.add_argument("--overlap", type=int, default=Chunker.CHUNK_OVERLAP_TOKENS)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = syntheticText(args.words)
+
+    Tokens.getEncoding() #load the encoding before timing anything
+
+    results = [
+        measure("words (previous chunkText)", chunkWords, text, args.repeat),
+        measure("tokens, sentence snapped", lambda t: Chunker.chunkText(t, args.chunk_size, args.overlap), text, args.repeat),
+        measure("tokens, fixed windows", lambda t: Chunker.chunkText(t, args.chunk_size, args.overlap, snap_to_sentences=False), text, args.repeat),
+    ]
+    print(json.dumps({"characters": len(text), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+#################
+# In-process stand-ins for the Azure services used by the backend, for offline benchmarks.
+#
+# - FakeOpenAIServer: an HTTP server speaking the Azure OpenAI chat completions (as server-sent events with
+#   stream=True) and embeddings API, so the real openai clients are used. Latency, generation speed, reply length
+#   and how often the model asks for the hybridSearch tool are configurable.
+# - FakeSearchIndex / AsyncFakeSearchIndex: a LocalSearch index with the latency of AI Search, for Chatbot and AISearch.
+# - AsyncInMemoryContainerProvider: LocalContainer.InMemoryContainer behind the azure.cosmos.aio interface.
+# - FakeBlobServiceClient and FakeUploadedFile: blob storage and uploaded files for the ingestion pipeline.
+################
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import Counter
+import threading
+import asyncio
+import hashlib
+import random
+import math
+import json
+import time
+import uuid
+import io
+import re
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Backend"))
+
+import LocalContainer
+
+_WORDS = ["engine", "torque", "hybrid", "warranty", "interior", "leather", "seats", "horsepower", "model",
+          "fuel", "economy", "safety", "airbags", "display", "trim", "premium", "package", "wheel", "drive"]
+
+
+def fakeEmbedding(text, dimensions):
+    #deterministic unit vector of the text
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimensions)]
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+def _words(text):
+    return re.findall(r"\w+", (text or "").lower())
+
+####################
+## OpenAI
+####################
+class FakeOpenAIServer:
+    """
+    latency_ms: time to the first token of a completion, tokens_per_second: generation speed of the reply,
+    reply_tokens: words in a reply, tool_call_rate: share of user questions answered with a hybridSearch call,
+    embedding_latency_ms: time of one embeddings request, dimensions: size of the embeddings.
+    """
+    def __init__(self, latency_ms=300, tokens_per_second=80, reply_tokens=120, tool_call_rate=0.8,
+                 embedding_latency_ms=40, dimensions=1536):
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.tool_call_rate = tool_call_rate
+        self.embedding_latency_ms = embedding_latency_ms
+        self.dimensions = dimensions
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.split("?")[0].endswith("/chat/completions") and body.get("stream"):
+                    self.streamEvents(fake.chatCompletionChunks(body))
+                    return
+                if self.path.split("?")[0].endswith("/chat/completions"):
+                    response = fake.chatCompletion(body)
+                elif self.path.split("?")[0].endswith("/embeddings"):
+                    response = fake.embeddings(body)
+                else:
+                    self.send_error(404)
+                    return
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def streamEvents(self, chunks):
+                #server-sent events without Content-Length, the response ends when the connection is closed
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.calls[name] += value
+
+    def snapshotCalls(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def _wantsTool(self, body):
+        messages = body.get("messages") or []
+        if not body.get("tools") or not messages or messages[-1].get("role") != "user":
+            return False
+        digest = hashlib.sha256(str(messages[-1].get("content")).encode("utf-8")).digest()
+        return digest[0] / 256 < self.tool_call_rate
+
+    def _completion(self, body):
+        #(message, finish_reason, prompt_tokens, completion_tokens) of a chat completion request
+        self.count("chat_completions")
+        prompt_tokens = sum(len(_words(str(message.get("content")))) for message in body.get("messages") or [])
+        message = {"role": "assistant", "content": None}
+
+        if self._wantsTool(body):
+            self.count("tool_calls")
+            message["tool_calls"] = [{
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {"name": "hybridSearch", "arguments": json.dumps({"query": body["messages"][-1]["content"]})}
+            }]
+            return message, "tool_calls", prompt_tokens, 20
+
+        completion_tokens = min(self.reply_tokens, body.get("max_tokens") or self.reply_tokens)
+        rng = random.Random(prompt_tokens)
+        message["content"] = " ".join(rng.choice(_WORDS) for _ in range(completion_tokens)).capitalize() + "."
+        return message, "stop", prompt_tokens, completion_tokens
+
+    def chatCompletion(self, body):
+        message, finish_reason, prompt_tokens, completion_tokens = self._completion(body)
+        time.sleep(self.latency_ms / 1000 + completion_tokens / self.tokens_per_second)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "finish_reason": finish_reason, "message": message}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
+
+    def chatCompletionChunks(self, body):
+        #chat.completion.chunk objects of a stream=True request: the first one after latency_ms,
+        #then a word (content) or a piece of the tool call arguments at tokens_per_second
+        message, finish_reason, _, completion_tokens = self._completion(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4o"),
+                "choices": [{"index": 0, "finish_reason": finish_reason, "delta": delta}]
+            }
+
+        time.sleep(self.latency_ms / 1000)
+        yield chunk({"role": "assistant", "content": ""})
+
+        if message.get("tool_calls"):
+            tool_call = message["tool_calls"][0]
+            arguments = tool_call["function"]["arguments"]
+            pieces = [arguments[i:i + 8] for i in range(0, len(arguments), 8)]
+            yield chunk({"tool_calls": [{"index": 0, "id": tool_call["id"], "type": "function",
+                                         "function": {"name": tool_call["function"]["name"], "arguments": ""}}]})
+            for piece in pieces:
+                time.sleep(completion_tokens / self.tokens_per_second / len(pieces))
+                yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": piece}}]})
+        else:
+            words = message["content"].split(" ")
+            for position, word in enumerate(words):
+                time.sleep(1 / self.tokens_per_second)
+                yield chunk({"content": word if position == 0 else " " + word})
+
+        yield chunk({}, finish_reason)
+
+    def embeddings(self, body):
+        inputs = body.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs or [])
+        self.count("embedding_requests")
+        self.count("embedding_inputs", len(inputs))
+
+        time.sleep(self.embedding_latency_ms / 1000)
+        tokens = sum(len(_words(text)) for text in inputs)
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": position, "embedding": fakeEmbedding(text, self.dimensions)}
+                for position, text in enumerate(inputs)
+            ],
+            "model": body.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }
+
+####################
+## AI Search
+####################
+class FakeSearchIndex:
+    """
+    A LocalSearch index (BM25, vector and hybrid ranking, OData filters, order_by) behind the latency of a remote
+    index: latency_ms is added to every search. calls counts the search and upload_documents requests.
+    Documents are keyed by key_field, chunk_id like the index created by the function app.
+    """
+    def __init__(self, latency_ms=30, key_field="chunk_id"):
+        import LocalSearch #imported here since it reads its settings when imported, see PipelineBenchmark.configureEnvironment
+
+        self.index = LocalSearch.LocalSearchIndex(key_field=key_field)
+        self.latency_ms = latency_ms
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def upload_documents(self, documents):
+        self.count("upload_documents")
+        return self.index.upload_documents(documents)
+
+    def delete_documents(self, documents):
+        self.count("delete_documents")
+        return self.index.delete_documents(documents)
+
+    def get_document_count(self):
+        return self.index.get_document_count()
+
+    def search(self, **kwargs):
+        self.count("search")
+        time.sleep(self.latency_ms / 1000)
+        return self.index.search(**kwargs)
+
+    def close(self):
+        pass
+
+
+class _AsyncResults:
+    def __init__(self, results):
+        self._results = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncFakeSearchIndex:
+    #azure.search.documents.aio interface over a FakeSearchIndex
+    def __init__(self, index):
+        self.index = index
+
+    async def search(self, **kwargs):
+        results = await asyncio.to_thread(self.index.search, **kwargs)
+        return _AsyncResults(results)
+
+    async def upload_documents(self, documents):
+        return self.index.upload_documents(documents)
+
+    async def close(self):
+        pass
+
+####################
+## Cosmos DB
+####################
+class AsyncInMemoryContainer:
+    #azure.cosmos.aio interface over a LocalContainer.InMemoryContainer
+    def __init__(self, container):
+        self.container = container
+
+    async def read_item(self, *args, **kwargs):
+        return self.container.read_item(*args, **kwargs)
+
+    async def create_item(self, *args, **kwargs):
+        return self.container.create_item(*args, **kwargs)
+
+    async def upsert_item(self, *args, **kwargs):
+        return self.container.upsert_item(*args, **kwargs)
+
+    async def delete_item(self, *args, **kwargs):
+        return self.container.delete_item(*args, **kwargs)
+
+    async def execute_item_batch(self, *args, **kwargs):
+        return self.container.execute_item_batch(*args, **kwargs)
+
+    def query_items(self, *args, **kwargs):
+        return _AsyncResults(self.container.query_items(*args, **kwargs))
+
+
+class AsyncInMemoryContainerProvider:
+    # Same interface as AsyncDatabase.AsyncContainerProvider, sharing the container of a LocalContainer provider
+    def __init__(self, container=None):
+        self.container = AsyncInMemoryContainer(container or LocalContainer.InMemoryContainer())
+
+    async def getContainer(self):
+        return self.container
+
+    async def close(self):
+        pass
+
+####################
+## Blob Storage and Uploads
+####################
+class FakeUploadedFile:
+    #what the Functions runtime hands out in req.files
+    def __init__(self, filename, content=b"%PDF-fake"):
+        self.filename = filename
+        self.stream = io.BytesIO(content)
+
+
+class _FakeBlobClient:
+    def __init__(self, name):
+        self.url = f"https://benchmark.blob.core.windows.net/uploads/{name}"
+
+    def upload_blob(self, data, overwrite=False):
+        data.read()
+
+    def delete_blob(self, delete_snapshots=None):
+        pass
+
+
+class _FakeContainerClient:
+    def get_blob_client(self, name):
+        return _FakeBlobClient(name)
+
+
+class FakeBlobServiceClient:
+    def __init__(self, account_url=None, credential=None):
+        pass
+
+    def get_container_client(self, container_name):
+        return _FakeContainerClient()
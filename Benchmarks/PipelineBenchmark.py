@@ -0,0 +1,365 @@
+#################
+# Offline benchmark of the chat and ingestion paths.
+# The real Chatbot (sendMessageHelper and streamMessageHelper), AsyncChatbot, AISearch and Database code runs against in-process stand-ins (see Fakes.py):
+# a fake Azure OpenAI server, a fake search index and the in-memory Cosmos container. With --search-backend local
+# the chat searches run on the embedded LocalSearch index instead, which AISearch keeps in sync with the fake index.
+# Reports throughput, p50/p95/p99 latency, service calls per turn (or per file), the time spent in every traced
+# stage and the memory allocated while running, and saves everything as JSON so runs can be compared.
+#
+#   python Benchmarks/PipelineBenchmark.py                                  (every scenario)
+#   python Benchmarks/PipelineBenchmark.py --scenario chat-async --turns 200 --concurrency 16
+#   python Benchmarks/PipelineBenchmark.py --latency-ms 50 --output results/baseline.json
+#   python Benchmarks/PipelineBenchmark.py --scenario chat --search-backend local
+#   python Benchmarks/PipelineBenchmark.py --scenario chat-stream            (streamed replies, adds time to first token)
+################
+from collections import defaultdict
+from datetime import datetime, timezone
+import statistics
+import tracemalloc
+import threading
+import argparse
+import asyncio
+import time
+import json
+import sys
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "Backend"))
+
+import Fakes
+
+SCENARIOS = ["chat", "chat-async", "chat-stream", "ingestion"]
+
+QUESTIONS = [
+    "What is the warranty of the hybrid model?",
+    "How much torque does the premium package engine have?",
+    "Which safety features and airbags come with the sedan?",
+    "hello!",
+    "What is the fuel economy of the SUV in km/h?",
+    "Does the interior trim include leather seats?",
+    "thanks",
+    "Compare the display and infotainment of both models",
+]
+
+
+def configureEnvironment(server, index_name, search_backend="fake"):
+    #the backend modules read their settings when imported, so this runs before importing them
+    os.environ.update({
+        "AZURE_AI_FOUNDRY_ENDPOINT": server.endpoint,
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_API_VERSION": "2024-10-21",
+        "AZURE_OPENAI_CHAT_DEPLOYMENT_NAME": "gpt-4o",
+        "AZURE_OPENAI_MODEL_NAME": "gpt-4o",
+        "AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME": "text-embedding-3-small",
+        "AZURE_SEARCH_ENDPOINT": "https://benchmark.search.windows.net",
+        "AZURE_SEARCH_API_KEY": "benchmark",
+        "AZURE_SEARCH_INDEX_NAME": index_name,
+        "AZURE_STORAGE_ACCOUNT_NAME": "benchmark",
+        "AZURE_STORAGE_ACCOUNT_API_KEY": "YmVuY2htYXJr",
+        "AZURE_STORAGE_ACCOUNT_CONTAINER_NAME": "uploads",
+        "COSMO_DB_LOG_OPERATIONS": "false",
+        "SEARCH_BACKEND": "local" if search_backend == "local" else "azure",
+        "LOCAL_SEARCH_SNAPSHOT_PATH": "",
+    })
+
+
+class TraceCollector:
+    #Tracing exporter keeping the duration of every span by name
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        with self._lock:
+            for span in trace.spans:
+                if span.duration_ms is not None:
+                    self.durations[span.name].append(span.duration_ms)
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: {"count": len(values), "avg_ms": round(statistics.mean(values), 3), "p95_ms": percentiles(values)["p95_ms"]}
+                for name, values in sorted(self.durations.items())
+            }
+
+    def clear(self):
+        with self._lock:
+            self.durations.clear()
+
+
+def percentiles(latencies_ms):
+    if not latencies_ms:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    if len(latencies_ms) == 1:
+        return {"p50_ms": round(latencies_ms[0], 3), "p95_ms": round(latencies_ms[0], 3), "p99_ms": round(latencies_ms[0], 3)}
+    cuts = statistics.quantiles(latencies_ms, n=100, method="inclusive")
+    return {"p50_ms": round(cuts[49], 3), "p95_ms": round(cuts[94], 3), "p99_ms": round(cuts[98], 3)}
+
+def callsPerUnit(before, after, units):
+    return {name: round((after.get(name, 0) - before.get(name, 0)) / units, 3) for name in sorted(after) if units}
+
+def cosmosOperations():
+    import CosmosMetrics
+    return {label: values["operations"] for label, values in CosmosMetrics.stats().items()}
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.server = Fakes.FakeOpenAIServer(
+            latency_ms=args.latency_ms,
+            tokens_per_second=args.tokens_per_second,
+            reply_tokens=args.reply_tokens,
+            tool_call_rate=args.tool_call_rate,
+            embedding_latency_ms=args.embedding_latency_ms,
+            dimensions=args.dimensions
+        ).start()
+        configureEnvironment(self.server, args.index_name, args.search_backend)
+
+        import Clients
+        import Database
+        import AsyncDatabase
+        import AISearch
+        import Tracing
+        import LocalContainer
+
+        self.search_index = Fakes.FakeSearchIndex(latency_ms=args.search_latency_ms)
+        async_search_index = Fakes.AsyncFakeSearchIndex(self.search_index)
+        Clients.getSearchClient = lambda index_name=None, endpoint=None: self.search_index
+        Clients.getAsyncSearchClient = lambda index_name=None, endpoint=None: async_search_index
+
+        container = LocalContainer.InMemoryContainer()
+        Database.setContainerProvider(LocalContainer.InMemoryContainerProvider(container))
+        AsyncDatabase.setContainerProvider(Fakes.AsyncInMemoryContainerProvider(container))
+
+        AISearch.BlobServiceClient = Fakes.FakeBlobServiceClient
+        AISearch.initializeDocumentAnalysisClient = lambda: None
+        AISearch.analyzeDocument = self.analyzeDocument
+
+        self.traces = TraceCollector()
+        Tracing.setExporter(self.traces)
+
+    def close(self):
+        self.server.stop()
+
+    ##############
+    # Stand-ins
+    ##############
+    def analyzeDocument(self, client, file_info):
+        #Document Intelligence stand-in: synthetic brochure pages after analyze_latency_ms
+        from ChunkerBenchmark import syntheticText
+        time.sleep(self.args.analyze_latency_ms / 1000)
+        seed = sum(file_info["file_name"].encode("utf-8"))
+        return [
+            {
+                "id": f"{abs(hash(file_info['file_name']))}-page{page}",
+                "file_name": file_info["file_name"],
+                "page_number": page,
+                "content": syntheticText(self.args.words_per_page, seed=seed + page)
+            }
+            for page in range(1, self.args.pages + 1)
+        ]
+
+    def seedIndex(self):
+        #indexes a few documents so the chat searches have something to find
+        import AISearch
+        AISearch.addDocuments(self.args.index_name, self.analyzeDocument(None, {"file_name": "seed.pdf"}), ["content"])
+
+    def createSessions(self, count):
+        import Database
+        import Chatbot
+        user_id = Database.addUser("Bench", "Mark", f"benchmark-{time.time_ns()}", "benchmark")
+        return user_id, [Chatbot.createSession(user_id, f"Benchmark {i}") for i in range(count)]
+
+    ##############
+    # Scenarios
+    ##############
+    def measure(self, name, units, unit_name, run):
+        #run() performs the work and returns the latency of every unit in ms
+        self.traces.clear()
+        calls_before = self.server.snapshotCalls()
+        search_before = dict(self.search_index.calls)
+        cosmos_before = cosmosOperations()
+
+        if self.args.tracemalloc:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        started_at = time.perf_counter()
+        latencies_ms = run()
+        elapsed = time.perf_counter() - started_at
+
+        memory = None
+        if self.args.tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory = {
+                "retained_kb": round((current - memory_before) / 1024, 1),
+                "peak_kb": round((peak - memory_before) / 1024, 1),
+                "peak_kb_per_unit": round((peak - memory_before) / 1024 / units, 1)
+            }
+
+        calls = callsPerUnit(calls_before, self.server.snapshotCalls(), units)
+        calls.update(callsPerUnit({f"search.{k}": v for k, v in search_before.items()},
+                                  {f"search.{k}": v for k, v in self.search_index.calls.items()}, units))
+        calls.update(callsPerUnit({f"cosmos.{k}": v for k, v in cosmos_before.items()},
+                                  {f"cosmos.{k}": v for k, v in cosmosOperations().items()}, units))
+
+        return {
+            "scenario": name,
+            unit_name: units,
+            "seconds": round(elapsed, 3),
+            f"{unit_name}_per_second": round(units / elapsed, 3) if elapsed else None,
+            "mean_ms": round(statistics.mean(latencies_ms), 3) if latencies_ms else None,
+            **percentiles(latencies_ms),
+            f"calls_per_{unit_name[:-1]}": calls,
+            "stages": self.traces.summary(),
+            "memory": memory
+        }
+
+    def chat(self):
+        import Chatbot
+        user_id, sessions = self.createSessions(self.args.concurrency)
+        turns_per_session = max(1, self.args.turns // len(sessions))
+
+        def run():
+            latencies_ms = []
+            lock = threading.Lock()
+
+            def converse(session_id, offset):
+                for turn in range(turns_per_session):
+                    started_at = time.perf_counter()
+                    Chatbot.sendMessageHelper(user_id, session_id, QUESTIONS[(offset + turn) % len(QUESTIONS)])
+                    with lock:
+                        latencies_ms.append((time.perf_counter() - started_at) * 1000)
+
+            threads = [threading.Thread(target=converse, args=(session_id, i)) for i, session_id in enumerate(sessions)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return latencies_ms
+
+        return self.measure("chat", turns_per_session * len(sessions), "turns", run)
+
+    def chatAsync(self):
+        import AsyncChatbot
+        import Clients
+        user_id, sessions = self.createSessions(self.args.concurrency)
+        turns_per_session = max(1, self.args.turns // len(sessions))
+
+        async def converse(session_id, offset, latencies_ms):
+            for turn in range(turns_per_session):
+                started_at = time.perf_counter()
+                await AsyncChatbot.sendMessageHelper(user_id, session_id, QUESTIONS[(offset + turn) % len(QUESTIONS)])
+                latencies_ms.append((time.perf_counter() - started_at) * 1000)
+
+        async def main():
+            latencies_ms = []
+            try:
+                await asyncio.gather(*(converse(session_id, i, latencies_ms) for i, session_id in enumerate(sessions)))
+            finally:
+                await Clients.closeAsyncClients() #the clients of this loop cannot be used by the next asyncio.run
+            return latencies_ms
+
+        return self.measure("chat-async", turns_per_session * len(sessions), "turns", lambda: asyncio.run(main()))
+
+    def chatStream(self):
+        #Chatbot.streamMessageHelper, latencies are up to the done event and the time to first token is read from it
+        import Chatbot
+        user_id, sessions = self.createSessions(self.args.concurrency)
+        turns_per_session = max(1, self.args.turns // len(sessions))
+        first_token_ms = []
+
+        def run():
+            latencies_ms = []
+            lock = threading.Lock()
+
+            def converse(session_id, offset):
+                for turn in range(turns_per_session):
+                    started_at = time.perf_counter()
+                    events = list(Chatbot.streamMessageHelper(user_id, session_id, QUESTIONS[(offset + turn) % len(QUESTIONS)]))
+                    elapsed_ms = (time.perf_counter() - started_at) * 1000
+                    if not events[-1].startswith("event: done"):
+                        raise RuntimeError(f"Stream failed: {events[-1]}")
+                    done = json.loads(events[-1].split("data: ", 1)[1])
+                    with lock:
+                        latencies_ms.append(elapsed_ms)
+                        if done["time_to_first_token_ms"] is not None:
+                            first_token_ms.append(done["time_to_first_token_ms"])
+
+            threads = [threading.Thread(target=converse, args=(session_id, i)) for i, session_id in enumerate(sessions)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return latencies_ms
+
+        result = self.measure("chat-stream", turns_per_session * len(sessions), "turns", run)
+        result["time_to_first_token"] = {"mean_ms": round(statistics.mean(first_token_ms), 3), **percentiles(first_token_ms)} if first_token_ms else None
+        return result
+
+    def ingestion(self):
+        import AISearch
+
+        def run():
+            files = {f"file{i}": Fakes.FakeUploadedFile(f"brochure-{i}.pdf") for i in range(self.args.files)}
+            results = AISearch.addDocumentHelper(self.args.index_name, files)
+            failed = [result for result in results if result["status"] != "added"]
+            if failed:
+                raise RuntimeError(f"Ingestion failed: {failed}")
+            return [result["seconds"] * 1000 for result in results]
+
+        return self.measure("ingestion", self.args.files, "files", run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the chat and ingestion paths")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--turns", type=int, default=40, help="chat turns per chat scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="conversations running at the same time")
+    parser.add_argument("--files", type=int, default=6, help="files uploaded by the ingestion scenario")
+    parser.add_argument("--pages", type=int, default=4, help="pages per file")
+    parser.add_argument("--words-per-page", type=int, default=600)
+    parser.add_argument("--latency-ms", type=float, default=300, help="time to first token of a completion")
+    parser.add_argument("--tokens-per-second", type=float, default=80, help="generation speed of the fake model")
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--tool-call-rate", type=float, default=0.8, help="share of questions answered with a search")
+    parser.add_argument("--embedding-latency-ms", type=float, default=40)
+    parser.add_argument("--search-latency-ms", type=float, default=30)
+    parser.add_argument("--search-backend", choices=["fake", "local"], default="fake",
+                        help="index searched by the chat: the fake AI Search index or the embedded LocalSearch index")
+    parser.add_argument("--analyze-latency-ms", type=float, default=500, help="Document Intelligence time per file")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--index-name", default="benchmark")
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false", help="skip the allocation tracking (faster)")
+    parser.add_argument("--output", help="JSON file for the results (defaults to Benchmarks/results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    harness = Harness(args)
+    try:
+        harness.seedIndex()
+        scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+        runners = {"chat": harness.chat, "chat-async": harness.chatAsync, "chat-stream": harness.chatStream, "ingestion": harness.ingestion}
+        results = [runners[scenario]() for scenario in scenarios]
+    finally:
+        harness.close()
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results
+    }
+    output = args.output or os.path.join(BENCHMARKS_DIR, "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+
+    print(json.dumps(report, indent=2))
+    print(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
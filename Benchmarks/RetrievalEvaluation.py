@@ -0,0 +1,196 @@
+#################
+# Recall and latency evaluation of the hybridSearch retrieval settings.
+# Runs a labelled query set against the search index with every combination of the vector query settings
+# (exhaustive scan or HNSW graph, k, oversampling) and reports, for each one: recall@top and MRR on the labels,
+# agreement with the exhaustive results of the same k, and the search latency. Query embeddings are computed once
+# beforehand, so only the search is timed. The settings are read from the environment (or --settings) like the
+# function app, and the chosen values map to SEARCH_EXHAUSTIVE, SEARCH_VECTOR_K and SEARCH_OVERSAMPLING.
+#
+#   python Benchmarks/RetrievalEvaluation.py --queries queries.jsonl
+#   python Benchmarks/RetrievalEvaluation.py --queries queries.jsonl --k 5 10 20 --oversampling 2 4 --repeat 5
+#   python Benchmarks/RetrievalEvaluation.py --queries queries.jsonl --backend azure local
+#
+# The query set is a JSON lines file (or a JSON list) of
+#   {"query": "What is the warranty of the hybrid?", "relevant": ["<chunk id>", {"file_name": "brochure.pdf", "page_number": 3}]}
+# A relevant entry is the id of a chunk or the field values of the chunks that count as a hit.
+# Queries without "relevant" are only used for latency and agreement.
+################
+from datetime import datetime, timezone
+import itertools
+import statistics
+import argparse
+import time
+import json
+import sys
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "Backend"))
+
+from PipelineBenchmark import percentiles
+
+
+def loadSettings(path):
+    #Values of a Functions local.settings.json, without overriding the environment
+    with open(path, "r", encoding="utf-8") as file:
+        values = json.load(file).get("Values", {})
+    for key, value in values.items():
+        os.environ.setdefault(key, str(value))
+
+def loadQueries(path):
+    with open(path, "r", encoding="utf-8") as file:
+        content = file.read().strip()
+    if content.startswith("["):
+        queries = json.loads(content)
+    else:
+        queries = [json.loads(line) for line in content.splitlines() if line.strip()]
+    return [{"query": entry["query"], "relevant": entry.get("relevant") or []} for entry in queries]
+
+
+####################
+## Scores
+####################
+def isRelevant(result, label):
+    if isinstance(label, dict):
+        return all(str(result.get(field)) == str(value) for field, value in label.items())
+    return result.get("id") == label
+
+def scoreQuery(results, labels):
+    #(recall, reciprocal rank) of the results: share of the labels found, and 1 / rank of the first relevant result
+    if not labels:
+        return None, None
+    found = sum(any(isRelevant(result, label) for result in results) for label in labels)
+    first_rank = next((rank for rank, result in enumerate(results, start=1) if any(isRelevant(result, label) for label in labels)), None)
+    return found / len(labels), (1 / first_rank if first_rank else 0.0)
+
+def agreement(results, baseline):
+    #share of the baseline results (the exhaustive search) that are also returned
+    baseline_ids = {result["id"] for result in baseline}
+    if not baseline_ids:
+        return None
+    return len(baseline_ids.intersection(result["id"] for result in results)) / len(baseline_ids)
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return round(statistics.mean(values), 4) if values else None
+
+
+####################
+## Evaluation
+####################
+def settingsToEvaluate(args):
+    #every (backend, exhaustive, k, oversampling). The local index is always exact, so it only varies k
+    settings = []
+    for backend, k in itertools.product(args.backend, args.k):
+        if backend == "local":
+            settings.append({"backend": backend, "exhaustive": True, "k": k, "oversampling": None})
+            continue
+        settings.append({"backend": backend, "exhaustive": True, "k": k, "oversampling": None})
+        for oversampling in [None] + args.oversampling:
+            settings.append({"backend": backend, "exhaustive": False, "k": k, "oversampling": oversampling})
+    return settings
+
+def searchClient(backend, index_name):
+    import Clients
+    import LocalSearch
+    return LocalSearch.getIndex(index_name) if backend == "local" else Clients.getSearchClient(index_name)
+
+def runSetting(setting, queries, embeddings, args):
+    #returns (results of every query, search latencies in ms)
+    import Chatbot
+
+    search_client = searchClient(setting["backend"], args.index_name)
+    all_results, latencies_ms = [], []
+    for entry, embedding in zip(queries, embeddings):
+        arguments = Chatbot.searchArguments(entry["query"], embedding, top=args.top, k=setting["k"],
+                                            exhaustive=setting["exhaustive"], oversampling=setting["oversampling"])
+        for _ in range(args.repeat):
+            started_at = time.perf_counter()
+            results = list(search_client.search(**arguments))
+            latencies_ms.append((time.perf_counter() - started_at) * 1000)
+        all_results.append(results)
+    return all_results, latencies_ms
+
+def evaluate(args):
+    import Chatbot
+    import Clients
+    import EmbeddingCache
+
+    queries = loadQueries(args.queries)
+    openai_client = Clients.getOpenAIClient()
+    embeddings = [EmbeddingCache.embedQuery(openai_client, entry["query"], Chatbot.AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME) for entry in queries]
+
+    #a first search per backend so connection setup is not timed
+    for backend in args.backend:
+        list(searchClient(backend, args.index_name).search(**Chatbot.searchArguments(queries[0]["query"], embeddings[0], top=1)))
+
+    report = []
+    exhaustive_results = {}  # (backend, k) -> results of every query
+    for setting in settingsToEvaluate(args):
+        try:
+            results, latencies_ms = runSetting(setting, queries, embeddings, args)
+        except Exception as e:
+            #eg: oversampling on a vector field without compression
+            report.append({**setting, "error": f"{type(e).__name__}: {e}"})
+            continue
+
+        if setting["exhaustive"]:
+            exhaustive_results[(setting["backend"], setting["k"])] = results
+        #the local index is compared with the exhaustive Azure results when both backends are evaluated
+        baseline = exhaustive_results.get(("azure", setting["k"])) or exhaustive_results.get((setting["backend"], setting["k"]))
+        scores = [scoreQuery(query_results, entry["relevant"]) for query_results, entry in zip(results, queries)]
+
+        report.append({
+            **setting,
+            f"recall_at_{args.top}": mean(recall for recall, _ in scores),
+            "mrr": mean(reciprocal_rank for _, reciprocal_rank in scores),
+            "agreement_with_exhaustive": mean(agreement(query_results, baseline_results) for query_results, baseline_results in zip(results, baseline)) if baseline else None,
+            "mean_ms": round(statistics.mean(latencies_ms), 3),
+            **percentiles(latencies_ms)
+        })
+    return {"queries": len(queries), "labelled_queries": sum(bool(entry["relevant"]) for entry in queries), "results": report}
+
+def printTable(evaluation, top):
+    columns = ["backend", "exhaustive", "k", "oversampling", f"recall_at_{top}", "mrr", "agreement_with_exhaustive", "p50_ms", "p95_ms"]
+    print(" | ".join(columns))
+    for row in evaluation["results"]:
+        if "error" in row:
+            print(" | ".join(str(row[column]) for column in columns[:4]) + f" | {row['error']}")
+        else:
+            print(" | ".join(str(row.get(column)) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall and latency of the hybridSearch retrieval settings")
+    parser.add_argument("--queries", required=True, help="labelled query set (JSON lines or a JSON list)")
+    parser.add_argument("--settings", help="local.settings.json whose Values are used as environment variables")
+    parser.add_argument("--index-name", help="defaults to AZURE_SEARCH_INDEX_NAME")
+    parser.add_argument("--backend", nargs="+", choices=["azure", "local"], default=["azure"])
+    parser.add_argument("--top", type=int, default=5, help="hits per search, recall is measured on them")
+    parser.add_argument("--k", type=int, nargs="+", default=[5], help="nearest neighbours of the vector query")
+    parser.add_argument("--oversampling", type=float, nargs="*", default=[], help="oversampling values tried with HNSW (compressed vector fields only)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed searches per query and setting")
+    parser.add_argument("--output", help="JSON file for the results (defaults to Benchmarks/results/retrieval-<timestamp>.json)")
+    args = parser.parse_args()
+
+    if args.settings:
+        loadSettings(args.settings)
+    args.index_name = args.index_name or os.getenv("AZURE_SEARCH_INDEX_NAME")
+
+    evaluation = evaluate(args)
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "settings")},
+        "evaluation": evaluation
+    }
+    output = args.output or os.path.join(BENCHMARKS_DIR, "results", "retrieval-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+
+    printTable(evaluation, args.top)
+    print(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,12 +26,12 @@ export default function EditDocuments() {
       const response = await axios.get(
         "https://fa-ict-coueiss-sdc-01-d2g5h9gddrcucygu.swedencentral-01.azurewebsites.net/api/http_ai_search_list_documents",
         {
-          params: { user_id: user.id, index_name: index_name },
+          params: { user_id: user.id, index_name: index_name, group_by: "file_name" },
         }
       );
 
-      const documents = response.data.documents;
-      setDocumentsList([...new Set(documents.map((doc) => doc.file_name))]);
+      const files = response.data.files;
+      setDocumentsList(files.map((file) => file.file_name));
     } catch (error) {
       console.error("Error fetching document list:", error);
     }
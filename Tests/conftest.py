@@ -0,0 +1,57 @@
+#################
+# Shared fixtures of the backend tests. The tests run offline against the in-process stand-ins
+# (LocalContainer, LocalSearch and the fake clients below), so no Azure resource is needed:
+#
+#   python -m pytest Tests
+################
+import re
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "Backend"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "Benchmarks"))
+
+import Tokens
+
+_PIECE = re.compile(r"\S+\s*|\s+")
+
+
+class FakeEncoding:
+    """
+    Reversible stand-in for a tiktoken encoding (tiktoken downloads its encodings on first use):
+    every word with its trailing whitespace is one token, so decode(encode(text)) == text.
+    """
+    def __init__(self):
+        self._ids = {}
+        self._pieces = []
+
+    def _id(self, piece):
+        if piece not in self._ids:
+            self._ids[piece] = len(self._pieces)
+            self._pieces.append(piece)
+        return self._ids[piece]
+
+    def encode_ordinary(self, text):
+        return [self._id(piece) for piece in _PIECE.findall(text)]
+
+    def encode(self, text, **kwargs):
+        return self.encode_ordinary(text)
+
+    def encode_ordinary_batch(self, texts, **kwargs):
+        return [self.encode_ordinary(text) for text in texts]
+
+    def decode(self, tokens):
+        return "".join(self._pieces[token] for token in tokens)
+
+    def decode_batch(self, batch):
+        return [self.decode(tokens) for tokens in batch]
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    fake = FakeEncoding()
+    monkeypatch.setattr(Tokens, "getEncoding", lambda *args, **kwargs: fake)
+    return fake
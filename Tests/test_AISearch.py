@@ -0,0 +1,266 @@
+from types import SimpleNamespace
+import threading
+import time
+
+import pytest
+from azure.search.documents.indexes.models import SearchFieldDataType
+
+import AISearch
+import Clients
+import LocalSearch
+
+
+####################
+## Batched Embeddings
+####################
+class FakeEmbeddings:
+    #embeddings.create of the openai client. The items of a response come back in reverse order, with their index,
+    #and every vector is [position of the text in its batch, len(text)]
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def create(self, input, model):
+        with self._lock:
+            self.requests.append(list(input))
+        items = [SimpleNamespace(index=index, embedding=[float(index), float(len(text))]) for index, text in enumerate(input)]
+        return SimpleNamespace(data=items[::-1])
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    embeddings = FakeEmbeddings()
+    monkeypatch.setattr(Clients, "getOpenAIClient", lambda *args, **kwargs: SimpleNamespace(embeddings=embeddings))
+    return embeddings
+
+
+def test_batchTexts_stays_within_the_token_budget():
+    texts = ["a b c", "d e", "f g h i", "j", "k l m n o p"]
+    #tokens: 3, 2, 4, 1, 6
+    assert AISearch.batchTexts(texts, token_budget=6, max_inputs=10) == [[0, 1], [2, 3], [4]]
+
+def test_batchTexts_limits_the_inputs_per_batch():
+    assert AISearch.batchTexts(["a"] * 5, token_budget=100, max_inputs=2) == [[0, 1], [2, 3], [4]]
+
+def test_batchTexts_gives_an_oversized_text_its_own_batch():
+    assert AISearch.batchTexts(["a", "b c d e f", "g"], token_budget=3, max_inputs=10) == [[0], [1], [2]]
+
+def test_vectorizeStrings_returns_the_vectors_in_the_order_of_the_texts(embeddings):
+    texts = ["one", "three words here", "two words", "x", "four words in this"]
+
+    vectors = AISearch.vectorizeStrings(texts, token_budget=4, max_inputs=2, concurrency=3)
+
+    batches = AISearch.batchTexts(texts, token_budget=4, max_inputs=2)
+    assert sorted(map(tuple, embeddings.requests)) == sorted(tuple(texts[p] for p in batch) for batch in batches)
+    for batch in batches:
+        for index, position in enumerate(batch):
+            assert vectors[position] == [float(index), float(len(texts[position]))]
+
+def test_vectorizeStrings_of_no_text(embeddings):
+    assert AISearch.vectorizeStrings([]) == []
+    assert embeddings.requests == []
+
+
+####################
+## Ingestion Pipeline
+####################
+def recordStage(name):
+    def stage(job):
+        job.setdefault("stages", []).append(name)
+    return stage
+
+def test_runPipeline_runs_every_job_through_every_stage_in_order():
+    jobs = [{"file_name": f"file{index}.pdf"} for index in range(10)]
+    stages = [("analyze", recordStage("analyze"), 3), ("chunk", recordStage("chunk"), 2), ("index", recordStage("index"), 1)]
+
+    result = AISearch.runPipeline(jobs, stages, queue_size=1)
+
+    assert result is jobs
+    assert all(job["stages"] == ["analyze", "chunk", "index"] for job in jobs)
+
+def test_runPipeline_of_no_job():
+    assert AISearch.runPipeline([], [("analyze", recordStage("analyze"), 2), ("index", recordStage("index"), 2)]) == []
+
+def test_runPipeline_takes_a_failed_job_out_of_the_pipeline():
+    failed = []
+
+    def chunk(job):
+        if job["file_name"] == "broken.pdf":
+            raise ValueError("unreadable page")
+        recordStage("chunk")(job)
+
+    jobs = [{"file_name": "a.pdf"}, {"file_name": "broken.pdf"}, {"file_name": "b.pdf"}]
+    stages = [("analyze", recordStage("analyze"), 2), ("chunk", chunk, 2), ("index", recordStage("index"), 2)]
+    AISearch.runPipeline(jobs, stages, on_failure=failed.append)
+
+    broken = jobs[1]
+    assert broken["stages"] == ["analyze"]
+    assert (broken["error"], broken["failed_stage"]) == ("unreadable page", "chunk")
+    assert failed == [broken]
+    assert jobs[0]["stages"] == jobs[2]["stages"] == ["analyze", "chunk", "index"]
+    assert "error" not in jobs[0] and "error" not in jobs[2]
+
+def test_runPipeline_bounds_the_jobs_waiting_for_a_slow_stage():
+    release = threading.Event()
+    analyzed = []
+    lock = threading.Lock()
+
+    def analyze(job):
+        with lock:
+            analyzed.append(job["file_name"])
+
+    def index(job):
+        release.wait(5)
+
+    jobs = [{"file_name": f"file{index}.pdf"} for index in range(10)]
+    runner = threading.Thread(target=AISearch.runPipeline, args=(jobs, [("analyze", analyze, 1), ("index", index, 1)]), kwargs={"queue_size": 1})
+    runner.start()
+    try:
+        time.sleep(0.2)
+        #one job held by the index worker, one in its queue and one waiting to be queued by the analyze worker
+        with lock:
+            assert len(analyzed) <= 3
+    finally:
+        release.set()
+        runner.join(5)
+    assert len(analyzed) == 10
+
+
+####################
+## List Documents
+####################
+def schema(key_sortable=True):
+    return {
+        "name": "cars",
+        "key_field": "chunk_id",
+        "metadata": {},
+        "fields": [
+            {"name": "chunk_id", "type": SearchFieldDataType.String, "key": True, "sortable": key_sortable, "dimensions": None},
+            {"name": "chunk", "type": SearchFieldDataType.String, "key": False, "sortable": False, "dimensions": None},
+            {"name": "file_name", "type": SearchFieldDataType.String, "key": False, "sortable": True, "dimensions": None},
+            {"name": "content_vector", "type": SearchFieldDataType.Collection(SearchFieldDataType.Single), "key": False, "sortable": False, "dimensions": 2},
+        ]
+    }
+
+@pytest.fixture
+def index(monkeypatch):
+    index = LocalSearch.LocalSearchIndex()
+    index.upload_documents([
+        {"chunk_id": f"c{number:02d}", "chunk": f"chunk {number}", "file_name": "cars.pdf", "content_vector": [1.0, float(number)]}
+        for number in (7, 3, 9, 0, 5, 1, 8, 2, 6, 4)
+    ])
+    monkeypatch.setattr(Clients, "getSearchClient", lambda *args, **kwargs: index)
+    monkeypatch.setattr(AISearch, "getIndexSchemaCache", lambda: SimpleNamespace(get=lambda name: schema()))
+    return index
+
+def listAll(page_size, **kwargs):
+    pages, cursor = [], None
+    while True:
+        page = AISearch.listDocuments("cars", page_size=page_size, cursor=cursor, **kwargs)
+        pages.append(page)
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+@pytest.mark.parametrize("position", [{"after": "c03", "seen": 4}, {"after": "it's", "seen": 0}, {"skip": 200}])
+def test_cursor_round_trip(position):
+    assert AISearch.decodeCursor(AISearch.encodeCursor(position)) == position
+
+@pytest.mark.parametrize("cursor", ["not base64!", AISearch.encodeCursor({"after": "c03"}), AISearch.encodeCursor({"skip": "ten"}),
+                                    AISearch.encodeCursor(["skip"]), ""])
+def test_decodeCursor_rejects_invalid_cursors(cursor):
+    with pytest.raises(ValueError):
+        AISearch.decodeCursor(cursor)
+
+def test_listDocuments_pages_in_key_order(index):
+    pages = listAll(4)
+
+    assert [[document["chunk_id"] for document in page["documents"]] for page in pages] == [
+        ["c00", "c01", "c02", "c03"], ["c04", "c05", "c06", "c07"], ["c08", "c09"]
+    ]
+    assert all(page["total_count"] == 10 for page in pages)
+    assert all("content_vector" not in document for page in pages for document in page["documents"])
+
+def test_listDocuments_pages_are_not_shifted_by_changes(index):
+    first = AISearch.listDocuments("cars", page_size=4)
+    index.delete_documents([{"chunk_id": "c01"}])
+    index.upload_documents([{"chunk_id": "c00a", "chunk": "new", "file_name": "new.pdf"}])
+
+    second = AISearch.listDocuments("cars", page_size=4, cursor=first["next_cursor"])
+    assert [document["chunk_id"] for document in second["documents"]] == ["c04", "c05", "c06", "c07"]
+
+def test_listDocuments_selects_fields_and_vectors(index):
+    page = AISearch.listDocuments("cars", page_size=2, fields=["file_name"])
+    assert page["documents"] == [{"file_name": "cars.pdf"}, {"file_name": "cars.pdf"}]
+
+    page = AISearch.listDocuments("cars", page_size=1, include_vectors=True)
+    assert page["documents"][0]["content_vector"] == [1.0, 0.0]
+
+def test_listDocuments_pages_with_skip_without_a_sortable_key(index, monkeypatch):
+    monkeypatch.setattr(AISearch, "getIndexSchemaCache", lambda: SimpleNamespace(get=lambda name: schema(key_sortable=False)))
+    pages = listAll(4)
+
+    listed = [document["chunk_id"] for page in pages for document in page["documents"]]
+    assert sorted(listed) == [f"c{number:02d}" for number in range(10)]
+    assert AISearch.decodeCursor(pages[0]["next_cursor"]) == {"skip": 4}
+
+
+####################
+## Vector Field Options
+####################
+def test_vectorFieldOptions_defaults():
+    assert AISearch.vectorFieldOptions({}) == {
+        "dimensions": None, "vector_type": "float32", "stored": True, "algorithm": "hnsw", "metric": "cosine",
+        "m": None, "ef_construction": None, "ef_search": None, "compression": "none", "rescore": True,
+        "oversampling": None, "preserve_originals": True
+    }
+
+@pytest.mark.parametrize("options", [
+    {"dimensions": 1536, "vector_type": "float16", "stored": False},
+    {"algorithm": "hnsw", "m": 4, "ef_construction": 1000, "ef_search": 100, "metric": "dotProduct"},
+    {"algorithm": "exhaustive", "metric": "euclidean"},
+    {"compression": "scalar", "oversampling": 4},
+    {"compression": "binary", "oversampling": 2.5, "rescore": False, "preserve_originals": False},
+])
+def test_vectorFieldOptions_accepts_valid_options(options):
+    checked = AISearch.vectorFieldOptions(options)
+    assert all(checked[name] == value for name, value in options.items())
+
+@pytest.mark.parametrize("options", [
+    {"dimension": 1536},
+    {"dimensions": 1},
+    {"dimensions": 5000},
+    {"dimensions": "1536"},
+    {"m": True},
+    {"m": 11},
+    {"ef_search": 99.5},
+    {"vector_type": "int8"},
+    {"stored": "false"},
+    {"algorithm": "ivf"},
+    {"metric": "hamming"},
+    {"algorithm": "exhaustive", "ef_search": 200},
+    {"compression": "product"},
+    {"compression": "scalar", "oversampling": 0.5},
+    {"compression": "scalar", "oversampling": True},
+    {"compression": "scalar", "rescore": True, "preserve_originals": False},
+])
+def test_vectorFieldOptions_rejects_invalid_options(options):
+    with pytest.raises(ValueError):
+        AISearch.vectorFieldOptions(options)
+
+def test_vectorSearchConfiguration_of_a_compressed_hnsw_field():
+    options = AISearch.vectorFieldOptions({"m": 8, "ef_search": 200, "compression": "scalar", "oversampling": 4})
+    algorithm, compression, profile = AISearch.vectorSearchConfiguration("content_vector", options)
+
+    assert (algorithm.name, algorithm.parameters.m, algorithm.parameters.ef_search) == ("content_vector-hnsw", 8, 200)
+    assert compression.compression_name == "content_vector-scalar"
+    assert compression.rescoring_options.default_oversampling == 4
+    assert compression.rescoring_options.rescore_storage_method == "preserveOriginals"
+    assert (profile.algorithm_configuration_name, profile.compression_name) == ("content_vector-hnsw", "content_vector-scalar")
+
+def test_vectorSearchConfiguration_of_an_exhaustive_field():
+    options = AISearch.vectorFieldOptions({"algorithm": "exhaustive", "metric": "euclidean"})
+    algorithm, compression, profile = AISearch.vectorSearchConfiguration("content_vector", options)
+
+    assert (algorithm.name, algorithm.parameters.metric) == ("content_vector-exhaustive", "euclidean")
+    assert compression is None and profile.compression_name is None
@@ -0,0 +1,65 @@
+import pytest
+
+import AnswerCache
+
+
+@pytest.fixture
+def cache():
+    return AnswerCache.AnswerCache(threshold=0.95, max_entries=2, ttl_seconds=60)
+
+
+def test_a_close_question_gets_the_cached_answer(cache):
+    cache.store("cars", "warranty?", [1.0, 0.0], ["source"], "Five years.", cache.generation("cars"))
+
+    hit = cache.lookup("cars", [0.99, 0.05])
+    assert hit["answer"] == "Five years."
+    assert hit["query"] == "warranty?"
+    assert hit["sources"] == ["source"]
+    assert hit["similarity"] == pytest.approx(0.9987, abs=1e-4)
+
+def test_a_question_below_the_threshold_misses(cache):
+    cache.store("cars", "warranty?", [1.0, 0.0], [], "Five years.", cache.generation("cars"))
+
+    assert cache.lookup("cars", [0.9, 0.43]) is None #similarity ~0.90
+    assert cache.lookup("cars", [0.0, 0.0]) is None
+
+def test_entries_are_scoped_by_index(cache):
+    cache.store("cars", "warranty?", [1.0, 0.0], [], "Five years.", cache.generation("cars"))
+    assert cache.lookup("trucks", [1.0, 0.0]) is None
+
+def test_the_best_match_wins(cache):
+    cache.store("cars", "a", [1.0, 0.0], [], "A", 0)
+    cache.store("cars", "b", [0.98, 0.2], [], "B", 0)
+    assert cache.lookup("cars", [0.97, 0.24])["answer"] == "B"
+
+def test_invalidate_drops_the_entries_and_rejects_answers_started_before(cache):
+    generation = cache.generation("cars")
+    cache.store("cars", "warranty?", [1.0, 0.0], [], "Five years.", generation)
+
+    cache.invalidate("cars")
+    assert cache.lookup("cars", [1.0, 0.0]) is None
+
+    #an answer built from the sources read before the invalidation is not stored
+    cache.store("cars", "warranty?", [1.0, 0.0], [], "Five years.", generation)
+    assert cache.lookup("cars", [1.0, 0.0]) is None
+
+    cache.store("cars", "warranty?", [1.0, 0.0], [], "Seven years.", cache.generation("cars"))
+    assert cache.lookup("cars", [1.0, 0.0])["answer"] == "Seven years."
+
+def test_expired_entries_miss_and_are_dropped(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(AnswerCache.time, "time", lambda: now[0])
+    cache.store("cars", "warranty?", [1.0, 0.0], [], "Five years.", 0)
+
+    now[0] += 61
+    assert cache.lookup("cars", [1.0, 0.0]) is None
+    assert not cache._indexes["cars"]
+
+def test_the_least_recently_used_entry_is_evicted(cache):
+    cache.store("cars", "a", [1.0, 0.0], [], "A", 0)
+    cache.store("cars", "b", [0.0, 1.0], [], "B", 0)
+    assert cache.lookup("cars", [1.0, 0.0])["answer"] == "A"
+    cache.store("cars", "c", [-1.0, 0.0], [], "C", 0)
+
+    assert cache.lookup("cars", [0.0, 1.0]) is None
+    assert cache.lookup("cars", [1.0, 0.0])["answer"] == "A"
@@ -0,0 +1,71 @@
+import pytest
+
+import Chunker
+
+
+def sentences(count, words=5):
+    return [" ".join(f"s{index}w{word}" for word in range(words)) + "." for index in range(count)]
+
+def tokens(encoding, text):
+    return len(encoding.encode_ordinary(text))
+
+
+def test_splitSentences_keeps_every_character():
+    text = "First one. Second one!  Third?\n\nNew paragraph without end"
+    pieces = Chunker.splitSentences(text)
+    assert "".join(pieces) == text
+    assert [piece.strip() for piece in pieces] == ["First one.", "Second one!", "Third?", "New paragraph without end"]
+
+@pytest.mark.parametrize("text", ["", "   \n  "])
+def test_chunkText_of_empty_text_is_empty(text):
+    assert Chunker.chunkText(text) == []
+
+def test_chunkText_rejects_an_overlap_as_large_as_the_chunk():
+    with pytest.raises(ValueError):
+        Chunker.chunkText("Some text.", chunk_size=10, overlap=10)
+
+def test_chunkText_packs_whole_sentences_within_the_token_limit(encoding):
+    text = " ".join(sentences(20))
+    chunks = Chunker.chunkText(text, chunk_size=22, overlap=0)
+
+    assert all(tokens(encoding, chunk) <= 22 for chunk in chunks)
+    assert all(chunk.endswith(".") for chunk in chunks)
+    #without overlap the chunks are the text cut between sentences
+    assert " ".join(chunks) == text
+
+def test_chunkText_repeats_the_last_sentences_within_the_overlap(encoding):
+    parts = sentences(12)
+    chunks = Chunker.chunkText(" ".join(parts), chunk_size=17, overlap=6)
+
+    assert len(chunks) > 1
+    for previous, current in zip(chunks, chunks[1:]):
+        assert tokens(encoding, current) <= 17
+        last_sentence = previous.split(". ")[-1]
+        assert current.startswith(last_sentence)
+        assert tokens(encoding, last_sentence) <= 6
+    #every sentence is in a chunk and the chunks move forward
+    assert all(any(part in chunk for chunk in chunks) for part in parts)
+    assert chunks[-1].endswith(parts[-1])
+
+def test_chunkText_does_not_overlap_sentences_longer_than_the_overlap(encoding):
+    chunks = Chunker.chunkText(" ".join(sentences(6, words=8)), chunk_size=20, overlap=4)
+    for previous, current in zip(chunks, chunks[1:]):
+        assert previous.split(". ")[-1] not in current
+
+def test_chunkText_splits_a_sentence_longer_than_the_chunk(encoding):
+    long_sentence = " ".join(f"w{index}" for index in range(25)) + "."
+    chunks = Chunker.chunkText(long_sentence, chunk_size=10, overlap=2)
+
+    assert [tokens(encoding, chunk) for chunk in chunks] == [10, 10, 5]
+    assert " ".join(chunks) == long_sentence
+
+def test_chunkText_without_sentences_uses_overlapping_token_windows(encoding):
+    text = " ".join(f"w{index}" for index in range(30))
+    chunks = Chunker.chunkText(text, chunk_size=10, overlap=3, snap_to_sentences=False)
+
+    windows = [chunk.split() for chunk in chunks]
+    assert [window[0] for window in windows] == ["w0", "w7", "w14", "w21"]
+    assert all(len(window) <= 10 for window in windows)
+    assert windows[-1][-1] == "w29"
+    for previous, current in zip(windows, windows[1:]):
+        assert previous[-3:] == current[:3]
@@ -0,0 +1,180 @@
+import threading
+
+import pytest
+from azure.cosmos.exceptions import CosmosBatchOperationError
+
+import Database
+import LocalContainer
+
+
+@pytest.fixture
+def container():
+    container = LocalContainer.InMemoryContainer()
+    previous = Database.setContainerProvider(LocalContainer.InMemoryContainerProvider(container))
+    container.create_item({"id": "user", "userId": "user", "documentType": "user", "user_type": "user", "username": "user"})
+    yield container
+    Database.setContainerProvider(previous)
+    with Database._session_sequences_lock:
+        Database._session_sequences.clear()
+
+def storedMessages(container, session_id):
+    query, parameters = Database.messagesQuery(session_id)
+    return list(container.query_items(query=query, parameters=parameters, partition_key="user"))
+
+def turn(number):
+    return [("user", f"question {number}"), ("assistant", f"answer {number}")]
+
+
+####################
+## Message Order
+####################
+def test_legacySequence_is_the_sent_time_in_microseconds():
+    assert Database.legacySequence("2024-01-01T00:00:00.000001+00:00") == 1704067200000001
+    assert Database.legacySequence(None) == 0
+    assert Database.legacySequence("yesterday") == 0
+
+def test_orderMessages_by_seq_then_sent_time_then_id():
+    messages = [
+        {"id": "b", "seq": 1704067200000005},
+        {"id": "legacy-late", "sentAt": "2024-01-01T00:00:00.000009+00:00"},
+        {"id": "a", "seq": 1704067200000005},
+        {"id": "legacy-early", "sentAt": "2024-01-01T00:00:00+00:00"},
+    ]
+    assert [message["id"] for message in Database.orderMessages(messages)] == ["legacy-early", "a", "b", "legacy-late"]
+
+def test_the_message_queries_leave_the_order_to_orderMessages():
+    assert "ORDER BY" not in Database.messagesQuery("session")[0].upper()
+    assert "ORDER BY" not in Database.messagesAfterQuery("session", after_seq=3)[0].upper()
+
+
+####################
+## Sequence Numbers
+####################
+def test_messages_are_numbered_from_the_session_counter(container):
+    session_id = Database.addSession("user", "Cars")
+    assert container.read_item(session_id, "user")["lastSeq"] == 0
+
+    for number in range(3):
+        Database.addMessages("user", session_id, turn(number), write_behind=False)
+
+    assert sorted(message["seq"] for message in storedMessages(container, session_id)) == list(range(1, 7))
+    assert container.read_item(session_id, "user")["lastSeq"] == 6
+    assert Database.getMessages("user", session_id)[-2:] == [
+        {"role": "user", "content": "question 2"}, {"role": "assistant", "content": "answer 2"}
+    ]
+    assert [message["seq"] for message in Database.getMessagesAfter("user", session_id, after_seq=4)] == [5, 6]
+
+def test_a_stale_counter_is_read_again(container):
+    session_id = Database.addSession("user", "Cars")
+    Database.addMessages("user", session_id, turn(0), write_behind=False)
+    #another instance wrote a turn since this one cached the counter
+    Database.rememberSequence(session_id, 0)
+
+    Database.addMessages("user", session_id, turn(1), write_behind=False)
+
+    assert sorted(message["seq"] for message in storedMessages(container, session_id)) == [1, 2, 3, 4]
+    assert Database.cachedSequence(session_id) == 4
+
+def test_concurrent_writers_never_share_a_seq(container, monkeypatch):
+    monkeypatch.setattr(Database, "SESSION_SEQUENCE_RETRIES", 100)
+    session_id = Database.addSession("user", "Cars")
+
+    def write(writer):
+        for number in range(5):
+            #every writer starts from a stale or missing counter, like separate Function instances
+            if number % 2:
+                Database.forgetSequence(session_id)
+            else:
+                Database.rememberSequence(session_id, 0)
+            Database.addMessages("user", session_id, turn(f"{writer}-{number}"), write_behind=False)
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    messages = Database.orderMessages(storedMessages(container, session_id))
+    assert [message["seq"] for message in messages] == list(range(1, 31))
+    #the two messages of a turn stay next to each other
+    for question, answer in zip(messages[::2], messages[1::2]):
+        assert question["content"].replace("question", "answer") == answer["content"]
+
+def test_a_session_without_counter_continues_after_its_legacy_messages(container):
+    container.create_item({"id": "old", "userId": "user", "documentType": "session", "sessionTitle": "Old"})
+    container.create_item({"id": "m1", "userId": "user", "sessionId": "old", "documentType": "message", "role": "user",
+                           "content": "first", "sentAt": "2024-01-01T00:00:00+00:00"})
+    container.create_item({"id": "m2", "userId": "user", "sessionId": "old", "documentType": "message", "role": "assistant",
+                           "content": "second", "seq": 1704067200000009, "sentAt": "2024-01-01T00:00:00+00:00"})
+
+    Database.addMessages("user", "old", [("user", "third")], write_behind=False)
+
+    assert [message["content"] for message in Database.getMessages("user", "old")] == ["first", "second", "third"]
+    assert container.read_item("old", "user")["lastSeq"] == 1704067200000010
+
+def test_a_retried_write_does_not_store_the_messages_twice(container):
+    session_id = Database.addSession("user", "Cars")
+    documents = Database.buildMessages("user", session_id, turn(0))
+
+    Database.writeMessages(Database.initializeContainer("addMessages"), "user", documents)
+    Database.writeMessages(Database.initializeContainer("addMessages"), "user", documents)
+
+    assert [document["seq"] for document in documents] == [1, 2]
+    assert len(storedMessages(container, session_id)) == 2
+
+def test_a_batch_with_a_failed_counter_patch_is_not_applied(container):
+    session_id = Database.addSession("user", "Cars")
+    operations, _ = Database.messageBatch(session_id, 5, Database.buildMessages("user", session_id, turn(0)))
+
+    with pytest.raises(CosmosBatchOperationError) as error:
+        container.execute_item_batch(batch_operations=operations, partition_key="user")
+
+    assert Database.isSequenceConflict(error.value)
+    assert storedMessages(container, session_id) == []
+    assert container.read_item(session_id, "user")["lastSeq"] == 0
+
+
+####################
+## Bulk Deletes
+####################
+def createItems(container, count):
+    ids = [f"item{number}" for number in range(count)]
+    for item_id in ids:
+        container.create_item({"id": item_id, "userId": "user", "documentType": "message"})
+    return ids
+
+def test_deleteBatch_deletes_in_one_batch(container, monkeypatch):
+    ids = createItems(container, 3)
+    single_deletes = []
+    monkeypatch.setattr(container, "delete_item", lambda **kwargs: single_deletes.append(kwargs))
+
+    assert Database._deleteBatch(container, "user", ids) == 3
+    assert single_deletes == []
+    assert not [item for item in container._items.values() if item["documentType"] == "message"]
+
+def test_deleteBatch_falls_back_to_single_deletes_when_an_item_is_gone(container):
+    ids = createItems(container, 3)
+    container.delete_item(item="item1", partition_key="user")
+
+    assert Database._deleteBatch(container, "user", ids) == 2
+    assert not [item for item in container._items.values() if item["documentType"] == "message"]
+
+def test_deleteItems_in_concurrent_batches(container):
+    ids = createItems(container, 25)
+    container.delete_item(item="item12", partition_key="user")
+
+    assert Database.deleteItems(container, "user", ids, batch_size=4, concurrency=3) == 24
+    assert Database.deleteItems(container, "user", [], batch_size=4) == 0
+    assert list(container._items) == [("user", "user")]
+
+def test_deleteSession_removes_its_messages_and_the_session(container):
+    session_id = Database.addSession("user", "Cars")
+    other_id = Database.addSession("user", "Other")
+    for number in range(3):
+        Database.addMessages("user", session_id, turn(number), write_behind=False)
+    Database.addMessages("user", other_id, turn(0), write_behind=False)
+
+    assert Database.deleteSession("user", session_id)["deleted"] == 7
+    assert storedMessages(container, session_id) == []
+    assert len(storedMessages(container, other_id)) == 2
+    assert Database.cachedSequence(session_id) is None
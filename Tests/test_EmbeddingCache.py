@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import EmbeddingCache
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(EmbeddingCache.time, "time", clock)
+    return clock
+
+
+def test_lookups_ignore_case_and_whitespace_but_not_the_deployment(clock):
+    cache = EmbeddingCache.EmbeddingCache(max_entries=8, ttl_seconds=60, path=None)
+    cache.put("What  is the  warranty?", "small", [0.5, 0.25])
+
+    assert cache.get(" what is the WARRANTY? ", "small") == [0.5, 0.25]
+    assert cache.get("what is the warranty?", "large") is None
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = EmbeddingCache.EmbeddingCache(max_entries=8, ttl_seconds=60, path=None)
+    cache.put("query", "small", [1.0])
+
+    clock.now += 60
+    assert cache.get("query", "small") == [1.0]
+    clock.now += 1
+    assert cache.get("query", "small") is None
+    assert cache.stats()["entries"] == 0
+
+def test_the_least_recently_used_entry_is_evicted(clock):
+    cache = EmbeddingCache.EmbeddingCache(max_entries=2, ttl_seconds=60, path=None)
+    cache.put("a", "small", [1.0])
+    cache.put("b", "small", [2.0])
+    cache.get("a", "small")
+    cache.put("c", "small", [3.0])
+
+    assert cache.get("b", "small") is None
+    assert cache.get("a", "small") == [1.0]
+    assert cache.get("c", "small") == [3.0]
+
+def test_getOrCreate_embeds_once_per_query(clock):
+    cache = EmbeddingCache.EmbeddingCache(max_entries=8, ttl_seconds=60, path=None)
+    calls = []
+
+    def embed(text):
+        calls.append(text)
+        return [0.5]
+
+    assert cache.getOrCreate("query", "small", embed) == [0.5]
+    assert cache.getOrCreate("Query ", "small", embed) == [0.5]
+    assert calls == ["query"]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+def test_getOrCreateAsync_with_a_sqlite_file(clock, tmp_path):
+    cache = EmbeddingCache.EmbeddingCache(max_entries=8, ttl_seconds=60, path=str(tmp_path / "cache.sqlite"))
+    calls = []
+
+    async def embed(text):
+        calls.append(text)
+        return [0.25, 0.75]
+
+    async def lookups():
+        return [await cache.getOrCreateAsync("query", "small", embed) for _ in range(2)]
+
+    assert asyncio.run(lookups()) == [[0.25, 0.75], [0.25, 0.75]]
+    assert calls == ["query"]
+    cache.close()
+
+def test_the_sqlite_file_survives_a_new_cache(clock, tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    first = EmbeddingCache.EmbeddingCache(max_entries=8, ttl_seconds=60, path=path)
+    first.put("query", "small", [0.5, -1.5])
+    first.close()
+
+    second = EmbeddingCache.EmbeddingCache(max_entries=8, ttl_seconds=60, path=path)
+    assert second.get("query", "small") == [0.5, -1.5]
+    assert second.stats()["entries"] == 1
+
+    #an expired row is removed from the file when it is read
+    second.clear()
+    second.put("old", "small", [1.0])
+    second._entries.clear()
+    clock.now += 61
+    assert second.get("old", "small") is None
+    assert second._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] == 0
+    second.close()
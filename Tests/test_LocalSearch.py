@@ -0,0 +1,183 @@
+import os
+
+import numpy as np
+import pytest
+
+import LocalSearch
+
+
+def keys(results, key_field="chunk_id"):
+    return [document[key_field] for document in results]
+
+@pytest.fixture
+def index():
+    index = LocalSearch.LocalSearchIndex()
+    index.upload_documents([
+        {"chunk_id": "engine", "chunk": "The hybrid engine has 300 horsepower and low fuel use.", "file_name": "sedan.pdf",
+         "parent_id": "sedan", "chunk_index": "0", "content_vector": [1.0, 0.0, 0.0]},
+        {"chunk_id": "warranty", "chunk": "The warranty covers the hybrid battery for eight years.", "file_name": "sedan.pdf",
+         "parent_id": "sedan", "chunk_index": "1", "content_vector": [0.0, 1.0, 0.0]},
+        {"chunk_id": "seats", "chunk": "Leather seats, leather steering wheel and a leather dashboard.", "file_name": "it's suv.pdf",
+         "parent_id": "suv", "chunk_index": "0", "content_vector": [0.0, 0.0, 1.0]},
+        {"chunk_id": "trim", "chunk": "Premium trim with leather seats.", "file_name": "it's suv.pdf",
+         "parent_id": "suv", "chunk_index": "1", "content_vector": [0.6, 0.0, 0.8]},
+        {"chunk_id": "notes", "chunk": "Dealer notes without a vector.", "file_name": None, "parent_id": "notes", "chunk_index": "0"},
+    ])
+    return index
+
+
+####################
+## Filters
+####################
+DOCUMENT = {"file_name": "it's suv.pdf", "chunk_index": "4", "page_number": 2, "archived": False, "owner": None}
+
+@pytest.mark.parametrize("search_filter, expected", [
+    ("file_name eq 'it''s suv.pdf'", True),
+    ("file_name ne 'it''s suv.pdf'", False),
+    ("chunk_index ge 3 and chunk_index le 5", True),
+    ("chunk_index gt 10", False),
+    ("chunk_index lt 10", True), #compared as a number, not as the string "4" < "10"
+    ("page_number eq 2 and archived eq false", True),
+    ("owner eq null", True),
+    ("owner ne null", False),
+    ("missing eq null", True),
+    ("page_number eq 3 or page_number eq 2", True),
+    ("not (page_number eq 2)", False),
+    ("page_number eq 3 and page_number eq 3 or archived eq false", True), #and binds tighter than or
+    ("page_number eq 3 and (page_number eq 3 or archived eq false)", False),
+    ("(file_name eq 'other.pdf' and chunk_index ge 3) or (file_name eq 'it''s suv.pdf' and chunk_index ge 3 and chunk_index le 5)", True),
+])
+def test_parseFilter(search_filter, expected):
+    assert LocalSearch.parseFilter(search_filter)(DOCUMENT) is expected
+
+@pytest.mark.parametrize("search_filter", [
+    "page_number eq",
+    "page_number like 2",
+    "(page_number eq 2",
+    "page_number eq 2 page_number eq 3",
+    "file_name eq suv",
+    "search.in(file_name, 'a,b')",
+])
+def test_parseFilter_rejects_unsupported_filters(search_filter):
+    with pytest.raises(ValueError):
+        LocalSearch.parseFilter(search_filter)(DOCUMENT)
+
+def test_search_with_the_neighbour_filter_of_the_chatbot(index):
+    results = index.search(search_text="*", filter="(parent_id eq 'suv' and chunk_index ge 0 and chunk_index le 1) or (parent_id eq 'sedan' and chunk_index ge 1 and chunk_index le 2)")
+    assert sorted(keys(results)) == ["seats", "trim", "warranty"]
+
+
+####################
+## Ranking
+####################
+def test_keyword_search_ranks_with_bm25(index):
+    #the shorter chunk with leather once ranks below the one repeating it, documents without the terms are left out
+    assert keys(index.search(search_text="leather")) == ["seats", "trim"]
+    #the rare term (battery) outweighs the common one (hybrid)
+    assert keys(index.search(search_text="hybrid battery"))[0] == "warranty"
+    assert index.search(search_text="submarine") == []
+
+def test_vector_search_returns_the_nearest_documents(index):
+    results = index.search(vector_queries=[{"vector": [0.0, 0.1, 1.0], "k_nearest_neighbors": 2, "fields": "content_vector"}])
+    assert keys(results) == ["seats", "trim"]
+    assert results[0]["@search.score"] == pytest.approx(1.0 / np.linalg.norm([0.0, 0.1, 1.0]))
+
+def test_vector_search_rejects_an_unknown_field(index):
+    with pytest.raises(ValueError):
+        index.search(vector_queries=[{"vector": [1.0, 0.0, 0.0], "fields": "summary_vector"}])
+
+def test_hybrid_search_fuses_the_rankings(index):
+    results = index.search(search_text="leather seats", vector_queries=[{"vector": [0.6, 0.0, 0.8], "k_nearest_neighbors": 3}])
+
+    #trim is 2nd by keywords and 1st by vector, seats 1st by keywords and 2nd by vector
+    scores = {document["chunk_id"]: document["@search.score"] for document in results}
+    assert scores["trim"] == pytest.approx(1 / (LocalSearch.RRF_K + 2) + 1 / (LocalSearch.RRF_K + 1))
+    assert scores["seats"] == pytest.approx(1 / (LocalSearch.RRF_K + 1) + 1 / (LocalSearch.RRF_K + 2))
+    assert set(keys(results[:2])) == {"trim", "seats"}
+    assert keys(results)[2] == "engine"
+
+def test_search_pages_and_selects(index):
+    results = index.search(search_text="*", select="chunk_id,file_name", top=2, skip=1, include_total_count=True)
+    assert results == [
+        {"chunk_id": "warranty", "file_name": "sedan.pdf", "@search.score": 1.0},
+        {"chunk_id": "seats", "file_name": "it's suv.pdf", "@search.score": 1.0},
+    ]
+    assert results.get_count() == 5
+    assert index.search(search_text="*").get_count() is None
+
+def test_search_orders_by_fields(index):
+    assert keys(index.search(search_text="*", order_by=["file_name desc", "chunk_id asc"])) == ["engine", "warranty", "seats", "trim", "notes"]
+    assert keys(index.search(search_text="*", order_by="chunk_id"))[:2] == ["engine", "notes"]
+
+def test_search_rejects_unsupported_arguments(index):
+    with pytest.raises(ValueError):
+        index.search(search_text="*", query_type="semantic")
+    with pytest.raises(ValueError):
+        index.search(search_text="*", order_by="content_vector asc")
+
+def test_replaced_and_deleted_documents_leave_the_index(index):
+    index.upload_documents([{"chunk_id": "seats", "chunk": "Cloth seats.", "file_name": "suv.pdf"}])
+    index.delete_documents([{"chunk_id": "trim"}])
+
+    assert keys(index.search(search_text="leather")) == []
+    assert keys(index.search(search_text="cloth")) == ["seats"]
+    assert len(index) == index.get_document_count() == 4
+    #the replaced document has no vector anymore
+    assert "seats" not in keys(index.search(vector_queries=[{"vector": [0.0, 0.0, 1.0]}]))
+
+
+####################
+## Snapshots
+####################
+def test_snapshot_round_trip(index, tmp_path):
+    index.delete_documents([{"chunk_id": "engine"}])
+    index.saveSnapshot(str(tmp_path))
+
+    loaded = LocalSearch.LocalSearchIndex.loadSnapshot(str(tmp_path))
+
+    assert len(loaded) == 4
+    for arguments in ({"search_text": "leather seats"}, {"vector_queries": [{"vector": [0.6, 0.0, 0.8]}]},
+                      {"search_text": "hybrid", "vector_queries": [{"vector": [0.0, 1.0, 0.0]}], "filter": "parent_id eq 'sedan'"}):
+        assert loaded.search(**arguments) == index.search(**arguments)
+    assert loaded.search(search_text="*", filter="chunk_id eq 'notes'")[0].get("content_vector") is None
+
+    #the memory-mapped vectors are copied on the first write
+    loaded.upload_documents([{"chunk_id": "new", "chunk": "Towing hitch.", "content_vector": [0.0, 1.0, 0.0]}])
+    assert keys(loaded.search(search_text="towing")) == ["new"]
+
+@pytest.fixture
+def snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(LocalSearch, "LOCAL_SEARCH_SNAPSHOT_PATH", str(tmp_path))
+    monkeypatch.setattr(LocalSearch, "SEARCH_BACKEND", "local")
+    monkeypatch.setattr(LocalSearch, "_indexes", {})
+    return tmp_path
+
+def test_synced_documents_are_logged_and_compacted(snapshots, monkeypatch):
+    LocalSearch.syncDocuments("cars", [{"chunk_id": "a", "chunk": "First batch.", "content_vector": [1.0, 0.0]}])
+    LocalSearch.syncDocuments("cars", [{"chunk_id": "b", "chunk": "Second batch.", "content_vector": [0.0, 1.0]},
+                                       {"chunk_id": "a", "@search.action": "delete"}])
+    assert os.path.exists(snapshots / "cars" / "changes.jsonl")
+    assert not os.path.exists(snapshots / "cars" / "meta.json")
+
+    #another worker loads the logged batches
+    monkeypatch.setattr(LocalSearch, "_indexes", {})
+    assert keys(LocalSearch.getIndex("cars").search(search_text="batch")) == ["b"]
+
+    LocalSearch.compactSnapshot("cars")
+    assert os.path.exists(snapshots / "cars" / "meta.json")
+    assert not os.path.exists(snapshots / "cars" / "changes.jsonl")
+    monkeypatch.setattr(LocalSearch, "_indexes", {})
+    index = LocalSearch.getIndex("cars")
+    assert keys(index.search(search_text="batch")) == ["b"]
+    assert keys(index.search(vector_queries=[{"vector": [0.0, 1.0]}])) == ["b"]
+
+def test_the_log_is_compacted_once_it_reaches_its_limit(snapshots, monkeypatch):
+    monkeypatch.setattr(LocalSearch, "LOCAL_SEARCH_COMPACT_BYTES", 200)
+    for number in range(5):
+        LocalSearch.syncDocuments("cars", [{"chunk_id": f"c{number}", "chunk": f"Chunk number {number} of the manual."}])
+
+    assert os.path.exists(snapshots / "cars" / "meta.json")
+    log_path = snapshots / "cars" / "changes.jsonl"
+    assert not os.path.exists(log_path) or os.path.getsize(log_path) < 200
+    monkeypatch.setattr(LocalSearch, "_indexes", {})
+    assert len(LocalSearch.getIndex("cars")) == 5